@@ -9,12 +9,19 @@ from gitdb.util import (
     hex_to_bin
 )
 
+from gitdb.utils.compat import xrange
 from gitdb.utils.encoding import force_text
 from gitdb.exc import (
     BadObject,
     AmbiguousObjectName
 )
+from gitdb.fun import (
+    is_equal_canonical_sha,
+    type_to_type_id_map
+)
 
+from bisect import bisect_left
+from heapq import merge
 from itertools import chain
 
 
@@ -145,6 +152,65 @@ class CachingDB(object):
     # END interface
 
 
+class _LazyOStream(object):
+
+    """An OStream-like object of a database or pack entity, which is only read if its
+    stream is accessed"""
+    __slots__ = ('_db', 'binsha', 'type', 'size')
+
+    def __init__(self, db, info):
+        self._db = db
+        self.binsha = info.binsha
+        self.type = info.type
+        self.size = info.size
+
+    @property
+    def type_id(self):
+        return type_to_type_id_map[self.type]
+
+    @property
+    def stream(self):
+        return self._db.stream(self.binsha)
+
+
+def _iter_shas(buf):
+    """:return: iterator over the 20 byte shas in the given buffer"""
+    return (buf[ofs:ofs + 20] for ofs in xrange(0, len(buf), 20))
+
+
+def _sorted_sha_iter(db):
+    """:return: iterator over the binary shas of the given database in ascending order.
+        The sorted sha tables of packs are read as they are, and only the shas of all
+        other databases are sorted"""
+    entities = getattr(db, 'entities', None)
+    if entities is None:
+        return iter(sorted(db.sha_iter()))
+    # END handle unsorted databases
+
+    def index_shas(entity):
+        with entity.index() as index:
+            sha = index.sha
+            for i in xrange(index.size()):
+                yield sha(i)
+            # END for each sha
+        # END with index
+    return merge(*[index_shas(entity) for entity in entities()])
+
+
+def _merge_sorted_shas(sha_iters):
+    """:return: bytes buffer of the unique shas of the given sorted iterators, in ascending
+        order, built without keeping an object per sha"""
+    buf = bytearray()
+    last = None
+    for sha in merge(*list(sha_iters)):
+        if sha != last:
+            buf += sha
+            last = sha
+        # END skip duplicates
+    # END for each sha
+    return bytes(buf)
+
+
 def _databases_recursive(database, output):
     """Fill output list with database from db, in order. Deals with Loose, Packed
     and compound databases."""
@@ -163,13 +229,27 @@ class CompoundDB(ObjectDBR, LazyMixin, CachingDB):
     """A database which delegates calls to sub-databases.
 
     Databases are stored in the lazy-loaded _dbs attribute.
-    Define _set_cache_ to update it with your databases"""
+    Define _set_cache_ to update it with your databases
+
+    Partial shas are resolved using the lazy-loaded _prefix_index attribute, one buffer
+    of the sorted binary shas of all databases, which is rebuilt once the databases
+    report a change in ``update_cache``. Shas added later, like those of stored objects,
+    are kept in the sorted _prefix_index_new list, which is merged into the buffer once
+    it grew large. Prefixes found in either are answered by bisection alone.
+    As databases which don't cache, like loose ones, can't report changes, they
+    are asked in addition for prefixes which aren't found. Objects written into them
+    by other processes make indexed prefixes ambiguous only after ``update_cache(force=True)``"""
 
     def _set_cache_(self, attr):
         if attr == '_dbs':
             self._dbs = []
         elif attr == '_db_cache':
             self._db_cache = dict()
+        elif attr in ('_prefix_index', '_prefix_index_new'):
+            databases = []
+            _databases_recursive(self, databases)
+            self._prefix_index = _merge_sorted_shas(_sorted_sha_iter(db) for db in databases)
+            self._prefix_index_new = []
         else:
             super(CompoundDB, self)._set_cache_(attr)
 
@@ -231,15 +311,53 @@ class CompoundDB(ObjectDBR, LazyMixin, CachingDB):
                 stat |= db.update_cache(force)
             # END if is caching db
         # END for each database to update
+        if stat or force:
+            self.__dict__.pop('_prefix_index', None)
+            self.__dict__.pop('_prefix_index_new', None)
+        # END rebuild prefix index lazily
         return stat
 
+    def _prefix_index_find(self, binsha):
+        """:return: byte offset of the first sha in our prefix index which is not less than
+            the given binary sha, or the index size if there is none"""
+        index = self._prefix_index
+        lo = 0
+        hi = len(index) // 20
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if index[mid * 20:mid * 20 + 20] < binsha:
+                lo = mid + 1
+            else:
+                hi = mid
+            # END handle midpoint
+        # END bisect
+        return lo * 20
+
+    def _prefix_index_add(self, binsha):
+        """Add the given 20 byte sha to our prefix index, if it was built already.
+        It goes into the list of new shas, which is merged into the buffer once it holds
+        more than a 64th of its shas, hence the buffer is copied rarely"""
+        if '_prefix_index' not in self.__dict__:
+            return
+        # END handle unbuilt index
+        index = self._prefix_index
+        new_shas = self._prefix_index_new
+        ofs = self._prefix_index_find(binsha)
+        pos = bisect_left(new_shas, binsha)
+        if index[ofs:ofs + 20] == binsha or (pos < len(new_shas) and new_shas[pos] == binsha):
+            return
+        # END skip known sha
+        new_shas.insert(pos, binsha)
+        if len(new_shas) > max(1024, len(index) // (20 * 64)):
+            self._prefix_index = _merge_sorted_shas((_iter_shas(index), iter(new_shas)))
+            self._prefix_index_new = []
+        # END merge new shas
+
     def partial_to_complete_sha_hex(self, partial_hexsha):
         """
         :return: 20 byte binary sha1 from the given less-than-40 byte hexsha (bytes or str)
         :param partial_hexsha: hexsha with less than 40 byte
         :raise AmbiguousObjectName: """
-        databases = []
-        _databases_recursive(self, databases)
         partial_hexsha = force_text(partial_hexsha)
         len_partial_hexsha = len(partial_hexsha)
         if len_partial_hexsha % 2 != 0:
@@ -248,8 +366,31 @@ class CompoundDB(ObjectDBR, LazyMixin, CachingDB):
             partial_binsha = hex_to_bin(partial_hexsha)
         # END assure successful binary conversion
 
+        # both parts of the index are sorted, hence all matching shas follow the first one
+        index = self._prefix_index
+        ofs = self._prefix_index_find(partial_binsha)
+        new_shas = self._prefix_index_new
+        pos = bisect_left(new_shas, partial_binsha)
+        matches = [binsha for binsha in (index[ofs:ofs + 20], index[ofs + 20:ofs + 40])
+                   + tuple(new_shas[pos:pos + 2])
+                   if binsha and is_equal_canonical_sha(len_partial_hexsha, partial_binsha, binsha)]
+        if len(matches) > 1:
+            raise AmbiguousObjectName(partial_hexsha)
+        if matches:
+            return matches[0]
+        # END handle index hit
+
+        # objects might have been added since the index was built, i.e. by other processes
+        if self.update_cache():
+            return self.partial_to_complete_sha_hex(partial_hexsha)
+        # END handle changed databases
+        databases = []
+        _databases_recursive(self, databases)
         candidate = None
         for db in databases:
+            if isinstance(db, CachingDB):
+                continue
+            # END skip databases covered by the index
             full_bin_sha = None
             try:
                 if hasattr(db, 'partial_to_complete_sha_hex'):
@@ -268,6 +409,7 @@ class CompoundDB(ObjectDBR, LazyMixin, CachingDB):
         # END for each db
         if not candidate:
             raise BadObject(partial_binsha)
+        self._prefix_index_add(candidate)
         return candidate
 
     #} END interface
@@ -3,20 +3,319 @@
 # This module is part of GitDB and is released under
 # the New BSD License: http://www.opensource.org/licenses/bsd-license.php
 from _functools import partial
+from collections import namedtuple
+from itertools import chain
+from multiprocessing import cpu_count, Pool
 import os
+import zlib
 
+import smmap
+
+from gitdb.base import IStream
+from gitdb.const import NULL_BYTE
 from gitdb.db.base import (
+    CachingDB,
     CompoundDB,
     ObjectDBW,
-    FileDBBase
+    FileDBBase,
+    _databases_recursive,
+    _LazyOStream
 )
 from gitdb.db.loose import LooseObjectDB
 from gitdb.db.pack import PackedDB
 from gitdb.db.ref import ReferenceDB
-from gitdb.exc import InvalidDBRoot
+from gitdb.exc import (
+    BadObject,
+    InvalidDBRoot
+)
+from gitdb.fun import chunk_size
+from gitdb.pack import PackEntity
+from gitdb.util import (
+    bin_to_hex,
+    hex_to_bin,
+    make_sha
+)
+from gitdb.utils.compat import (
+    xrange,
+    ExitStack
+)
+from gitdb.utils.encoding import force_text
+
+
+__all__ = ('GitDB', 'VerifyError', 'VerifyReport', 'copy_objects')
+
+
+#{ Verification
+
+class VerifyError(namedtuple('VerifyError', 'path, binsha, kind, message')):
+
+    """A problem found by ``GitDB.verify()``. path is the file it was found in, binsha the
+    binary sha of the affected object, or None if the file as a whole is affected. kind is
+    one of the kinds of ``PackEntity.verify()``"""
+    __slots__ = ()
+
+
+class VerifyReport(object):
+
+    """The result of ``GitDB.verify()``"""
+    __slots__ = ('packs', 'packed_objects', 'loose_objects', 'errors')
+
+    def __init__(self):
+        self.packs = 0              # amount of verified packs
+        self.packed_objects = 0     # amount of objects in these packs
+        self.loose_objects = 0      # amount of verified loose objects
+        self.errors = []            # VerifyError instances of all problems found
+
+    def is_valid(self):
+        """:return: True if no problems were found"""
+        return not self.errors
+
+    def corrupt_objects(self):
+        """:return: set of binary shas of all objects with problems"""
+        return set(error.binsha for error in self.errors if error.binsha is not None)
+
+
+def _verify_loose_object(path, binsha):
+    """:return: tuple(kind, message) describing the problem of the loose object at path,
+        or None if it is intact"""
+    zstream = zlib.decompressobj()
+    sha = make_sha()
+    header = b''
+    size = 0
+    try:
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                data = zstream.decompress(chunk)
+                sha.update(data)
+                size += len(data)
+                if len(header) < 64 and NULL_BYTE not in header:
+                    header += data[:64]
+                # END collect header
+            # END for each chunk
+            data = zstream.flush()
+        # END with file
+    except (IOError, OSError, zlib.error) as exc:
+        return 'object', "Object could not be read: %s" % exc
+    # END handle unreadable object
+    sha.update(data)
+    size += len(data)
+
+    try:
+        header = header[:header.index(NULL_BYTE) + 1]
+        object_size = int(header[:-1].split(b' ')[1])
+    except (ValueError, IndexError):
+        return 'object', "Object has an invalid header"
+    # END handle invalid header
+    if size - len(header) != object_size:
+        return 'object', "Object has %i bytes, expected %i" % (size - len(header), object_size)
+    # END handle size mismatch
+    if sha.digest() != binsha:
+        return 'sha', "Object data doesn't match its sha"
+    # END handle sha mismatch
+    return None
+
+
+def _verify_job(job):
+    """Run a job of ``GitDB.verify()``. Jobs are tuples, either ('loose', fanout directory)
+    or ('pack', pack path, use_crc, part, parts).
+
+    :return: tuple(kind of job, amount of verified objects, list of VerifyError instances)"""
+    kind, path = job[:2]
+    errors = []
+    num_objects = 0
+    try:
+        if kind == 'loose':
+            prefix = os.path.basename(path)
+            for name in sorted(os.listdir(path)):
+                if len(name) != 38:
+                    continue
+                # END skip non-objects
+                obj_path = os.path.join(path, name)
+                binsha = hex_to_bin(prefix + name)
+                num_objects += 1
+                problem = _verify_loose_object(obj_path, binsha)
+                if problem is not None:
+                    errors.append(VerifyError(obj_path, binsha, *problem))
+                # END handle problem
+            # END for each object
+        else:
+            use_crc, part, parts = job[2:]
+            with smmap.managed_mmaps() as mman:
+                with PackEntity(mman, path) as entity:
+                    if part == 0:
+                        num_objects = entity.index().size()
+                    # END count objects once
+                    for binsha, problem_kind, message in entity.verify(use_crc, part, parts):
+                        errors.append(VerifyError(path, binsha, problem_kind, message))
+                    # END for each problem
+                # END with entity
+            # END with mman
+        # END handle job kind
+    except Exception as exc:
+        errors.append(VerifyError(path, None, 'object', "Verification failed: %s" % exc))
+    # END handle unreadable files
+    return kind, num_objects, errors
+
+
+#} END verification
 
+#{ Copying
 
-__all__ = ('GitDB',)
+def _missing_objects(db, shas):
+    """:return: list of those of the given binary shas db doesn't contain. Loose databases
+        are queried with one listing per fanout directory, instead of one stat per object"""
+    databases = []
+    _databases_recursive(db, databases)
+    missing = shas
+    for sub_db in databases:
+        if not missing:
+            break
+        # END handle all found
+        if isinstance(sub_db, LooseObjectDB):
+            hexshas = [force_text(bin_to_hex(sha)) for sha in missing]
+            listings = dict()
+            for prefix in set(hexsha[:2] for hexsha in hexshas):
+                try:
+                    listings[prefix] = set(os.listdir(sub_db.db_path(prefix)))
+                except OSError:
+                    listings[prefix] = frozenset()
+                # END handle missing fanout directory
+            # END for each fanout directory
+            missing = [sha for sha, hexsha in zip(missing, hexshas) if hexsha[2:] not in listings[hexsha[:2]]]
+        else:
+            missing = [sha for sha in missing if not sub_db.has_object(sha)]
+        # END handle database type
+    # END for each database
+    return missing
+
+
+def copy_objects(src_db, dst_db, shas, batch_size=1000):
+    """Copy the objects with the given shas from one database into another, in the cheapest
+    way available. Compound databases like GitDB are handled through the databases they
+    consist of.
+
+    * loose objects are copied into loose databases as they are, compressed
+    * packed objects are copied into packs of the destination, reusing their compressed
+      data and deltas as far as possible. All of them go into one new pack
+    * packed objects are copied into loose databases by decompressing and compressing
+      them once
+    * into any other database, objects are stored as streams
+
+    :param src_db: database containing all objects
+    :param dst_db: database to copy the objects into, which is a LooseObjectDB, PackedDB,
+        GitDB or any other database supporting ``store``
+    :param shas: iterable of binary shas of the objects to copy
+    :param batch_size: amount of shas checked at once for existing in dst_db already,
+        which are skipped
+    :return: amount of objects actually copied
+    :raise BadObject: if an object is not contained in src_db"""
+    src_databases = []
+    _databases_recursive(src_db, src_databases)
+
+    dst_loose = dst_packed = None
+    if isinstance(dst_db, GitDB):
+        dst_loose = dst_db._loose_db
+        for db in dst_db.databases():
+            if isinstance(db, PackedDB):
+                dst_packed = db
+            # END remember pack database
+        # END for each database
+    elif isinstance(dst_db, LooseObjectDB):
+        dst_loose = dst_db
+    elif isinstance(dst_db, PackedDB):
+        dst_packed = dst_db
+    # END handle destination type
+    dst_store = dst_loose or dst_db
+
+    def src_database(sha):
+        for db in src_databases:
+            if db.has_object(sha):
+                return db
+            # END handle hit
+        # END for each database
+        raise BadObject(sha)
+    # END src_database
+
+    def src_reader(db, sha):
+        # packs our caller entered already can't be entered by their database once more
+        if isinstance(db, PackedDB):
+            entity = db._pack_info(sha)[0]
+            if entity._entered:
+                return entity
+            # END handle entered entity
+        # END handle packed object
+        return db
+    # END src_reader
+
+    count = 0
+    pack_objects = []
+    seen = set()
+    shas = iter(shas)
+    while True:
+        batch = []
+        for sha in shas:
+            if sha not in seen:
+                seen.add(sha)
+                batch.append(sha)
+            # END skip duplicates
+            if len(batch) == batch_size:
+                break
+            # END handle full batch
+        # END for each sha
+        if not batch:
+            break
+        # END handle end of shas
+
+        for sha in _missing_objects(dst_db, batch):
+            db = src_database(sha)
+            if dst_packed is not None and (isinstance(db, PackedDB) or dst_loose is None):
+                pack_objects.append((db, src_reader(db, sha).info(sha)))
+            elif isinstance(db, LooseObjectDB) and dst_loose is not None:
+                info = db.info(sha)
+                with open(db.readable_db_object_path(bin_to_hex(sha)), 'rb') as fp:
+                    # the compressed data is copied as is if the sha is given
+                    dst_loose.store(IStream(info.type, info.size, fp, sha))
+                # END with object file
+            else:
+                with src_reader(db, sha).stream(sha) as ostream:
+                    dst_store.store(IStream(ostream.type, ostream.size, ostream.stream))
+                # END with stream
+            # END handle copy strategy
+            count += 1
+        # END for each missing object
+    # END for each batch
+
+    if pack_objects:
+        objects = []
+        sources = []
+        for db, info in pack_objects:
+            if isinstance(db, PackedDB):
+                # packed objects are read through their entered entity, as the database
+                # would enter it once more. It supplies their reused data as well
+                db = db._pack_info(info.binsha)[0]
+                if db not in sources:
+                    sources.append(db)
+                # END remember source pack
+            # END handle packed object
+            objects.append(_LazyOStream(db, info))
+        # END for each object
+        with ExitStack() as stack:
+            for entity in sources:
+                # entities our caller entered already are used as they are
+                if not entity._entered:
+                    stack.enter_context(entity)
+                # END enter entity
+            # END for each source pack
+            PackEntity.create(dst_packed._mman, objects, dst_packed.root_path(), reuse=sources)
+        # END with source packs
+    # END handle pack
+    if count and isinstance(dst_db, CachingDB):
+        # loose objects were stored past the prefix index of compound databases
+        dst_db.update_cache(force=True)
+    # END handle caches
+    return count
+
+#} END copying
 
 
 class GitDB(FileDBBase, ObjectDBW, CompoundDB):
@@ -37,6 +336,9 @@ class GitDB(FileDBBase, ObjectDBW, CompoundDB):
     loose_dir = ''
     alternates_dir = os.path.join('info', 'alternates')
 
+    # packs larger than this are verified in several parts concurrently
+    verify_pack_part_size = 64 * 1024 ** 2
+
     def __init__(self, mman, root_path):
         """Initialize ourselves on a git objects directory
 
@@ -78,7 +380,9 @@ class GitDB(FileDBBase, ObjectDBW, CompoundDB):
     #{ ObjectDBW interface
 
     def store(self, istream):
-        return self._loose_db.store(istream)
+        istream = self._loose_db.store(istream)
+        self._prefix_index_add(istream.binsha)
+        return istream
 
     def ostream(self):
         return self._loose_db.ostream()
@@ -87,3 +391,140 @@ class GitDB(FileDBBase, ObjectDBW, CompoundDB):
         return self._loose_db.set_ostream(ostream)
 
     #} END objectdbw interface
+
+    #{ Interface
+
+    def verify(self, processes=None, use_crc=True, progress=None):
+        """Verify all objects of this database and of its alternates, similar to what
+        ``git fsck`` does for the object store. Packs are verified with ``PackEntity.verify()``,
+        and loose objects are decompressed and hashed. The work is split into jobs, one per
+        fanout directory of loose objects and one per part of each pack, which are run by
+        a process pool.
+
+        :param processes: amount of processes to run jobs with, or None for one per cpu.
+            With 1, all jobs run in this process
+        :param use_crc: if False, crcs of packed objects are not checked
+        :param progress: if not None, function progress(done, total) called whenever a job
+            finished, with the amount of finished jobs and the total amount of jobs
+        :return: VerifyReport listing all problems found"""
+        if processes is None:
+            try:
+                processes = cpu_count()
+            except NotImplementedError:
+                processes = 1
+            # END handle unknown cpu count
+        # END handle default
+
+        databases = []
+        _databases_recursive(self, databases)
+        jobs = []
+        for db in databases:
+            if isinstance(db, PackedDB):
+                for entity in db.entities():
+                    pack_path = entity.pack().path()
+                    parts = max(1, min(processes, os.path.getsize(pack_path) // self.verify_pack_part_size))
+                    jobs.extend(('pack', pack_path, use_crc, part, parts) for part in xrange(parts))
+                # END for each pack
+            elif isinstance(db, LooseObjectDB):
+                root = db.root_path()
+                for name in sorted(os.listdir(root)):
+                    path = os.path.join(root, name)
+                    if len(name) == 2 and os.path.isdir(path):
+                        jobs.append(('loose', path))
+                    # END handle fanout directory
+                # END for each directory
+            # END handle database type
+        # END for each database
+
+        report = VerifyReport()
+        pool = None
+        if processes > 1 and len(jobs) > 1:
+            pool = Pool(min(processes, len(jobs)))
+        # END handle processes
+        try:
+            if pool is None:
+                results = (_verify_job(job) for job in jobs)
+            else:
+                results = pool.imap_unordered(_verify_job, jobs)
+            # END handle pool
+            for done, (kind, num_objects, errors) in enumerate(results, 1):
+                if kind == 'loose':
+                    report.loose_objects += num_objects
+                else:
+                    report.packed_objects += num_objects
+                # END handle job kind
+                report.errors.extend(errors)
+                if progress is not None:
+                    progress(done, len(jobs))
+                # END handle progress
+            # END for each result
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            # END handle pool
+        # END shutdown pool
+        report.packs = len(set(job[1] for job in jobs if job[0] == 'pack'))
+        return report
+
+    def pack_loose_objects(self, threshold=6700, window=0):
+        """Move our loose objects into a new pack once there are too many of them, similar
+        to ``git gc --auto``. Loose objects which are in one of our packs already are not
+        packed again. Loose files are deleted only after the pack providing their object
+        is in use, hence all objects stay accessible through this instance meanwhile.
+
+        :param threshold: amount of loose objects up to which nothing is done, as estimated
+            by ``LooseObjectDB.approximate_size()``. If None, objects are packed regardless
+        :param window: amount of objects to search for delta bases, see ``PackEntity.write_pack``.
+            Without a window, objects are streamed into the pack one by one. Otherwise all of
+            them are held in memory, and the delta search takes a lot of time for many objects
+        :return: PackEntity of the new pack, or None if no pack was written"""
+        loose_db = self._loose_db
+        if threshold is not None and loose_db.approximate_size() <= threshold:
+            return None
+        # END handle few loose objects
+
+        pack_dir = self.db_path(self.packs_dir)
+        if not os.path.isdir(pack_dir):
+            os.makedirs(pack_dir)
+            # databases are obtained anew to include the one of the new directory
+            del self._dbs
+            del self._loose_db
+            self._db_cache.clear()
+            loose_db = self._loose_db
+        # END handle missing pack directory
+        packed_db = [db for db in self._dbs if isinstance(db, PackedDB)][0]
+        packed_db.update_cache()
+
+        unpacked_shas = (sha for sha in loose_db.sha_iter() if not packed_db.has_object(sha))
+        first_sha = next(unpacked_shas, None)
+        entity = None
+        if first_sha is not None:
+            objects = (_LazyOStream(loose_db, loose_db.info(sha)) for sha in chain((first_sha,), unpacked_shas))
+            entity = PackEntity.create(self._mman, objects, pack_dir, window=window)
+            self.update_cache(force=True)
+        # END handle unpacked objects
+
+        prefixes = set()
+        for sha in loose_db.sha_iter():
+            if not packed_db.has_object(sha):
+                continue
+            # END never delete the only copy of an object
+            hexsha = force_text(bin_to_hex(sha))
+            os.remove(loose_db.db_path(loose_db.object_path(hexsha)))
+            prefixes.add(hexsha[:2])
+        # END for each loose object
+        for name in prefixes:
+            try:
+                os.rmdir(loose_db.db_path(name))
+            except OSError:
+                pass
+            # END ignore directories which are not empty
+        # END for each fanout directory
+
+        # forget where the deleted objects were
+        loose_db._hexsha_to_file.clear()
+        self._db_cache.clear()
+        return entity
+
+    #} END interface
@@ -52,7 +52,7 @@ from gitdb.fun import (
 )
 
 from gitdb.utils.compat import MAXSIZE
-from gitdb.utils.encoding import force_bytes
+from gitdb.utils.encoding import force_text
 
 import tempfile
 import os
@@ -75,6 +75,9 @@ class LooseObjectDB(FileDBBase, ObjectDBR, ObjectDBW):
     if is_win:
         new_objects_mode = int("644", 8)
 
+    # fanout directory whose objects are counted to estimate our size, like git does
+    size_sample_dir = '17'
+
     def __init__(self, root_path):
         super(LooseObjectDB, self).__init__(root_path)
         self._hexsha_to_file = dict()
@@ -113,18 +116,49 @@ class LooseObjectDB(FileDBBase, ObjectDBR, ObjectDBW):
         :param name: hexadecimal partial name (bytes or ascii string)
         :raise AmbiguousObjectName:
         :raise BadObject: """
+        partial_hexsha = force_text(partial_hexsha)
+        # only the fanout directory of the prefix is listed, unless it is too short to name one
+        if len(partial_hexsha) >= 2:
+            prefixes = [partial_hexsha[:2]]
+        else:
+            try:
+                prefixes = [name for name in os.listdir(self.root_path())
+                            if len(name) == 2 and name.startswith(partial_hexsha)]
+            except OSError:
+                prefixes = []
+            # END handle missing database
+        # END handle prefix length
         candidate = None
-        for binsha in self.sha_iter():
-            if bin_to_hex(binsha).startswith(force_bytes(partial_hexsha)):
-                # it can't ever find the same object twice
-                if candidate is not None:
-                    raise AmbiguousObjectName(partial_hexsha)
-                candidate = binsha
-        # END for each object
+        for prefix in prefixes:
+            try:
+                names = os.listdir(self.db_path(prefix))
+            except OSError:
+                continue
+            # END handle vanished directory
+            for name in names:
+                if len(name) == 38 and (prefix + name).startswith(partial_hexsha):
+                    # it can't ever find the same object twice
+                    if candidate is not None:
+                        raise AmbiguousObjectName(partial_hexsha)
+                    candidate = hex_to_bin(prefix + name)
+                # END handle match
+            # END for each object
+        # END for each fanout directory
         if candidate is None:
             raise BadObject(partial_hexsha)
         return candidate
 
+    def approximate_size(self):
+        """:return: estimated amount of objects in this database. As shas are spread evenly,
+            only the objects of one fanout directory are counted, which is much cheaper
+            than ``size()`` for large databases"""
+        try:
+            names = os.listdir(self.db_path(self.size_sample_dir))
+        except OSError:
+            return 0
+        # END handle missing directory
+        return sum(1 for name in names if len(name) == 38) * 256
+
     #} END interface
 
     def _map_loose_object(self, sha):
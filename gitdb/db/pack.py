@@ -6,19 +6,34 @@
 from gitdb.db.base import (
     FileDBBase,
     ObjectDBR,
-    CachingDB
+    CachingDB,
+    _LazyOStream
 )
 
-from gitdb.util import LazyMixin
+from gitdb.util import (
+    LazyMixin,
+    LockedFD,
+)
 
 from gitdb.exc import (
     BadObject,
+    ParseError,
     UnsupportedOperation,
     AmbiguousObjectName
 )
 
-from gitdb.pack import PackEntity
-from gitdb.utils.compat import xrange
+from gitdb.pack import (
+    PackEntity,
+    PackBloomFilter,
+    MultiPackIndexFile,
+    MultiPackIndexWriter,
+)
+from gitdb.base import OInfo
+from gitdb.stream import DeltaBaseCache
+from gitdb.utils.compat import (
+    xrange,
+    ExitStack
+)
 
 import os
 import glob
@@ -37,16 +52,39 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
     # any effect, but it should have one
     _sort_interval = 500
 
+    # name of git's multi-pack-index file within our root path
+    multi_pack_index_name = 'multi-pack-index'
+
+    # bits per object of the bloom filters used to skip packs which can't contain
+    # a requested sha. 10 bits yield about 1% of false positives, 0 disables filters
+    bloom_filter_bits = 0
+
+    # if True, bloom filters are kept next to their pack as pack-<sha>.bloom to
+    # safe building them again
+    bloom_filter_persist = False
+
+    # bytes of resolved objects kept to serve as delta bases, shared by all our
+    # packs. 0 disables the cache. Must be set before our packs are loaded
+    delta_base_cache_size = 0
+
     def __init__(self, mman, root_path):
         super(PackedDB, self).__init__(root_path)
-        # list of lists with three items:
+        # list of lists with four items:
         # * hits - number of times the pack was hit with a request
         # * entity - Pack entity instance
         # * sha_to_index - PackIndexFile.sha_to_index method for direct cache query
+        # * bloom - PackBloomFilter of the pack, or None if it wasn't built yet
         # self._entities = []       # lazy loaded list
         self._mman = mman
         self._hit_count = 0             # amount of hits
         self._st_mtime = 0              # last modification data of our root path
+        self._midx = None               # MultiPackIndexFile covering some of our packs, if any
+        self._midx_entities = ()        # entity by pack-int-id of the multi-pack-index
+        self._midx_covered = frozenset()  # set of entities covered by the multi-pack-index
+        self._bloom_skips = 0           # packs skipped as their bloom filter ruled out the sha
+        self._bloom_passes = 0          # packs searched as their bloom filter allowed the sha
+        self._bloom_false_positives = 0  # passed packs which didn't contain the sha
+        self._delta_base_cache = None   # DeltaBaseCache shared by our entities, if any
 
     def _set_cache_(self, attr):
         if attr == '_entities':
@@ -58,27 +96,64 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
         self._entities.sort(key=lambda l: l[0], reverse=True)
 
     def _pack_info(self, sha):
-        """:return: tuple(entity, index) for an item at the given sha
+        """:return: tuple(entity, offset) for an item at the given sha
         :param sha: 20 or 40 byte sha
         :raise BadObject:
         **Note:** This method is not thread-safe, but may be hit in multi-threaded
             operation. The worst thing that can happen though is a counter that
             was not incremented, or the list being in wrong order. So we safe
             the time for locking here, lets see how that goes"""
+        entities = self._entities
+
+        # a multi-pack-index resolves all packs it covers with a single bisection
+        if self._midx is not None:
+            with self._midx as midx:
+                mindex = midx.sha_to_index(sha)
+                if mindex is not None:
+                    pack_int_id, offset = midx.pack_offset(mindex)
+                    self._hit_count += 1
+                    return (self._midx_entities[pack_int_id], offset)
+                # END handle hit
+            # END with midx
+        # END handle multi-pack-index
+
         # presort ?
         if self._hit_count % self._sort_interval == 0:
             self._sort_entities()
         # END update sorting
 
-        for item in self._entities:
+        midx_covered = self._midx_covered
+        use_bloom = self.bloom_filter_bits > 0 and len(sha) == 20
+        for item in entities:
             ent = item[1]
+            if ent in midx_covered:
+                continue
+            # END skip packs we already checked
+            bloom = None
+            if use_bloom:
+                bloom = item[3]
+                if bloom is None:
+                    bloom = item[3] = self._bloom_filter(ent)
+                # END build filter lazily
+                if sha not in bloom:
+                    self._bloom_skips += 1
+                    continue
+                # END skip pack
+                self._bloom_passes += 1
+            # END handle bloom filter
+            offset = None
             with ent.index() as index:
-                index = index.sha_to_index(sha)
-            if index is not None:
+                sindex = index.sha_to_index(sha)
+                if sindex is not None:
+                    offset = index.offset(sindex)
+            if offset is not None:
                 item[0] += 1            # one hit for you
                 self._hit_count += 1    # general hit count
-                return (item[1], index)
+                return (ent, offset)
             # END index found in pack
+            if bloom is not None:
+                self._bloom_false_positives += 1
+            # END count false positive
         # END for each item
 
         # no hit, see whether we have to update packs
@@ -97,14 +172,14 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
         # END exception handling
 
     def info(self, sha):
-        entity, index = self._pack_info(sha)
+        entity, offset = self._pack_info(sha)
         with entity:
-            return entity.info_at_index(index)
+            return entity.info_at_offset(sha, offset)
 
     def stream(self, sha):
-        entity, index = self._pack_info(sha)
+        entity, offset = self._pack_info(sha)
         with entity:
-            return entity.stream_at_index(index)
+            return entity.stream_at_offset(sha, offset)
 
     def sha_iter(self):
         for entity in self.entities():
@@ -158,8 +233,8 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
         for pack_file in (pack_files - our_pack_files):
             # init the hit-counter/priority with the size, a good measure for hit-
             # probability. Its implemented so that only 12 bytes will be read
-            with PackEntity(self._mman, pack_file) as entity:
-                self._entities.append([entity.pack().size(), entity, entity.index().sha_to_index])
+            with PackEntity(self._mman, pack_file, self.delta_base_cache()) as entity:
+                self._entities.append([entity.pack().size(), entity, entity.index().sha_to_index, None])
         # END for each new packfile
 
         # removed packs
@@ -177,12 +252,194 @@ class PackedDB(FileDBBase, ObjectDBR, CachingDB, LazyMixin):
 
         # reinitialize prioritiess
         self._sort_entities()
+        self._update_multi_pack_index()
         return True
 
+    def _update_multi_pack_index(self):
+        """(Re)load the multi-pack-index, if there is one. It is ignored if it refers
+        to packs we don't have, as it is stale then, or if it can't be read"""
+        self._midx = None
+        self._midx_entities = ()
+        self._midx_covered = frozenset()
+        midx_path = os.path.join(self.root_path(), self.multi_pack_index_name)
+        if not os.path.isfile(midx_path):
+            return
+        # END handle missing file
+
+        entities_by_name = dict((os.path.splitext(os.path.basename(item[1].index().path()))[0], item[1])
+                                for item in self._entities)
+        midx = MultiPackIndexFile(self._mman, midx_path)
+        try:
+            with midx:
+                names = [os.path.splitext(name)[0] for name in midx.pack_names()]
+            # END read pack names
+        except (IOError, OSError, ParseError):
+            # like git, we use our packs one by one if we can't use the file
+            return
+        # END handle unusable file
+        if not all(name in entities_by_name for name in names):
+            return
+        # END handle stale file
+        self._midx = midx
+        self._midx_entities = tuple(entities_by_name[name] for name in names)
+        self._midx_covered = frozenset(self._midx_entities)
+
+    def _bloom_filter(self, entity):
+        """:return: PackBloomFilter for the given entity, read from its sidecar file if
+        it is valid, or built from its index otherwise"""
+        bloom_path = "%s.bloom" % os.path.splitext(entity.pack().path())[0]
+        with entity.index() as index:
+            pack_sha = index.packfile_checksum()
+            num_bits = PackBloomFilter.new(index.size(), self.bloom_filter_bits).num_bits()
+            if self.bloom_filter_persist and os.path.isfile(bloom_path):
+                try:
+                    with open(bloom_path, 'rb') as fp:
+                        bloom = PackBloomFilter.from_data(fp.read(), pack_sha)
+                    if bloom.num_bits() == num_bits:
+                        return bloom
+                    # END handle matching configuration
+                except (IOError, OSError, ParseError):
+                    pass
+                # END ignore unusable files, we just rebuild them
+            # END try sidecar file
+
+            bloom = PackBloomFilter.from_index(index, self.bloom_filter_bits)
+        # END with index
+
+        if self.bloom_filter_persist:
+            lfd = LockedFD(bloom_path)
+            try:
+                fd = lfd.open(write=True)
+                try:
+                    bloom.write(pack_sha, lambda d: os.write(fd, d))
+                except:
+                    lfd.rollback()
+                    raise
+                # END handle write failure
+                lfd.commit()
+            except (IOError, OSError):
+                pass
+            # END persisting is optional, as our directory might be read-only
+        # END handle persistence
+        return bloom
+
+    def delta_base_cache(self):
+        """:return: DeltaBaseCache shared by all our packs, or None if
+            ``delta_base_cache_size`` is 0"""
+        if self._delta_base_cache is None and self.delta_base_cache_size > 0:
+            self._delta_base_cache = DeltaBaseCache(self.delta_base_cache_size)
+        # END create cache on demand
+        return self._delta_base_cache
+
+    def bloom_filter_stats(self):
+        """:return: tuple(skips, passes, false_positives) of the bloom filters, counting
+            packs which were skipped as they can't contain a requested sha, packs which
+            had to be searched, and searched packs which didn't contain the sha.
+            See ``bloom_filter_bits`` to tune the false positive rate"""
+        return (self._bloom_skips, self._bloom_passes, self._bloom_false_positives)
+
     def entities(self):
         """:return: list of pack entities operated upon by this database"""
         return [item[1] for item in self._entities]
 
+    def multi_pack_index(self):
+        """:return: MultiPackIndexFile used to lookup objects, or None if there is none"""
+        return self._midx
+
+    def write_multi_pack_index(self):
+        """Write a multi-pack-index covering all our packs and start using it.
+        Objects contained in multiple packs are taken from the most recently modified one.
+
+        :return: path to the written multi-pack-index file"""
+        entities = sorted(self.entities(), key=lambda e: os.path.getmtime(e.pack().path()), reverse=True)
+        writer = MultiPackIndexWriter()
+        for entity in entities:
+            with entity.index() as index:
+                writer.append(index)
+        # END for each entity
+
+        midx_path = os.path.join(self.root_path(), self.multi_pack_index_name)
+        lfd = LockedFD(midx_path)
+        fd = lfd.open(write=True)
+        try:
+            writer.write(lambda d: os.write(fd, d))
+        except:
+            lfd.rollback()
+            raise
+        # END handle write failure
+        lfd.commit()
+
+        self.update_cache(force=True)
+        return midx_path
+
+    def consolidate(self, max_packs=50, min_size=64 * 1024 ** 2):
+        """Merge our small packs into a single new one once we have too many packs, similar
+        to ``git gc --auto``. The compressed data and deltas of the objects are reused.
+        The new pack is in use before the merged ones are deleted, hence all objects stay
+        accessible through this instance meanwhile. A multi-pack-index is removed, as it
+        would refer to the merged packs.
+
+        **Note:** Other threads reading merged packs through entities they obtained before
+        will fail once their files are gone, hence don't consolidate while others read.
+        Files which can't be removed, like mapped ones on windows, are kept, and their pack
+        is merged once more by the next consolidation.
+
+        :param max_packs: amount of packs we may have without consolidating them
+        :param min_size: size in bytes from which on packs are kept as they are
+        :return: PackEntity of the new pack, or None if there was nothing to consolidate"""
+        self.update_cache()
+        if len(self._entities) <= max_packs:
+            return None
+        # END handle few packs
+        merged = [entity for entity in self.entities() if os.path.getsize(entity.pack().path()) < min_size]
+        if len(merged) < 2:
+            return None
+        # END handle nothing to merge
+
+        with ExitStack() as stack:
+            objects = []
+            seen = set()
+            for entity in merged:
+                stack.enter_context(entity)
+                for info in entity.info_iter(by_offset=True):
+                    binsha = bytes(info.binsha)
+                    if binsha not in seen:
+                        seen.add(binsha)
+                        objects.append(_LazyOStream(entity, OInfo(binsha, info.type, info.size)))
+                    # END skip duplicates
+                # END for each object
+            # END for each pack
+            new_entity = PackEntity.create(self._mman, objects, self.root_path(), reuse=merged)
+        # END with merged packs
+
+        midx_path = os.path.join(self.root_path(), self.multi_pack_index_name)
+        if os.path.isfile(midx_path):
+            os.remove(midx_path)
+        # END handle multi-pack-index
+        self.update_cache(force=True)
+        # the new pack may be identical to one of the merged ones, like one with all objects
+        new_pack_path = new_entity.pack().path()
+        merged = set(entity for entity in merged if entity.pack().path() != new_pack_path)
+        self._entities = [item for item in self._entities if item[1] not in merged]
+        for entity in merged:
+            # without its pack, an index is never looked at, hence it goes first
+            basename = os.path.splitext(entity.pack().path())[0]
+            for ext in ('.pack', '.idx', '.rev', '.bloom'):
+                path = basename + ext
+                if not os.path.isfile(path):
+                    continue
+                # END handle missing file
+                self._mman.force_map_handle_removal_win(path)
+                try:
+                    os.remove(path)
+                except OSError:
+                    break
+                # END leave the pack to the next consolidation
+            # END for each file of the pack
+        # END for each merged pack
+        self._st_mtime = os.stat(self.root_path()).st_mtime
+        return new_entity
+
     def partial_to_complete_sha(self, partial_binsha, canonical_length):
         """:return: 20 byte sha as inferred by the given partial binary sha
         :param partial_binsha: binary sha with less than 20 bytes
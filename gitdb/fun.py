@@ -14,7 +14,8 @@ import mmap
 from itertools import islice
 
 from gitdb.const import NULL_BYTE, BYTE_SPACE
-from gitdb.utils.encoding import force_text
+from gitdb.exc import ParseError
+from gitdb.utils.encoding import force_bytes, force_text
 from gitdb.utils.compat import izip, buffer, xrange, PY3
 from gitdb.typ import (
     str_blob_type,
@@ -54,8 +55,18 @@ type_to_type_id_map = {
 chunk_size = 1000 * mmap.PAGESIZE
 
 __all__ = ('is_loose_object', 'loose_object_header_info', 'msb_size', 'pack_object_header_info',
-           'write_object', 'loose_object_header', 'stream_copy', 'apply_delta_data',
-           'is_equal_canonical_sha', 'connect_deltas', 'DeltaChunkList', 'create_pack_object_header')
+           'write_object', 'loose_object_header', 'stream_copy', 'apply_delta_data', 'apply_delta',
+           'is_equal_canonical_sha', 'connect_deltas', 'DeltaChunkList', 'create_pack_object_header',
+           'create_ofs_delta_offset', 'create_delta_index', 'create_delta', 'pack_name_hash')
+
+# size of the blocks of base objects we search for in objects to deltify
+delta_block_size = 16
+
+# maximum amount of offsets of a block of the base we try to extend a match from
+delta_max_block_offsets = 16
+
+# maximum amount of bytes copied from the base with a single delta instruction
+delta_max_copy_size = 0x10000
 
 
 #{ Structures
@@ -754,6 +765,189 @@ def apply_delta_data(src_buf, src_buf_size, delta_buf, delta_buf_size, write):
     assert i == delta_buf_size, "delta replay has gone wild"
 
 
+def apply_delta(base, delta):
+    """:return: object data resulting from applying the decompressed delta data
+        to the given base object data
+    :raise ParseError: if the sizes recorded in the delta don't match"""
+    i, src_size = msb_size(delta)
+    i, target_size = msb_size(delta, i)
+    if src_size != len(base):
+        raise ParseError("Delta expected a base of %i bytes, got %i" % (src_size, len(base)))
+    # END handle base size
+    out = []
+    apply_delta_data(base, src_size, buffer(delta, i), len(delta) - i, out.append)
+    data = b''.join(out)
+    if len(data) != target_size:
+        raise ParseError("Delta produced %i bytes, expected %i" % (len(data), target_size))
+    # END handle target size
+    return data
+
+
+def _create_msb_size(size):
+    """:return: bytearray with the size in the encoding read by ``msb_size``"""
+    out = bytearray()
+    c = size & 0x7f
+    size >>= 7
+    while size:
+        out.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    # END until size is consumed
+    out.append(c)
+    return out
+
+
+def create_ofs_delta_offset(offset):
+    """
+    :return: bytearray encoding the distance of an OFS_DELTA to its base object, as
+        stored right after its pack object header
+    :param offset: positive distance from the delta's offset back to its base"""
+    out = bytearray()
+    out.append(offset & 0x7f)
+    offset >>= 7
+    while offset:
+        offset -= 1
+        out.insert(0, 0x80 | (offset & 0x7f))
+        offset >>= 7
+    # END until offset is consumed
+    return out
+
+
+def create_delta_index(base):
+    """:return: index of the given base data for use with ``create_delta``, mapping
+        each of its blocks of ``delta_block_size`` bytes to the list of offsets it
+        occurs at, ``delta_max_block_offsets`` at most"""
+    bs = delta_block_size
+    index = dict()
+    for i in xrange(0, len(base) - bs + 1, bs):
+        offsets = index.setdefault(base[i:i + bs], [])
+        if len(offsets) < delta_max_block_offsets:
+            offsets.append(i)
+        # END limit offsets per block
+    # END for each block
+    return index
+
+
+def create_delta(base, target, index=None, max_size=0):
+    """
+    :return: delta data turning base into target, as read by ``apply_delta``, or None
+        if the delta would be larger than max_size
+    :param index: index of base as created by ``create_delta_index``, if you want to
+        reuse it for multiple targets
+    :param max_size: if not 0, the amount of bytes the delta may take at most
+
+    **Note:** blocks of the target are looked up in the base, and matches are extended
+        in both directions. Unmatched bytes are inserted literally"""
+    if index is None:
+        index = create_delta_index(base)
+    # END handle index
+    bs = delta_block_size
+    blen = len(base)
+    tlen = len(target)
+    out = _create_msb_size(blen)
+    out += _create_msb_size(tlen)
+
+    def insert(start, end):
+        while start < end:
+            size = min(end - start, 0x7f)
+            out.append(size)
+            out.extend(target[start:start + size])
+            start += size
+        # END for each insert instruction
+    # END insert
+
+    def match_size(bofs):
+        # extend the match forward, in large steps first
+        size = bs
+        while i + size + 256 <= tlen and bofs + size + 256 <= blen and \
+                target[i + size:i + size + 256] == base[bofs + size:bofs + size + 256]:
+            size += 256
+        # END while blocks match
+        while i + size < tlen and bofs + size < blen and target[i + size] == base[bofs + size]:
+            size += 1
+        # END while bytes match
+        return size
+    # END match_size
+
+    i = 0               # current offset into the target
+    insert_start = 0    # first byte of target not yet written into the delta
+    while i + bs <= tlen:
+        offsets = index.get(target[i:i + bs])
+        if offsets is None:
+            i += 1
+            continue
+        # END handle miss
+
+        # use the longest match
+        size = 0
+        for candidate in offsets:
+            candidate_size = match_size(candidate)
+            if candidate_size > size:
+                size = candidate_size
+                bofs = candidate
+            # END handle longer match
+        # END for each candidate
+        # and extend it backward into bytes we would insert otherwise
+        while i > insert_start and bofs and target[i - 1] == base[bofs - 1]:
+            i -= 1
+            bofs -= 1
+            size += 1
+        # END while bytes match
+
+        insert(insert_start, i)
+        i += size
+        insert_start = i
+        while size:
+            copy_size = min(size, delta_max_copy_size)
+            cmd = 0x80
+            args = bytearray()
+            for shift, flag in ((0, 0x01), (8, 0x02), (16, 0x04), (24, 0x08)):
+                byte = (bofs >> shift) & 0xff
+                if byte:
+                    cmd |= flag
+                    args.append(byte)
+                # END handle non-zero byte
+            # END for each offset byte
+            # the maximum size is implied by leaving out all of its bytes
+            for shift, flag in ((0, 0x10), (8, 0x20), (16, 0x40)):
+                byte = (copy_size >> shift) & 0xff
+                if byte and copy_size != delta_max_copy_size:
+                    cmd |= flag
+                    args.append(byte)
+                # END handle non-zero byte
+            # END for each size byte
+            out.append(cmd)
+            out += args
+            bofs += copy_size
+            size -= copy_size
+        # END for each copy instruction
+
+        if max_size and len(out) > max_size:
+            return None
+        # END abort early
+    # END for each target position
+    insert(insert_start, tlen)
+
+    if max_size and len(out) > max_size:
+        return None
+    # END handle size limit
+    return bytes(out)
+
+
+def pack_name_hash(name):
+    """:return: 32 bit hash of the given path name, as used by git to sort objects of
+        similar names next to each other when searching for deltas. The last
+        characters of the name matter most"""
+    h = 0
+    for c in bytearray(force_bytes(name)):
+        if c in (0x20, 0x09, 0x0a, 0x0b, 0x0c, 0x0d):
+            continue
+        # END skip whitespace
+        h = ((h >> 2) + (c << 24)) & 0xffffffff
+    # END for each character
+    return h
+
+
 def is_equal_canonical_sha(canonical_length, match, sha1):
     """
     :return: True if the given lhs and rhs 20 byte binary shas
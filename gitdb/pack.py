@@ -5,10 +5,18 @@
 """Contains PackIndexFile and PackFile implementations"""
 import array
 from binascii import crc32
+from io import BytesIO
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import islice, repeat
+import mmap
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import os
-from struct import pack
+from struct import pack, unpack
 import sys
 import tempfile
+import threading
 import zlib
 
 from gitdb.base import (
@@ -29,16 +37,21 @@ from gitdb.exc import (
 )
 from gitdb.fun import (
     create_pack_object_header,
+    create_ofs_delta_offset,
+    create_delta_index,
+    create_delta,
+    pack_name_hash,
     pack_object_header_info,
     is_equal_canonical_sha,
     type_id_to_type_map,
     write_object,
-    stream_copy,
     chunk_size,
     delta_types,
     OFS_DELTA,
     REF_DELTA,
-    msb_size
+    msb_size,
+    apply_delta,
+    loose_object_header,
 )
 from gitdb.stream import (
     DecompressMemMapReader,
@@ -49,15 +62,25 @@ from gitdb.stream import (
 )
 from gitdb.util import (
     LazyMixin,
+    LockedFD,
     bin_to_hex,
     byte_ord,
+    make_sha,
+)
+from gitdb.utils.encoding import (
+    force_bytes,
+    force_text,
 )
 from gitdb.utils.compat import (
     izip,
     buffer,
+    Queue,
     xrange,
     to_bytes,
     unpack_from,
+    array_frombytes,
+    array_tobytes,
+    bit_length,
 )
 
 
@@ -68,7 +91,16 @@ except ImportError:
 # END try c module
 
 
-__all__ = ('PackIndexFile', 'PackFile', 'PackEntity')
+__all__ = ('PackIndexFile', 'MultiPackIndexFile', 'PackReverseIndexFile', 'PackBloomFilter',
+           'PackObjectRecords', 'PackFile', 'PackEntity')
+
+# typecode of arrays holding 64 bit unsigned integers, 'Q' is new in python 3.3
+try:
+    array.array('Q')
+    uint64_typecode = 'Q'
+except ValueError:
+    uint64_typecode = 'L'
+# END handle python version
 
 
 #{ Utilities
@@ -127,6 +159,86 @@ def pack_object_at(cursor, offset, as_stream):
     # END handle stream
 
 
+def delta_target_size_at(cursor, data_offset):
+    """
+    :return: size of the object the delta whose compressed data starts at the given
+        offset produces, decompressing only as much of the delta as its header takes"""
+    zstream = zlib.decompressobj()
+    buf = b''
+    # the header consists of the base and target sizes, 10 bytes each at most
+    while len(buf) < 20:
+        chunk = cursor.use_region(data_offset, 64).buffer()[:64]
+        if not chunk:
+            break
+        # END handle end of pack
+        data_offset += len(chunk)
+        buf += zstream.decompress(zstream.unconsumed_tail + chunk, 20 - len(buf))
+        if zstream.unused_data:
+            break
+        # END handle end of delta
+    # END while header is incomplete
+    offset, src_size = msb_size(buf)  # @UnusedVariable
+    offset, target_size = msb_size(buf, offset)
+    return target_size
+
+
+def madvise_sequential(region_map):
+    """Hint the kernel that the given memory map will be read sequentially, so it can
+    read ahead aggressively and drop pages behind us.
+
+    :return: True if the hint was given, False if the platform doesn't support it"""
+    advise = getattr(region_map, 'madvise', None)
+    flag = getattr(mmap, 'MADV_SEQUENTIAL', None)
+    if advise is None or flag is None:
+        return False
+    # END handle unsupported platform
+    advise(flag)
+    return True
+
+
+def uint32_array(data):
+    """:return: array of unsigned 32 bit integers read from the given big-endian
+        (network byte order) data, as stored in index files"""
+    a = array.array('I')    # 4 byte unsigned int, long are 8 byte on 64 bit it appears
+    array_frombytes(a, data)
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return a
+
+
+def uint32_bytes(values):
+    """:return: the given unsigned 32 bit integers as big-endian (network byte order)
+        bytes, as stored in index files"""
+    a = array.array('I', values)
+    if sys.byteorder == 'little':
+        a.byteswap()
+    return array_tobytes(a)
+
+
+def write_reverse_index(offsets, pack_sha, write):
+    """Write a reverse index in git's .rev format, listing the index positions of all
+    objects in the order of their offsets into the pack
+
+    :param offsets: sequence of pack offsets of all objects, in index order
+    :param pack_sha: binary sha over the whole pack that we index
+    :param write: function to receive the bytes to write
+    :return: binary sha over all contents of the reverse index"""
+    positions = array.array('I', sorted(xrange(len(offsets)), key=offsets.__getitem__))
+    if sys.byteorder == 'little':
+        positions.byteswap()
+    # END convert to network byte order
+
+    sha_writer = FlexibleSha1Writer(write)
+    sha_write = sha_writer.write
+    sha_write(pack('>4sLL', PackReverseIndexFile.rev_signature, PackReverseIndexFile.rev_version_default, 1))
+    sha_write(array_tobytes(positions))
+    assert len(pack_sha) == 20
+    sha_write(pack_sha)
+    sha = sha_writer.sha(as_hex=False)
+    write(sha)
+    return sha
+
+
 def write_stream_to_pack(read, write, zstream, base_crc=None):
     """Copy a stream as read from read function, zip it, and write the result.
     Count the number of written bytes and return it
@@ -167,71 +279,604 @@ def write_stream_to_pack(read, write, zstream, base_crc=None):
     return (br, bw, crc)
 
 
+def deltify_objects(objects, window, depth, name_hints=None, thin_bases=()):
+    """Search deltas among the given objects, similar to ``git pack-objects``. Objects are
+    sorted by type, name and size, and each one is tried as delta against the objects
+    preceding it within the window, whose delta chains are shorter than depth.
+
+    :param objects: list of OStream instances, which will be read completely
+    :param window: amount of preceding objects to try as base
+    :param depth: maximum length of the resulting delta chains
+    :param name_hints: if not None, dict(binsha: path) of the objects, which sorts objects
+        of the same path close to each other
+    :param thin_bases: list of OStream instances which may serve as bases, but are no
+        objects to deltify themselves, as used for thin packs
+    :return: list with a tuple(binsha, type_id, data, base_position, delta) for each
+        object in the order of objects. base_position is the position of the
+        delta's base object in the list, or -1 if the object is no delta, in which
+        case delta is None. Positions past the end of the list refer to thin_bases,
+        with the length of objects subtracted"""
+    num_targets = len(objects)
+    objects = list(objects) + list(thin_bases)
+    datas = [obj.stream.read() for obj in objects]
+    num_objects = len(objects)
+    bases = [-1] * num_objects
+    deltas = [None] * num_objects
+    depths = [0] * num_objects
+
+    name_hashes = [0] * num_objects
+    if name_hints:
+        for pos, obj in enumerate(objects):
+            name = name_hints.get(obj.binsha)
+            if name is not None:
+                name_hashes[pos] = pack_name_hash(name)
+            # END handle name
+        # END for each object
+    # END handle name hints
+    # thin bases precede similar objects, as only preceding objects serve as bases
+    order = sorted(xrange(num_objects), key=lambda pos: (objects[pos].type_id, name_hashes[pos], -len(datas[pos]),
+                                                         pos < num_targets))
+
+    candidates = []     # list of tuple(position, delta index) of possible bases
+    for pos in order:
+        type_id = objects[pos].type_id
+        if candidates and objects[candidates[0][0]].type_id != type_id:
+            del candidates[:]
+        # END only objects of the same type are similar
+
+        target = datas[pos]
+        # like git, deltas must be smaller than half of the object at least
+        max_size = len(target) // 2 - 20
+        if pos >= num_targets:
+            max_size = 0
+        # END thin bases are no targets
+        for base_pos, index in reversed(candidates):
+            base = datas[base_pos]
+            if depths[base_pos] >= depth or max_size <= 0:
+                continue
+            # END skip chains which are too long
+            if len(base) < len(target) and len(target) - len(base) >= max_size:
+                continue
+            # END skip bases which are much smaller than the target
+            delta = create_delta(base, target, index, max_size)
+            if delta is not None:
+                bases[pos] = base_pos
+                deltas[pos] = delta
+                depths[pos] = depths[base_pos] + 1
+                max_size = len(delta) - 1
+            # END handle better delta
+        # END for each candidate
+
+        candidates.append((pos, create_delta_index(target)))
+        if len(candidates) > window:
+            del candidates[0]
+        # END slide window
+    # END for each object
+
+    return [(obj.binsha, obj.type_id, data, base_pos, delta)
+            for obj, data, base_pos, delta in islice(izip(objects, datas, bases, deltas), num_targets)]
+
+
+def find_reusable_objects(objects, entities):
+    """Find objects whose compressed data can be copied from the given packs as is.
+    These are non-deltas, and deltas whose base object is among the objects as well.
+
+    :param objects: list of objects with a binsha attribute
+    :param entities: sequence of entered PackEntity instances to search the objects in
+    :return: list with a tuple(entity, offset, index, base_position) for each object,
+        or None if its data can't be reused. base_position is the position of the delta's
+        base object in objects, or -1 for non-deltas"""
+    positions = dict((obj.binsha, pos) for pos, obj in enumerate(objects))
+    sources = [None] * len(objects)
+    for pos, obj in enumerate(objects):
+        for entity in entities:
+            pack_index = entity.index()
+            index = pack_index.sha_to_index(obj.binsha)
+            if index is None:
+                continue
+            # END handle missing object
+
+            offset = pack_index.offset(index)
+            info = pack_object_at(entity.pack()._cursor, offset, False)[1]
+            base_pos = -1
+            if info.type_id == OFS_DELTA:
+                base_index = entity.offset_to_index(offset - info.delta_info)
+                if base_index is not None:
+                    base_pos = positions.get(pack_index.sha(base_index), -1)
+                # END handle corrupted offset
+            elif info.type_id == REF_DELTA:
+                base_pos = positions.get(bytes(info.delta_info), -1)
+            # END handle deltas
+            if info.type_id in delta_types and base_pos == -1:
+                continue
+            # END skip deltas whose base we don't write
+
+            sources[pos] = (entity, offset, index, base_pos)
+            break
+        # END for each entity
+    # END for each object
+    return sources
+
+
+def copy_pack_data(cursor, start, end, write, crc=None):
+    """Copy the pack's bytes from start to end using the write function.
+
+    :param crc: if not None, the crc32 to compute the one of the copied bytes upon
+    :return: crc32 of the copied bytes, or None if crc was None"""
+    while start < end:
+        data = bytes(cursor.use_region(start, min(chunk_size, end - start)).buffer()[:end - start])
+        write(data)
+        if crc is not None:
+            crc = crc32(data, crc)
+        # END handle crc
+        start += len(data)
+    # END copy loop
+    return crc
+
+
+def iter_compressed(items, zlib_compression, pool=None, max_pending_size=0):
+    """Compress the data of the given items, concurrently if a pool is given.
+
+    :param items: iterable of tuple(item, data) with the bytes to compress, or None if
+        there is nothing to compress
+    :param pool: if not None, a ThreadPool to compress with, which works as zlib
+        releases the GIL
+    :param max_pending_size: amount of bytes which may be compressed concurrently. Once
+        exceeded, no more items are consumed until the oldest ones are compressed
+    :return: iterator yielding tuple(item, compressed data or None) in the order of items"""
+    if pool is None:
+        for item, data in items:
+            if data is not None:
+                data = zlib.compress(data, zlib_compression)
+            # END handle data
+            yield item, data
+        # END for each item
+        return
+    # END handle serial compression
+
+    pending = deque()       # tuple(item, async result or None, size)
+    pending_size = 0
+    for item, data in items:
+        result = None
+        size = 0
+        if data is not None:
+            result = pool.apply_async(zlib.compress, (data, zlib_compression))
+            size = len(data)
+        # END handle data
+        pending.append((item, result, size))
+        pending_size += size
+
+        while pending and (pending_size > max_pending_size or
+                           pending[0][1] is None or pending[0][1].ready()):
+            item, result, size = pending.popleft()
+            pending_size -= size
+            yield item, result is not None and result.get() or None
+        # END while results must or can be yielded
+    # END for each item
+
+    for item, result, size in pending:
+        yield item, result is not None and result.get() or None
+    # END for each pending item
+
+
+def compression_pool(threads):
+    """:return: tuple(pool, threads) ThreadPool to compress objects with, or None if
+        objects should be compressed on the calling thread, and its amount of threads
+    :param threads: amount of threads, or None for one per cpu"""
+    if threads is None:
+        try:
+            threads = cpu_count()
+        except NotImplementedError:
+            threads = 1
+        # END handle unknown cpu count
+    # END handle default
+    if threads > 1:
+        return ThreadPool(threads), threads
+    return None, 1
+
+
+def write_pack_object(obj, write, zlib_compression, want_crc, compressed=None):
+    """Write the given object into a pack as it is, without deltifying it
+
+    :param obj: OStream of the object
+    :param want_crc: if True, the crc32 of the written bytes is computed
+    :param compressed: if not None, the object's data, compressed already
+    :return: tuple(crc or None, bytes written)"""
+    hdr = create_pack_object_header(obj.type_id, obj.size)
+    crc = None
+    if want_crc:
+        crc = crc32(hdr)
+    # END handle crc
+    write(hdr)
+
+    if compressed is not None:
+        write(compressed)
+        if crc is not None:
+            crc = crc32(compressed, crc)
+        # END handle crc
+        return crc, len(hdr) + len(compressed)
+    # END handle compressed data
+
+    # data stream
+    zstream = zlib.compressobj(zlib_compression)
+    br, bw, crc = write_stream_to_pack(obj.stream.read, write, zstream, base_crc=crc)
+    assert(br == obj.size)
+    return crc, len(hdr) + bw
+
+
+def write_pack_objects(objects, write, index, zlib_compression, offset, pool=None, max_pending_size=0,
+                       max_object_size=0):
+    """Write the given objects into a pack as they are, without deltifying them
+
+    :param objects: iterable of OStream instances
+    :param index: if not None, IndexWriter to append the objects to
+    :param offset: offset into the pack at which the first object is written
+    :param pool: if not None, the ThreadPool to compress objects with, see ``iter_compressed``
+    :param max_pending_size: amount of bytes of objects which may be compressed concurrently
+    :param max_object_size: objects larger than this are compressed while they are streamed
+        on the calling thread
+    :return: tuple(amount of objects, offset following the last object)"""
+    def read_obj(obj):
+        if pool is None or obj.size > max_object_size:
+            return None
+        # END handle large objects
+        data = obj.stream.read()
+        assert len(data) == obj.size
+        return data
+    # END read_obj
+
+    count = 0
+    for obj, compressed in iter_compressed(((obj, read_obj(obj)) for obj in objects),
+                                           zlib_compression, pool, max_pending_size):
+        count += 1
+        crc, size = write_pack_object(obj, write, zlib_compression, index is not None, compressed)
+        if index is not None:
+            index.append(obj.binsha, crc, offset)
+        # END handle index
+        offset += size
+    # END for each object
+    return count, offset
+
+
+def finalize_pack_file(pack_file, start, end, object_count):
+    """Set the object count in the header of the pack written into the given file, and
+    append its checksum.
+
+    :param pack_file: file object which can be read, written and seeked
+    :param start: offset of the pack's header within the file
+    :param end: offset following the pack's last object, relative to start
+    :return: binary sha of the pack"""
+    pack_file.seek(start + 8)
+    pack_file.write(pack('>L', object_count))
+    pack_file.seek(start)
+    sha_writer = Sha1Writer()
+    remaining = end
+    while remaining:
+        chunk = pack_file.read(min(chunk_size, remaining))
+        if not chunk:
+            raise IOError("Pack file %r was truncated while writing it" % pack_file)
+        # END handle truncation
+        sha_writer.write(chunk)
+        remaining -= len(chunk)
+    # END checksum loop
+    pack_sha = sha_writer.sha(as_hex=False)
+    pack_file.seek(start + end)
+    pack_file.write(pack_sha)
+    return pack_sha
+
+
+def is_random_access(fp):
+    """:return: True if the given file object can be read, written and seeked"""
+    try:
+        return fp.seekable() and fp.readable()
+    except AttributeError:
+        pass
+    # END handle io objects
+    try:
+        fp.tell()
+    except (AttributeError, IOError, OSError):
+        return False
+    # END handle unseekable files
+    mode = getattr(fp, 'mode', '')
+    return 'r' in mode or '+' in mode
+
+
+def mapped_file_sha(cursor, size, threaded=True, block_size=4 * 1024 ** 2, max_pending_blocks=4):
+    """:return: binary sha1 of the first size bytes of the file of the given cursor, which
+        are read window by window
+    :param cursor: smmap cursor of the file
+    :param threaded: if True, blocks of the windows are copied on the calling thread, and
+        hashed on a background thread meanwhile. As hashing releases the GIL, reading
+        the file, which happens when pages of the windows are touched for the first time,
+        overlaps with hashing. Otherwise the windows are hashed in place
+    :param block_size: amount of bytes to copy and hash at once if threaded
+    :param max_pending_blocks: amount of copied blocks which may wait for being hashed,
+        which limits the memory used to about block_size * (max_pending_blocks + 2)"""
+    sha = make_sha()
+
+    def iter_buffers(max_size):
+        offset = 0
+        while offset < size:
+            buf = cursor.use_region(offset, min(max_size, size - offset)).buffer()
+            if not len(buf):
+                raise ParseError("File %s is shorter than %i bytes" % (cursor.path_or_fd(), size))
+            # END handle truncated file
+            buf = buf[:min(max_size, size - offset)]
+            yield buf
+            offset += len(buf)
+        # END for each window
+    # END iter_buffers
+
+    if not threaded:
+        for buf in iter_buffers(size):
+            sha.update(buf)
+        # END for each window
+        return sha.digest()
+    # END handle serial hashing
+
+    blocks = Queue(max_pending_blocks)
+
+    def hash_blocks():
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            # END handle end of file
+            sha.update(block)
+        # END for each block
+    # END hash_blocks
+
+    thread = threading.Thread(target=hash_blocks)
+    thread.daemon = True
+    thread.start()
+    try:
+        for buf in iter_buffers(block_size):
+            blocks.put(bytes(buf))
+        # END for each block
+    finally:
+        blocks.put(None)
+        thread.join()
+    # END stop hashing thread
+    return sha.digest()
+
+
+def inflate_at(read, offset, write, base_crc=0):
+    """Decompress the zlib stream starting at the given offset chunk by chunk.
+
+    :param read: function read(offset, size) returning up to size bytes at the given
+        offset into the pack
+    :param write: function receiving the decompressed chunks
+    :param base_crc: crc the crc32 of the compressed data is based on
+    :return: tuple(end_offset, decompressed_size, crc32) the offset of the first byte
+        after the compressed stream, the amount of bytes passed to write and the crc
+        over the compressed bytes
+    :raise ParseError: if the stream is truncated"""
+    zd = zlib.decompressobj()
+    size = 0
+    crc = base_crc
+    while True:
+        chunk = read(offset, chunk_size)
+        if not chunk:
+            raise ParseError("Compressed stream is truncated at offset %i" % offset)
+        # END handle end of data
+        data = zd.decompress(chunk)
+        size += len(data)
+        write(data)
+        if zd.unused_data:
+            used = len(chunk) - len(zd.unused_data)
+            return offset + used, size, crc32(chunk[:used], crc)
+        # END handle end of stream
+        crc = crc32(chunk, crc)
+        offset += len(chunk)
+    # END for each chunk
+
+
+class InflateStream(object):
+
+    """A stream decompressing a zlib stream of a pack on demand, chunk by chunk. Unlike
+    DecompressMemMapReader, it knows exactly where the compressed data ends, which is
+    what iterating a pack without index requires"""
+    __slots__ = ('_read', '_offset', '_end_offset', '_zd', '_buf', '_size', '_inflated')
+
+    def __init__(self, read, offset, size):
+        """:param read: function read(offset, size) returning up to size bytes at the given
+            offset into the pack
+        :param offset: offset of the compressed data
+        :param size: size of the decompressed data"""
+        self._read = read
+        self._offset = offset
+        self._end_offset = None
+        self._zd = zlib.decompressobj()
+        self._buf = b''
+        self._size = size
+        self._inflated = 0
+
+    def _inflate_chunk(self):
+        """:return: next chunk of decompressed data, which is empty at the end of the stream"""
+        if self._end_offset is not None:
+            return b''
+        # END handle end of stream
+        chunk = self._read(self._offset, chunk_size)
+        if not chunk:
+            raise ParseError("Compressed stream is truncated at offset %i" % self._offset)
+        # END handle end of data
+        data = self._zd.decompress(chunk)
+        self._offset += len(chunk) - len(self._zd.unused_data)
+        if self._zd.unused_data:
+            self._end_offset = self._offset
+            if self._inflated + len(data) != self._size:
+                raise ParseError("Compressed stream has %i bytes, expected %i"
+                                 % (self._inflated + len(data), self._size))
+            # END handle size mismatch
+        # END handle end of stream
+        self._inflated += len(data)
+        return data
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self._size
+        # END handle read all
+        chunks = [self._buf]
+        have = len(self._buf)
+        while have < size:
+            data = self._inflate_chunk()
+            if not data:
+                break
+            # END handle end of stream
+            chunks.append(data)
+            have += len(data)
+        # END while data is missing
+        data = b''.join(chunks)
+        self._buf = data[size:]
+        return data[:size]
+
+    def end_offset(self):
+        """:return: offset of the first byte after the compressed data. Data which wasn't
+            read yet is decompressed and dropped to find it"""
+        self._buf = b''
+        while self._inflate_chunk():
+            pass
+        # END while there is data
+        return self._end_offset
+
+
+def iter_delta_tree(inflate, children, root, type_id, data):
+    """Resolve all deltas based on the given root object, depth first. Only the
+    objects on the path to the delta currently being resolved are kept in memory.
+
+    :param inflate: function inflate(index) returning the decompressed data of the
+        object with the given index
+    :param children: function children(index, sha) returning the indices of the
+        deltas based on the object with the given index and binary sha
+    :param root: index of the base object
+    :param type_id: type id of the base object
+    :param data: decompressed data of the base object
+    :return: iterator yielding tuple(index, type_id, binsha, data) for the root and
+        all deltas resolved from it"""
+    type_name = type_id_to_type_map[type_id]
+    root_data = data
+    stack = [(root, None)]
+    while stack:
+        index, base = stack.pop()
+        if base is None:
+            data = root_data
+        else:
+            data = apply_delta(base, inflate(index))
+        # END resolve delta
+        sha = make_sha(loose_object_header(type_name, len(data)))
+        sha.update(data)
+        sha = sha.digest()
+        yield index, type_id, sha, data
+        for child in children(index, sha):
+            stack.append((child, data))
+        # END for each delta
+    # END while there are objects to resolve
+
+
 #} END utilities
 
 
 class IndexWriter(object):
 
     """Utility to cache index information, allowing to write all information later
-    in one go to the given stream
+    in one go to the given stream. Information is kept in one contiguous buffer of shas
+    and arrays of crcs and offsets, taking 32 bytes per object.
     **Note:** currently only writes v2 indices"""
-    __slots__ = '_objs'
+    __slots__ = ('_shas', '_crcs', '_offsets')
 
     def __init__(self):
-        self._objs = []
+        self._shas = bytearray()
+        self._crcs = array.array('I')
+        self._offsets = array.array(uint64_typecode)
+
+    def __len__(self):
+        return len(self._crcs)
 
     def append(self, binsha, crc, offset):
         """Append one piece of object information"""
-        self._objs.append((binsha, crc, offset))
+        assert len(binsha) == 20
+        self._shas += binsha
+        self._crcs.append(crc & 0xffffffff)
+        self._offsets.append(offset)
+
+    def _sha_order(self):
+        """:return: array of the positions of our shas in ascending order of the shas.
+            Positions are bucketed by the first two bytes of their sha, and only those
+            within a bucket are compared, hence no object is created per sha"""
+        shas = self._shas
+        keys = array.array('H', (first << 8 | second for first, second in izip(shas[0::20], shas[1::20])))
+        # ends[key] is the end of the bucket of key once all positions are in place
+        ends = [0] * 0x10001
+        for key in keys:
+            ends[key + 1] += 1
+        # END for each key
+        for key in xrange(0x10000):
+            ends[key + 1] += ends[key]
+        # END for each bucket
+        order = array.array('I', [0]) * len(keys)
+        for pos, key in enumerate(keys):
+            order[ends[key]] = pos
+            ends[key] += 1
+        # END for each position
+
+        sha_key = lambda pos: shas[pos * 20 + 2:pos * 20 + 20]
+        start = 0
+        for end in ends[:0x10000]:
+            if end - start > 1:
+                order[start:end] = array.array('I', sorted(order[start:end], key=sha_key))
+            # END handle buckets with several shas
+            start = end
+        # END for each bucket
+        return order
 
     def write(self, pack_sha, write):
         """Write the index file using the given write method
         :param pack_sha: binary sha over the whole pack that we index
         :return: sha1 binary sha over all index file contents"""
-        # sort for sha1 hash
-        self._objs.sort(key=lambda o: o[0])
+        # sort for sha1 hash, indirectly, so the columns stay where they are
+        order = self._sha_order()
+        unsorted_shas = self._shas
+        shas = bytearray(len(unsorted_shas))
+        for i, pos in enumerate(order):
+            shas[i * 20:i * 20 + 20] = unsorted_shas[pos * 20:pos * 20 + 20]
+        # END for each sha
 
         sha_writer = FlexibleSha1Writer(write)
         sha_write = sha_writer.write
         sha_write(PackIndexFile.index_v2_signature)
         sha_write(pack(">L", PackIndexFile.index_version_default))
 
-        # fanout
-        tmplist = list((0,) * 256)                                # fanout or list with 64 bit offsets
-        for t in self._objs:
-            tmplist[byte_ord(t[0][0])] += 1
-        # END prepare fanout
-        for i in xrange(255):
-            v = tmplist[i]
-            sha_write(pack('>L', v))
-            tmplist[i + 1] += v
-        # END write each fanout entry
-        sha_write(pack('>L', tmplist[255]))
+        # fanout - the amount of shas whose first byte is smaller or equal
+        first_bytes = bytearray(shas[::20])
+        sha_write(uint32_bytes(bisect_right(first_bytes, i) for i in xrange(256)))
 
         # sha1 ordered
-        # save calls, that is push them into c
-        sha_write(b''.join(t[0] for t in self._objs))
+        sha_write(shas)
 
         # crc32
-        for t in self._objs:
-            sha_write(pack('>L', t[1] & 0xffffffff))
-        # END for each crc
-
-        tmplist = []
-        # offset 32
-        for t in self._objs:
-            ofs = t[2]
-            if ofs > 0x7fffffff:
-                tmplist.append(ofs)
-                ofs = 0x80000000 + len(tmplist) - 1
-            # END hande 64 bit offsets
-            sha_write(pack('>L', ofs & 0xffffffff))
-        # END for each offset
+        crcs = self._crcs
+        sha_write(uint32_bytes(map(crcs.__getitem__, order)))
+
+        # offset 32, referring to the 64 bit offsets if they don't fit
+        offsets = self._offsets
+        offsets64 = []
+        if not offsets or max(offsets) <= 0x7fffffff:
+            offsets32 = map(offsets.__getitem__, order)
+        else:
+            offsets32 = array.array('I')
+            for i in order:
+                ofs = offsets[i]
+                if ofs > 0x7fffffff:
+                    offsets64.append(ofs)
+                    ofs = 0x80000000 + len(offsets64) - 1
+                # END handle 64 bit offsets
+                offsets32.append(ofs)
+            # END for each offset
+        # END handle 64 bit offsets
+        sha_write(uint32_bytes(offsets32))
 
         # offset 64
-        for ofs in tmplist:
-            sha_write(pack(">Q", ofs))
-        # END for each offset
+        sha_write(pack(">%iQ" % len(offsets64), *offsets64))
 
         # trailer
         assert(len(pack_sha) == 20)
@@ -241,6 +886,172 @@ class IndexWriter(object):
         return sha
 
 
+class MultiPackIndexWriter(object):
+
+    """Utility to gather the objects of several pack indices, allowing to write them
+    as one multi-pack-index later, as understood by git
+    **Note:** currently only writes v1 files without optional chunks"""
+    __slots__ = ('_names', '_objs')
+
+    def __init__(self):
+        self._names = []
+        self._objs = []
+
+    def append(self, index):
+        """Append all objects of the given PackIndexFile, which must be entered.
+        Objects contained in several packs will be taken from the pack whose
+        index was appended first"""
+        pack_id = len(self._names)
+        self._names.append(os.path.basename(index.path()))
+        if index.size():
+            self._objs.extend(izip(index._sha_range(0, index.size()), repeat(pack_id), index.offsets()))
+        # END handle empty index
+
+    def write(self, write):
+        """Write the multi-pack-index file using the given write method
+        :return: sha1 binary sha over all file contents"""
+        # pack names are stored sorted, their position is the pack-int-id
+        name_order = sorted(xrange(len(self._names)), key=self._names.__getitem__)
+        pack_ids = [0] * len(name_order)
+        for pack_int_id, pack_id in enumerate(name_order):
+            pack_ids[pack_id] = pack_int_id
+        # END for each pack
+
+        # sort for sha1 hash, the first appended pack wins for duplicates
+        self._objs.sort()
+        objs = []
+        last_sha = None
+        for obj in self._objs:
+            if obj[0] != last_sha:
+                objs.append(obj)
+                last_sha = obj[0]
+            # END skip duplicates
+        # END for each object
+
+        names = b''.join(force_bytes(self._names[i]) + NULL_BYTE for i in name_order)
+        names += NULL_BYTE * (-len(names) % 4)
+
+        fanout = list((0,) * 256)
+        for obj in objs:
+            fanout[byte_ord(obj[0][0])] += 1
+        # END prepare fanout
+        for i in xrange(255):
+            fanout[i + 1] += fanout[i]
+        # END accumulate fanout
+
+        # offsets beyond 32 bit go into the large offset table, but only if needed at all
+        wants_large_offsets = objs and max(obj[2] for obj in objs) > 0xffffffff
+        large_offsets = []
+        object_offsets = []
+        for obj in objs:
+            ofs = obj[2]
+            if wants_large_offsets and ofs > 0x7fffffff:
+                large_offsets.append(ofs)
+                ofs = 0x80000000 + len(large_offsets) - 1
+            # END handle large offsets
+            object_offsets.append(pack('>LL', pack_ids[obj[1]], ofs))
+        # END for each object
+
+        chunks = [(b'PNAM', names),
+                  (b'OIDF', b''.join(pack('>L', v) for v in fanout)),
+                  (b'OIDL', b''.join(obj[0] for obj in objs)),
+                  (b'OOFF', b''.join(object_offsets))]
+        if large_offsets:
+            chunks.append((b'LOFF', b''.join(pack('>Q', ofs) for ofs in large_offsets)))
+        # END handle large offsets
+
+        sha_writer = FlexibleSha1Writer(write)
+        sha_write = sha_writer.write
+        sha_write(pack('>4sBBBBL', MultiPackIndexFile.midx_signature, MultiPackIndexFile.midx_version_default,
+                       1, len(chunks), 0, len(self._names)))
+
+        # chunk lookup table, terminated by a zero id pointing to the end of the last chunk
+        chunk_offset = 12 + (len(chunks) + 1) * 12
+        for chunk_id, chunk in chunks:
+            sha_write(pack('>4sQ', chunk_id, chunk_offset))
+            chunk_offset += len(chunk)
+        # END for each chunk
+        sha_write(pack('>4sQ', NULL_BYTE * 4, chunk_offset))
+
+        for chunk_id, chunk in chunks:
+            sha_write(chunk)
+        # END for each chunk
+
+        sha = sha_writer.sha(as_hex=False)
+        write(sha)
+        return sha
+
+
+class WindowedFileView(object):
+
+    """Provides slices of a file which is too large to be mapped by a single window.
+    The beginning of the file is mapped by consecutive windows, which stay pinned while
+    we exist. Slices within one of them are taken from its map directly, all others are
+    gathered from as many windows as needed."""
+    __slots__ = ('_begins', '_ends', '_maps', '_pinned_cursors', '_cursor')
+
+    def __init__(self, mman, path, pinned_cursor, pinned_size=0):
+        """:param pinned_cursor: cursor whose region starts at the beginning of the file
+        :param pinned_size: amount of bytes at the beginning of the file to keep mapped,
+            using as many more windows as needed"""
+        assert pinned_cursor.ofs_begin() == 0
+        self._begins = [0]
+        self._ends = [pinned_cursor.ofs_end()]
+        self._maps = [pinned_cursor.map()]
+        self._pinned_cursors = []
+        pinned_size = min(pinned_size, pinned_cursor.file_size())
+        while self._ends[-1] < pinned_size:
+            cursor = mman.make_cursor(path).use_region(self._ends[-1])
+            if not cursor.is_valid():
+                break
+            # END handle end of file
+            self._pinned_cursors.append(cursor)
+            self._begins.append(cursor.ofs_begin())
+            self._ends.append(cursor.ofs_end())
+            self._maps.append(cursor.map())
+        # END for each window to pin
+        self._cursor = mman.make_cursor(path)
+
+    def __getitem__(self, s):
+        """:return: bytes of the given slice, which must have non-negative bounds and no step"""
+        start, stop = s.start, s.stop
+        chunks = []
+        if stop <= self._ends[-1]:
+            i = bisect_right(self._begins, start) - 1
+            # slices across pinned windows are joined from their maps
+            while start < stop:
+                begin = self._begins[i]
+                end = min(stop, self._ends[i])
+                chunks.append(self._maps[i][start - begin:end - begin])
+                start = end
+                i += 1
+            # END for each pinned window
+            return len(chunks) == 1 and chunks[0] or b''.join(chunks)
+        # END handle pinned region
+        cursor = self._cursor
+        while start < stop:
+            chunk = bytes(cursor.use_region(start, stop - start).buffer())
+            if not chunk:
+                raise ParseError("Cannot read beyond the end of %s" % cursor.path())
+            # END handle end of file
+            chunks.append(chunk)
+            start += len(chunk)
+        # END for each window
+        return b''.join(chunks)
+
+    def pinned_size(self):
+        """:return: amount of bytes at the beginning of the file which are pinned"""
+        return self._ends[-1]
+
+    def release(self):
+        """Release the windows we occupy, we must not be used afterwards"""
+        self._maps = None
+        for cursor in self._pinned_cursors:
+            cursor._destroy()
+        # END for each pinned window
+        self._cursor._destroy()
+
+
 class PackIndexFile(LazyMixin):
 
     """A pack index provides offsets into the corresponding pack, allowing to find
@@ -248,7 +1059,7 @@ class PackIndexFile(LazyMixin):
 
     # Dont use slots as we dynamically bind functions for each version, need a dict for this
     # The slots you see here are just to keep track of our instance variables
-    # __slots__ = ('_indexpath', '_fanout_table', '_cursor', '_version',
+    # __slots__ = ('_indexpath', '_fanout_table', '_cursor', '_data', '_version',
     #               '_sha_list_offset', '_crc_list_offset', '_pack_offset', '_pack_64_offset')
 
     # used in v2 indices
@@ -261,6 +1072,7 @@ class PackIndexFile(LazyMixin):
         self._indexpath = indexpath
         self._entered = 0
         self._cursor = None
+        self._data = None
 
     def __enter__(self):
         if self._entered == 0:
@@ -269,6 +1081,7 @@ class PackIndexFile(LazyMixin):
             # alternate for instance
             assert self._cursor is None, self._cursor
             self._cursor = self._make_cursor()
+            self._data = self._make_data(self._cursor)
         self._entered += 1
 
         return self
@@ -277,30 +1090,43 @@ class PackIndexFile(LazyMixin):
         self._entered -= 1
         assert self._entered >= 0, (self, self._indexpath)
         if self._entered == 0:
+            if isinstance(self._data, WindowedFileView):
+                self._data.release()
+            self._data = None
             self._cursor._destroy()
             self._cursor = None
 
     def _make_cursor(self):
-        mman = self._mman
-        cursor = mman.make_cursor(self._indexpath).use_region()
-
-        # We will assume that the index will always fully fit into memory !
-        if mman.window_size() > 0 and cursor.file_size() > mman.window_size():
-            raise AssertionError("The index file at %s is too large to fit into a mapped window (%i > %i). "
-                                 "This is a limitation of the hardware." % (
-                                     self._indexpath, cursor.file_size(), mman.window_size()))
-
-        return cursor
+        # the first window holds the header and the fanout. It stays pinned while we are entered
+        return self._mman.make_cursor(self._indexpath).use_region()
+
+    def _make_data(self, cursor):
+        """:return: sliceable data of the whole index file, which is the map of the given
+            cursor if the file fits into it, or a WindowedFileView otherwise. The latter
+            keeps the sha table pinned, which is hit by every lookup"""
+        if cursor.ofs_end() >= cursor.file_size():
+            return cursor.map()
+        # END handle small index
+        data = cursor.map()
+        if data[:4] == self.index_v2_signature:
+            num_objects = unpack_from('>L', data, 8 + 255 * 4)[0]
+            sha_table_end = self._sha_list_offset + num_objects * 20
+        else:
+            # v1 entries consist of offset and sha
+            num_objects = unpack_from('>L', data, 255 * 4)[0]
+            sha_table_end = 1024 + num_objects * 24
+        # END handle version
+        return WindowedFileView(self._mman, self._indexpath, cursor, sha_table_end)
 
     def _set_cache_(self, attr):
         # now its time to initialize everything - if we are here, someone wants
         # to access the fanout table or related properties
 
         # CHECK VERSION
-        mmap = self._cursor.map()
-        self._version = (mmap[:4] == self.index_v2_signature and 2) or 1
+        data = self._data
+        self._version = (data[0:4] == self.index_v2_signature and 2) or 1
         if self._version == 2:
-            version_id = unpack_from(">L", mmap, 4)[0]
+            version_id = unpack(">L", data[4:8])[0]
             assert version_id == self._version, "Unsupported index version: %i" % version_id
         # END assert version
 
@@ -318,34 +1144,34 @@ class PackIndexFile(LazyMixin):
             self._crc_list_offset = self._sha_list_offset + self.size() * 20
             self._pack_offset = self._crc_list_offset + self.size() * 4
             self._pack_64_offset = self._pack_offset + self.size() * 4
+            self._sha_table_offset = self._sha_list_offset
+            self._sha_stride = 20
+        else:
+            # v1 shas follow the 4 byte offset of each entry
+            self._sha_table_offset = 1024 + 4
+            self._sha_stride = 24
         # END setup base
 
     def _read_fanout(self, byte_offset):
         """Generate a fanout table from our data"""
-        d = self._cursor.map()
-        out = []
-        append = out.append
-        for i in xrange(256):
-            append(unpack_from('>L', d, byte_offset + i * 4)[0])
-        # END for each entry
-        return out
-
-        # END handle attributes
+        return uint32_array(self._data[byte_offset:byte_offset + 256 * 4])
 
     #{ Access V1
 
     def _entry_v1(self, i):
         """:return: tuple(offset, binsha, 0)"""
-        return unpack_from(">L20s", self._cursor.map(), 1024 + i * 24) + (0,)
+        base = 1024 + i * 24
+        return unpack(">L20s", self._data[base:base + 24]) + (0,)
 
     def _offset_v1(self, i):
         """see ``_offset_v2``"""
-        return unpack_from(">L", self._cursor.map(), 1024 + i * 24)[0]
+        base = 1024 + i * 24
+        return unpack(">L", self._data[base:base + 4])[0]
 
     def _sha_v1(self, i):
         """see ``_sha_v2``"""
         base = 1024 + (i * 24) + 4
-        return self._cursor.map()[base:base + 20]
+        return self._data[base:base + 20]
 
     def _crc_v1(self, i):
         """unsupported"""
@@ -361,13 +1187,15 @@ class PackIndexFile(LazyMixin):
     def _offset_v2(self, i):
         """:return: 32 or 64 byte offset into pack files. 64 byte offsets will only
             be returned if the pack is larger than 4 GiB, or 2^32"""
-        offset = unpack_from(">L", self._cursor.map(), self._pack_offset + i * 4)[0]
+        base = self._pack_offset + i * 4
+        offset = unpack(">L", self._data[base:base + 4])[0]
 
         # if the high-bit is set, this indicates that we have to lookup the offset
         # in the 64 bit region of the file. The current offset ( lower 31 bits )
         # are the index into it
         if offset & 0x80000000:
-            offset = unpack_from(">Q", self._cursor.map(), self._pack_64_offset + (offset & ~0x80000000) * 8)[0]
+            base = self._pack_64_offset + (offset & ~0x80000000) * 8
+            offset = unpack(">Q", self._data[base:base + 8])[0]
         # END handle 64 bit offset
 
         return offset
@@ -375,11 +1203,12 @@ class PackIndexFile(LazyMixin):
     def _sha_v2(self, i):
         """:return: sha at the given index of this file index instance"""
         base = self._sha_list_offset + i * 20
-        return self._cursor.map()[base:base + 20]
+        return self._data[base:base + 20]
 
     def _crc_v2(self, i):
         """:return: 4 bytes crc for the object at index i"""
-        return unpack_from(">L", self._cursor.map(), self._crc_list_offset + i * 4)[0]
+        base = self._crc_list_offset + i * 4
+        return unpack(">L", self._data[base:base + 4])[0]
 
     #} END access V2
 
@@ -397,45 +1226,71 @@ class PackIndexFile(LazyMixin):
 
     def packfile_checksum(self):
         """:return: 20 byte sha representing the sha1 hash of the pack file"""
-        return self._cursor.map()[-40:-20]
+        end = self._cursor.file_size()
+        return self._data[end - 40:end - 20]
 
     def indexfile_checksum(self):
         """:return: 20 byte sha representing the sha1 hash of this index file"""
-        return self._cursor.map()[-20:]
+        end = self._cursor.file_size()
+        return self._data[end - 20:end]
+
+    def verify_checksum(self, threaded=True):
+        """:return: True if the sha1 of this index file matches its trailing checksum
+        :param threaded: if True, the file is hashed on a background thread while it is
+            read, see ``mapped_file_sha``"""
+        # our own cursor keeps the first window pinned
+        cursor = self._mman.make_cursor(self._indexpath)
+        try:
+            return mapped_file_sha(cursor, cursor.file_size() - 20, threaded) == bytes(self.indexfile_checksum())
+        finally:
+            cursor._destroy()
+        # END release cursor
 
     def offsets(self):
         """:return: sequence of all offsets in the order in which they were written
 
         **Note:** return value can be random accessed, but may be immmutable"""
         if self._version == 2:
-            # read stream to array, convert to tuple
-            a = array.array('I')    # 4 byte unsigned int, long are 8 byte on 64 bit it appears
-            a.fromstring(buffer(self._cursor.map(), self._pack_offset, self._pack_64_offset - self._pack_offset))
-
-            # networkbyteorder to something array likes more
-            if sys.byteorder == 'little':
-                a.byteswap()
+            # read the table in one go, networkbyteorder to something array likes more
+            a = uint32_array(self._data[self._pack_offset:self._pack_64_offset])
+            if self._cursor.file_size() - 40 > self._pack_64_offset:
+                # some offsets are indices into the 64 bit table, resolve them
+                return [(ofs & 0x80000000 and self.offset(i)) or ofs for i, ofs in enumerate(a)]
+            # END handle 64 bit offsets
             return a
         else:
             return tuple(self.offset(index) for index in xrange(self.size()))
         # END handle version
 
+    def crcs(self):
+        """:return: array of the crc32 values of all objects in the order in which they
+            were written, read from the index in one go
+        :raise UnsupportedOperation: If the index is version 1 only"""
+        if self._version < 2:
+            raise UnsupportedOperation("Version 1 indices do not contain crc's")
+        # END handle index version
+        return uint32_array(self._data[self._crc_list_offset:self._pack_offset])
+
     def sha_to_index(self, sha):
         """
         :return: index usable with the ``offset`` or ``entry`` method, or None
             if the sha was not found in this pack index
         :param sha: 20 byte sha to lookup"""
         first_byte = byte_ord(sha[0])
-        get_sha = self.sha
+        data = self._data
+        base = self._sha_table_offset
+        stride = self._sha_stride
         lo = 0  # lower index, the left bound of the bisection
         if first_byte != 0:
             lo = self._fanout_table[first_byte - 1]
         hi = self._fanout_table[first_byte]     # the upper, right bound of the bisection
 
-        # bisect until we have the sha
+        # bisect until we have the sha - slice the table directly, which is
+        # considerably cheaper than going through ``sha`` for each probe
         while lo < hi:
             mid = (lo + hi) // 2
-            mid_sha = get_sha(mid)
+            ofs = base + mid * stride
+            mid_sha = data[ofs:ofs + 20]
             if sha < mid_sha:
                 hi = mid
             elif sha == mid_sha:
@@ -446,6 +1301,85 @@ class PackIndexFile(LazyMixin):
         # END bisect
         return None
 
+    def _sha_range(self, lo, hi):
+        """:return: list of the shas at indices lo to hi (exclusive), read in one go"""
+        base = self._sha_table_offset
+        stride = self._sha_stride
+        block = self._data[base + lo * stride:base + (hi - 1) * stride + 20]
+        return [block[i:i + 20] for i in xrange(0, len(block), stride)]
+
+    def sha_to_index_many(self, shas):
+        """
+        :return: array of indices usable with the ``offset`` or ``entry`` method,
+            lining up with the given shas. Shas not found in this pack index
+            are marked with -1
+        :param shas: iterable of 20 byte shas to lookup
+
+        **Note:** the shas are sorted once and walked against the fanout and sha
+        tables in a single merge-style pass, which is a lot cheaper than calling
+        ``sha_to_index`` for each of them"""
+        if not isinstance(shas, (tuple, list)):
+            shas = list(shas)
+        # END handle list type
+        count = len(shas)
+        out = array.array('l', (-1,)) * count
+        order = sorted(xrange(count), key=shas.__getitem__)
+        fanout = self._fanout_table
+        data = self._data
+        base = self._sha_table_offset
+        stride = self._sha_stride
+
+        i = 0
+        while i < count:
+            first_byte = byte_ord(shas[order[i]][0])
+            j = i + 1
+            while j < count and byte_ord(shas[order[j]][0]) == first_byte:
+                j += 1
+            # END gather all queries of this fanout bucket
+
+            lo = 0
+            if first_byte != 0:
+                lo = fanout[first_byte - 1]
+            hi = fanout[first_byte]
+            if lo < hi:
+                if (j - i) * bit_length(hi - lo) >= hi - lo:
+                    # dense - read the bucket at once and let bisect work on it,
+                    # each query starting where the previous one stopped
+                    bucket = self._sha_range(lo, hi)
+                    pos = 0
+                    for k in xrange(i, j):
+                        sha = shas[order[k]]
+                        pos = bisect_left(bucket, sha, pos)
+                        if pos < len(bucket) and bucket[pos] == sha:
+                            out[order[k]] = lo + pos
+                        # END handle match
+                    # END for each query
+                else:
+                    # sparse - bisect each query, narrowing the left bound as we go
+                    for k in xrange(i, j):
+                        sha = shas[order[k]]
+                        left, right = lo, hi
+                        while left < right:
+                            mid = (left + right) // 2
+                            ofs = base + mid * stride
+                            if data[ofs:ofs + 20] < sha:
+                                left = mid + 1
+                            else:
+                                right = mid
+                            # END handle midpoint
+                        # END bisect
+                        lo = left
+                        ofs = base + left * stride
+                        if left < hi and data[ofs:ofs + 20] == sha:
+                            out[order[k]] = left
+                        # END handle match
+                    # END for each query
+                # END handle bucket density
+            # END handle non-empty bucket
+            i = j
+        # END for each bucket
+        return out
+
     def partial_sha_to_index(self, partial_bin_sha, canonical_length):
         """
         :return: index as in `sha_to_index` or None if the sha was not found in this
@@ -460,7 +1394,9 @@ class PackIndexFile(LazyMixin):
         assert isinstance(partial_bin_sha, bytes), "partial_bin_sha must be bytes"
         first_byte = byte_ord(partial_bin_sha[0])
 
-        get_sha = self.sha
+        data = self._data
+        base = self._sha_table_offset
+        stride = self._sha_stride
         lo = 0                  # lower index, the left bound of the bisection
         if first_byte != 0:
             lo = self._fanout_table[first_byte - 1]
@@ -472,7 +1408,8 @@ class PackIndexFile(LazyMixin):
         # find lowest
         while lo < hi:
             mid = (lo + hi) // 2
-            mid_sha = get_sha(mid)
+            ofs = base + mid * stride
+            mid_sha = data[ofs:ofs + 20]
             if filled_sha < mid_sha:
                 hi = mid
             elif filled_sha == mid_sha:
@@ -484,6 +1421,7 @@ class PackIndexFile(LazyMixin):
             # END handle midpoint
         # END bisect
 
+        get_sha = self.sha
         if lo < self.size():
             cur_sha = get_sha(lo)
             if is_equal_canonical_sha(canonical_length, partial_bin_sha, cur_sha):
@@ -500,13 +1438,413 @@ class PackIndexFile(LazyMixin):
     if 'PackIndexFile_sha_to_index' in globals():
         # NOTE: Its just about 25% faster, the major bottleneck might be the attr
         # accesses
+        _sha_to_index_py = sha_to_index
+
         def sha_to_index(self, sha):
+            # the c version requires the whole index to be mapped
+            if isinstance(self._data, WindowedFileView):
+                return self._sha_to_index_py(sha)
             return PackIndexFile_sha_to_index(self, sha)
     # END redefine heavy-hitter with c version
 
     #} END properties
 
 
+class MultiPackIndexFile(LazyMixin):
+
+    """A multi-pack-index covers the objects of many packs with a single sha table,
+    mapping each object to the pack containing it and its offset in there.
+    This allows to locate an object with one bisection, no matter how many packs
+    there are."""
+
+    midx_signature = b'MIDX'
+    midx_version_default = 1
+
+    def __init__(self, mman, midxpath):
+        self._mman = mman
+        self._midxpath = midxpath
+        self._entered = 0
+        self._cursor = None
+        self._data = None
+
+    def __enter__(self):
+        if self._entered == 0:
+            assert self._cursor is None, self._cursor
+            cursor = self._mman.make_cursor(self._midxpath).use_region()
+            try:
+                if not cursor.is_valid():
+                    raise ParseError("Multi-pack-index at %s is empty" % self._midxpath)
+                # END handle empty file
+                self._data = self._make_data(cursor)
+            except:
+                cursor._destroy()
+                raise
+            # END handle unreadable file
+            self._cursor = cursor
+        self._entered += 1
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._entered -= 1
+        assert self._entered >= 0, (self, self._midxpath)
+        if self._entered == 0:
+            if isinstance(self._data, WindowedFileView):
+                self._data.release()
+            self._data = None
+            self._cursor._destroy()
+            self._cursor = None
+
+    def _read_header(self, data, file_size):
+        """:return: tuple(num_packs, chunks) of the given file data, chunks being a dict
+            of tuple(start, end) offsets by chunk id
+        :raise ParseError: if the header is invalid, unsupported or truncated"""
+        if file_size < 12 + 20:
+            raise ParseError("Multi-pack-index at %s is truncated" % self._midxpath)
+        # END handle truncated header
+        signature, version, hash_version, num_chunks, num_bases, num_packs = unpack('>4sBBBBL', data[0:12])
+        if signature != self.midx_signature:
+            raise ParseError("Invalid multi-pack-index signature: %r" % signature)
+        if version != self.midx_version_default or hash_version != 1 or num_bases:
+            raise ParseError("Unsupported multi-pack-index version: %i" % version)
+        # END handle header
+
+        # the chunk table is terminated by the end offset of the last chunk
+        table_end = 12 + (num_chunks + 1) * 12
+        if table_end + 20 > file_size:
+            raise ParseError("Multi-pack-index at %s is truncated" % self._midxpath)
+        # END handle truncated chunk table
+        table = data[12:table_end]
+        entries = [unpack('>4sQ', table[i:i + 12]) for i in xrange(0, len(table), 12)]
+        chunks = dict()
+        for (chunk_id, chunk_offset), (_, chunk_end) in zip(entries, entries[1:]):
+            if not table_end <= chunk_offset <= chunk_end <= file_size - 20:
+                raise ParseError("Multi-pack-index at %s has an invalid %r chunk" % (self._midxpath, chunk_id))
+            # END handle invalid bounds
+            chunks[chunk_id] = (chunk_offset, chunk_end)
+        # END for each chunk
+        for chunk_id in (b'PNAM', b'OIDF', b'OIDL', b'OOFF'):
+            if chunk_id not in chunks:
+                raise ParseError("Multi-pack-index at %s lacks the %r chunk" % (self._midxpath, chunk_id))
+        # END assert required chunks
+        return num_packs, chunks
+
+    def _make_data(self, cursor):
+        """:return: sliceable data of the whole file, see ``PackIndexFile._make_data``.
+            A WindowedFileView keeps the fanout and sha tables pinned"""
+        if cursor.ofs_end() >= cursor.file_size():
+            return cursor.map()
+        # END handle small file
+        chunks = self._read_header(cursor.map(), cursor.file_size())[1]
+        pinned_size = max(chunks[b'OIDF'][1], chunks[b'OIDL'][1])
+        return WindowedFileView(self._mman, self._midxpath, cursor, pinned_size)
+
+    def _set_cache_(self, attr):
+        data = self._data
+        num_packs, chunks = self._read_header(data, self._cursor.file_size())
+
+        start, end = chunks[b'PNAM']
+        names = data[start:end].split(NULL_BYTE)[:num_packs]
+        self._pack_names = [force_text(name) for name in names]
+
+        start, end = chunks[b'OIDF']
+        if end - start != 256 * 4:
+            raise ParseError("Multi-pack-index at %s has an invalid fanout table" % self._midxpath)
+        # END handle invalid fanout
+        fanout_table = uint32_array(data[start:end])
+        num_objects = fanout_table[255]
+        for chunk_id, entry_size in ((b'OIDL', 20), (b'OOFF', 8)):
+            start, end = chunks[chunk_id]
+            if end - start != num_objects * entry_size:
+                raise ParseError("Multi-pack-index at %s has an invalid %r chunk" % (self._midxpath, chunk_id))
+            # END handle invalid table size
+        # END for each table
+        self._fanout_table = fanout_table
+        self._sha_table_offset = chunks[b'OIDL'][0]
+        self._object_offset = chunks[b'OOFF'][0]
+        self._large_offset = b'LOFF' in chunks and chunks[b'LOFF'][0] or None
+
+    #{ Interface
+
+    def size(self):
+        """:return: amount of objects referred to by this index"""
+        return self._fanout_table[255]
+
+    def path(self):
+        """:return: path to the multi-pack-index file"""
+        return self._midxpath
+
+    def pack_names(self):
+        """:return: list of names of the pack index files covered by this file, the
+            position of each name is the pack-int-id used in ``pack_offset``"""
+        return self._pack_names
+
+    def checksum(self):
+        """:return: 20 byte sha representing the sha1 hash of this file"""
+        end = self._cursor.file_size()
+        return self._data[end - 20:end]
+
+    def sha(self, i):
+        """:return: sha at the given index of this file"""
+        base = self._sha_table_offset + i * 20
+        return self._data[base:base + 20]
+
+    def pack_offset(self, i):
+        """:return: tuple(pack_int_id, offset) locating the object at the given index"""
+        data = self._data
+        base = self._object_offset + i * 8
+        pack_int_id, offset = unpack('>LL', data[base:base + 8])
+        if offset & 0x80000000 and self._large_offset is not None:
+            base = self._large_offset + (offset & ~0x80000000) * 8
+            offset = unpack('>Q', data[base:base + 8])[0]
+        # END handle large offset
+        return pack_int_id, offset
+
+    def sha_to_index(self, sha):
+        """
+        :return: index usable with the ``sha`` or ``pack_offset`` method, or None
+            if the sha was not found in this multi-pack-index
+        :param sha: 20 byte sha to lookup"""
+        first_byte = byte_ord(sha[0])
+        data = self._data
+        base = self._sha_table_offset
+        lo = 0
+        if first_byte != 0:
+            lo = self._fanout_table[first_byte - 1]
+        hi = self._fanout_table[first_byte]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            ofs = base + mid * 20
+            mid_sha = data[ofs:ofs + 20]
+            if sha < mid_sha:
+                hi = mid
+            elif sha == mid_sha:
+                return mid
+            else:
+                lo = mid + 1
+            # END handle midpoint
+        # END bisect
+        return None
+
+    #} END interface
+
+
+class PackReverseIndexFile(LazyMixin):
+
+    """A reverse index lists the index positions of all objects in a pack in the
+    order of their offsets into the pack, as stored by git in .rev files next to the pack.
+    It allows to map offsets back to objects without having to sort all offsets first."""
+
+    rev_signature = b'RIDX'
+    rev_version_default = 1
+
+    # header and trailer sizes
+    header_size = 12
+    footer_size = 40
+
+    def __init__(self, mman, revpath):
+        self._mman = mman
+        self._revpath = revpath
+        self._entered = 0
+        self._cursor = None
+        self._data = None
+
+    def __enter__(self):
+        if self._entered == 0:
+            assert self._cursor is None, self._cursor
+            self._cursor = self._mman.make_cursor(self._revpath).use_region()
+            self._data = self._make_data(self._cursor)
+        self._entered += 1
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._entered -= 1
+        assert self._entered >= 0, (self, self._revpath)
+        if self._entered == 0:
+            if isinstance(self._data, WindowedFileView):
+                self._data.release()
+            self._data = None
+            self._cursor._destroy()
+            self._cursor = None
+
+    def _make_data(self, cursor):
+        """:return: sliceable data of the whole file, see ``PackIndexFile._make_data``"""
+        if cursor.ofs_end() >= cursor.file_size():
+            return cursor.map()
+        # END handle small file
+        return WindowedFileView(self._mman, self._revpath, cursor)
+
+    def _set_cache_(self, attr):
+        signature, version, hash_id = unpack('>4sLL', self._data[0:12])
+        if signature != self.rev_signature:
+            raise ParseError("Invalid reverse index signature: %r" % signature)
+        if version != self.rev_version_default or hash_id != 1:
+            raise ParseError("Unsupported reverse index version: %i" % version)
+        # END handle header
+        self._size = (self._cursor.file_size() - self.header_size - self.footer_size) // 4
+
+    #{ Interface
+
+    def size(self):
+        """:return: amount of objects referred to by this reverse index"""
+        return self._size
+
+    def path(self):
+        """:return: path to the reverse index file"""
+        return self._revpath
+
+    def packfile_checksum(self):
+        """:return: 20 byte sha representing the sha1 hash of the pack file"""
+        end = self._cursor.file_size()
+        return self._data[end - 40:end - 20]
+
+    def revfile_checksum(self):
+        """:return: 20 byte sha representing the sha1 hash of this file"""
+        end = self._cursor.file_size()
+        return self._data[end - 20:end]
+
+    def index_positions(self):
+        """:return: array of index positions of all objects, ordered by their pack offset"""
+        return uint32_array(self._data[self.header_size:self.header_size + self._size * 4])
+
+    #} END interface
+
+
+class PackBloomFilter(object):
+
+    """A probabilistic set of the shas contained in a pack, answering whether a sha
+    is definitely not in the pack, or whether it might be, with a false positive rate
+    depending on the amount of bits used per sha.
+
+    As shas are evenly distributed already, the hash functions are derived from the
+    sha itself."""
+    __slots__ = ('_bits', '_num_bits', '_num_hashes')
+
+    bloom_signature = b'GDBF'
+    bloom_version_default = 1
+    header_size = 4 + 4 + 4 + 8 + 20
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        """Initialize an empty filter, or one with the given bits
+        :param num_bits: size of the filter in bits, must be a multiple of 8"""
+        assert num_bits % 8 == 0, "num_bits must be a multiple of 8"
+        self._num_bits = num_bits
+        self._num_hashes = num_hashes
+        if bits is None:
+            bits = bytearray(num_bits // 8)
+        self._bits = bits
+
+    def _bit_positions(self, sha):
+        h1, h2 = unpack_from('>QQ', sha, 0)
+        h2 |= 1
+        num_bits = self._num_bits
+        return ((h1 + i * h2) % num_bits for i in xrange(self._num_hashes))
+
+    def __contains__(self, sha):
+        bits = self._bits
+        for pos in self._bit_positions(sha):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        # END for each bit
+        return True
+
+    #{ Interface
+
+    @classmethod
+    def new(cls, num_objects, bits_per_object=10):
+        """:return: empty filter sized for the given amount of objects
+        :param bits_per_object: 10 bits yield a false positive rate of about 1%"""
+        num_bits = max(64, num_objects * bits_per_object)
+        num_bits += -num_bits % 8
+        return cls(num_bits, max(1, int(round(bits_per_object * 0.6931))))
+
+    @classmethod
+    def from_index(cls, index, bits_per_object=10):
+        """:return: filter containing all shas of the given entered PackIndexFile"""
+        inst = cls.new(index.size(), bits_per_object)
+        if index.size():
+            for sha in index._sha_range(0, index.size()):
+                inst.add(sha)
+        # END handle empty index
+        return inst
+
+    @classmethod
+    def from_data(cls, data, pack_sha=None):
+        """:return: filter as previously written with ``write``
+        :param pack_sha: if not None, the 20 byte sha of the pack the filter must belong to
+        :raise ParseError: if the data is not a filter, or doesn't belong to the pack"""
+        if len(data) < cls.header_size:
+            raise ParseError("Bloom filter data is truncated")
+        signature, version, num_hashes, num_bits = unpack_from('>4sLLQ', data, 0)
+        if signature != cls.bloom_signature or version != cls.bloom_version_default:
+            raise ParseError("Invalid bloom filter signature or version: %r, %i" % (signature, version))
+        if pack_sha is not None and data[cls.header_size - 20:cls.header_size] != pack_sha:
+            raise ParseError("Bloom filter belongs to a different pack")
+        if len(data) - cls.header_size != num_bits // 8:
+            raise ParseError("Bloom filter data is truncated")
+        # END handle errors
+        return cls(num_bits, num_hashes, bytearray(data[cls.header_size:]))
+
+    def add(self, sha):
+        """Add the given 20 byte sha to the filter"""
+        bits = self._bits
+        for pos in self._bit_positions(sha):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        # END for each bit
+
+    def write(self, pack_sha, write):
+        """Write the filter using the given write method
+        :param pack_sha: binary sha of the pack the filter belongs to"""
+        assert len(pack_sha) == 20
+        write(pack('>4sLLQ', self.bloom_signature, self.bloom_version_default, self._num_hashes, self._num_bits))
+        write(pack_sha)
+        write(bytes(self._bits))
+
+    def num_bits(self):
+        """:return: size of the filter in bits"""
+        return self._num_bits
+
+    def num_hashes(self):
+        """:return: amount of bits set per sha"""
+        return self._num_hashes
+
+    #} END interface
+
+
+class PackObjectRecords(object):
+
+    """Information about all objects of a pack as read from their headers, similar
+    to what ``git verify-pack -v`` shows. Each field is a separate array with one
+    item per object, sorted by offset into the pack, which is much more compact than
+    an object per item.
+
+    * offsets - offset of the object into the pack
+    * indices - position of the object in the index, for use with its ``sha`` method
+    * type_ids - type id of the object, which for deltas is the one of their base object.
+      Deltas whose base is not in the pack keep their REF_DELTA type id
+    * sizes - size of the object as stored in its header, which for deltas is the size of
+      the delta data
+    * packed_sizes - amount of bytes the object takes in the pack, including its header
+    * depths - length of the delta chain up to the base object, 0 for non-deltas
+    * base_offsets - offset of the delta's base object, 0 for non-deltas"""
+
+    __slots__ = ('offsets', 'indices', 'type_ids', 'sizes', 'packed_sizes', 'depths', 'base_offsets')
+
+    def __init__(self, offsets, indices, type_ids, sizes, packed_sizes, depths, base_offsets):
+        self.offsets = offsets
+        self.indices = indices
+        self.type_ids = type_ids
+        self.sizes = sizes
+        self.packed_sizes = packed_sizes
+        self.depths = depths
+        self.base_offsets = base_offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+
 class PackFile(LazyMixin):
 
     """A pack is a file written according to the Version 2 for git packs
@@ -564,28 +1902,65 @@ class PackFile(LazyMixin):
         if type_id != PackFile.pack_signature:
             raise ParseError("Invalid pack signature: %i" % type_id)
 
+    def _index_offsets(self):
+        """:return: sorted offsets of all objects as read from the index next to us,
+            or None if there is no index matching our pack"""
+        index_path = "%s.idx" % os.path.splitext(self._packpath)[0]
+        if not os.path.isfile(index_path):
+            return None
+        # END handle missing index
+        try:
+            with PackIndexFile(self._mman, index_path) as index:
+                if index.size() != self.size() or bytes(index.packfile_checksum()) != bytes(self.checksum()):
+                    return None
+                # END handle foreign index
+                return sorted(index.offsets())
+            # END with index
+        except (ParseError, AssertionError, ValueError):
+            return None
+        # END ignore unusable indices
+
     def _iter_objects(self, start_offset, as_stream=True):
-        """Handle the actual iteration of objects within this pack"""
+        """Handle the actual iteration of objects within this pack
+        **Note:** Streams are returned directly in any case, as they are derived from the
+            info object. Objects are decompressed at most once, chunk by chunk"""
         c = self._cursor
         content_size = c.file_size() - self.footer_size
         cur_offset = start_offset or self.first_object_offset
 
-        null = NullStream()
+        # an index tells us where each object starts, nothing needs to be decompressed
+        offsets = self._index_offsets()
+        if offsets is not None:
+            for offset in offsets[bisect_left(offsets, cur_offset):]:
+                yield pack_object_at(c, offset, True)[1]
+            # END for each offset
+            return
+        # END handle index
+
+        # Otherwise the end of each compressed stream is only known once it was
+        # decompressed. Whatever the consumer didn't read is decompressed and dropped
+        # when advancing to the next object
+        read = lambda offset, size: bytes(c.use_region(offset, size).buffer())
+        null_write = lambda data: None
         while cur_offset < content_size:
-            data_offset, ostream = pack_object_at(c, cur_offset, True)
-            # scrub the stream to the end - this decompresses the object, but yields
-            # the amount of compressed bytes we need to get to the next offset
-
-            stream_copy(ostream.read, null.write, ostream.size, chunk_size)
-            assert ostream.stream._br == ostream.size
-            cur_offset += (data_offset - ostream.pack_offset) + ostream.stream.compressed_bytes_read()
-
-            # if a stream is requested, reset it beforehand
-            # Otherwise return the Stream object directly, its derived from the
-            # info object
-            if as_stream:
-                ostream.stream.seek(0)
-            yield ostream
+            data_offset, info = pack_object_at(c, cur_offset, False)
+            if not as_stream:
+                yield info
+                end_offset, size, _ = inflate_at(read, data_offset, null_write)
+                if size != info.size:
+                    raise ParseError("Object at offset %i has %i bytes, expected %i" % (cur_offset, size, info.size))
+                # END handle size mismatch
+                cur_offset = end_offset
+                continue
+            # END handle infos
+
+            stream = InflateStream(read, data_offset, info.size)
+            if info.type_id in delta_types:
+                yield ODeltaPackStream(cur_offset, info.type_id, info.size, info.delta_info, stream)
+            else:
+                yield OPackStream(cur_offset, info.type_id, info.size, stream)
+            # END handle delta
+            cur_offset = stream.end_offset()
         # END until we have read everything
 
     #{ Pack Information
@@ -614,6 +1989,13 @@ class PackFile(LazyMixin):
         """:return: 20 byte sha1 hash on all object sha's contained in this file"""
         return self._cursor.use_region(self._cursor.file_size() - 20).buffer()[:]
 
+    def verify_checksum(self, threaded=True):
+        """:return: True if the sha1 of this pack's contents matches its trailing checksum
+        :param threaded: if True, the file is hashed on a background thread while it is
+            read, see ``mapped_file_sha``"""
+        checksum = bytes(self.checksum())
+        return mapped_file_sha(self._cursor, self._cursor.file_size() - self.footer_size, threaded) == checksum
+
     def path(self):
         """:return: path to the packfile"""
         return self._packpath
@@ -671,8 +2053,9 @@ class PackFile(LazyMixin):
         :param start_offset: offset to the first object to iterate. If 0, iteration
             starts at the very first object in the pack.
 
-        **Note:** Iterating a pack directly is costly as the datastream has to be decompressed
-        to determine the bounds between the objects"""
+        **Note:** Without an index next to the pack, each object has to be decompressed
+        to determine the bounds between the objects. Its stream decompresses it on demand,
+        the part which wasn't read is decompressed once the iteration advances"""
         return self._iter_objects(start_offset, as_stream=True)
 
     #} END Read-Database like Interface
@@ -686,18 +2069,29 @@ class PackEntity(LazyMixin):
     __slots__ = ('_basename',        # Could have been int, but better limit scurpulus nesting.
                  '_index',           # our index file
                  '_pack',            # our pack file
-                 '_offset_map',      # on demand dict mapping one offset to the next consecutive one
+                 '_rev_index',       # our reverse index file, which might not exist
+                 '_sorted_offsets',  # on demand array of all object offsets, ascending
+                 '_offset_indices',  # on demand array of index positions matching _sorted_offsets
+                 '_delta_base_cache',  # DeltaBaseCache for resolving deltas, or None
+                 '_base_type_ids',   # on demand array of type ids of the chains' base objects
+                                     # matching _sorted_offsets, 0 if unknown
                  '_entered',
                  )
 
     IndexFileCls = PackIndexFile
     PackFileCls = PackFile
+    ReverseIndexFileCls = PackReverseIndexFile
+
+    def __init__(self, mman, pack_or_index_path, delta_base_cache=None):
+        """Initialize ourselves with the path to the respective pack or index file
 
-    def __init__(self, mman, pack_or_index_path):
-        """Initialize ourselves with the path to the respective pack or index file"""
+        :param delta_base_cache: if not None, a DeltaBaseCache keeping the objects resolved
+            when reading deltas, which may be shared with other entities"""
         basename, ext = os.path.splitext(pack_or_index_path)  # @UnusedVariable
         self._index = self.IndexFileCls(mman, "%s.idx" % basename)
         self._pack = self.PackFileCls(mman, "%s.pack" % basename)
+        self._rev_index = self.ReverseIndexFileCls(mman, "%s.rev" % basename)
+        self._delta_base_cache = delta_base_cache
         self._entered = False
 
     def __enter__(self):
@@ -715,29 +2109,45 @@ class PackEntity(LazyMixin):
         self._entered = False
 
     def _set_cache_(self, attr):
-        # currently this can only be _offset_map
-        # TODO: make this a simple sorted offset array which can be bisected
-        # to find the respective entry, from which we can take a +1 easily
-        # This might be slower, but should also be much lighter in memory !
-        offsets_sorted = sorted(self._index.offsets())
-        last_offset = len(self._pack.data()) - self._pack.footer_size
-        assert offsets_sorted, "Cannot handle empty indices"
-
-        offset_map = None
-        if len(offsets_sorted) == 1:
-            offset_map = {offsets_sorted[0]: last_offset}
+        if attr == '_base_type_ids':
+            # one byte per object, type ids are never 0
+            self._base_type_ids = array.array('B', [0]) * len(self._sorted_offsets)
+            return
+        # END handle base type ids
+
+        # otherwise this can only be _sorted_offsets or _offset_indices
+        # Use the reverse index git may have written along with the pack, it spares
+        # us sorting all offsets. Both arrays take a few bytes per object only.
+        offsets = self._index.offsets()
+        assert len(offsets), "Cannot handle empty indices"
+
+        positions = None
+        if os.path.isfile(self._rev_index.path()):
+            with self._rev_index as rev:
+                if rev.size() == len(offsets) and rev.packfile_checksum() == self._index.packfile_checksum():
+                    positions = rev.index_positions()
+            # END with reverse index
+        # END use reverse index
+        if positions is None:
+            positions = array.array('I', sorted(xrange(len(offsets)), key=offsets.__getitem__))
+        # END sort offsets ourselves
+
+        sorted_offsets = (offsets[i] for i in positions)
+        if self._pack._cursor.file_size() <= 0xffffffff:
+            sorted_offsets = array.array('I', sorted_offsets)
         else:
-            iter_offsets = iter(offsets_sorted)
-            iter_offsets_plus_one = iter(offsets_sorted)
-            next(iter_offsets_plus_one)
-            consecutive = izip(iter_offsets, iter_offsets_plus_one)
-
-            offset_map = dict(consecutive)
-
-            # the last offset is not yet set
-            offset_map[offsets_sorted[-1]] = last_offset
-        # END handle offset amount
-        self._offset_map = offset_map
+            sorted_offsets = list(sorted_offsets)
+        # END handle 64 bit offsets
+        self._sorted_offsets = sorted_offsets
+        self._offset_indices = positions
+
+    def _next_offset(self, offset):
+        """:return: offset at which the object following the one at offset starts,
+            or the offset of the pack's footer if it is the last one"""
+        pos = bisect_right(self._sorted_offsets, offset)
+        if pos < len(self._sorted_offsets):
+            return self._sorted_offsets[pos]
+        return self._pack._cursor.file_size() - self._pack.footer_size
 
     def _sha_to_index(self, sha):
         """:return: index for the given sha, or raise"""
@@ -746,27 +2156,95 @@ class PackEntity(LazyMixin):
             raise BadObject(sha)
         return index
 
-    def _iter_objects(self, as_stream):
-        """Iterate over all objects in our index and yield their OInfo or OStream instences"""
+    def _base_type_id(self, sha, offset, info):
+        """:return: type id of the base object of the delta chain starting with the delta
+            at the given offset, whose header is info. Only headers are read, and the
+            result is remembered for all deltas along the chain
+        :raise BadObject: if the chain refers to a base which is not in this pack"""
+        base_type_ids = self._base_type_ids
+        sorted_offsets = self._sorted_offsets
+        cursor = self._pack._cursor
+        chain = []
+        type_id = None
+        while True:
+            pos = bisect_left(sorted_offsets, offset)
+            if pos == len(sorted_offsets) or sorted_offsets[pos] != offset:
+                raise BadObject(sha, "Delta refers to no object at offset %i" % offset)
+            # END handle invalid offset
+            type_id = base_type_ids[pos]
+            if type_id:
+                break
+            # END handle known link
+            chain.append(pos)
+            if info.type_id == OFS_DELTA:
+                offset -= info.delta_info
+            else:
+                index = self._index.sha_to_index(bytes(info.delta_info))
+                if index is None:
+                    raise BadObject(sha, "Could not resolve delta object")
+                # END handle thin pack
+                offset = self._index.offset(index)
+            # END handle delta type
+            info = pack_object_at(cursor, offset, False)[1]
+            if info.type_id not in delta_types:
+                type_id = info.type_id
+                break
+            # END handle base object
+            if len(chain) > len(self._sorted_offsets):
+                raise BadObject(sha, "Delta chain is a cycle")
+            # END handle cycle
+        # END for each link
+
+        for pos in chain:
+            base_type_ids[pos] = type_id
+        # END for each link
+        return type_id
+
+    def _iter_objects(self, as_stream, by_offset=False, madvise=False):
+        """Iterate over all objects in our index and yield their OInfo or OStream instences
+        :param by_offset: if True, objects are yielded in the order of their offsets into
+            the pack, instead of the order of their shas
+        :param madvise: if True and by_offset is True, each window of the pack is
+            hinted to be read sequentially"""
         _sha = self._index.sha
         _object = self._object
-        for index in xrange(self._index.size()):
-            yield _object(_sha(index), as_stream, index)
-        # END for each index
+        if not by_offset:
+            for index in xrange(self._index.size()):
+                yield _object(_sha(index), as_stream, index)
+            # END for each index
+            return
+        # END handle sha order
+
+        cursor = self._pack._cursor
+        advised_map = None
+        for offset, index in izip(self._sorted_offsets, self._offset_indices):
+            if madvise:
+                region_map = cursor.use_region(offset).map()
+                if region_map is not advised_map:
+                    madvise_sequential(region_map)
+                    advised_map = region_map
+                # END handle new window
+            # END handle madvise
+            yield _object(_sha(index), as_stream, index, offset)
+        # END for each offset
 
-    def _object(self, sha, as_stream, index=-1):
+    def _object(self, sha, as_stream, index=-1, offset=None):
         """:return: OInfo or OStream object providing information about the given sha
-        :param index: if not -1, its assumed to be the sha's index in the IndexFile"""
+        :param index: if not -1, its assumed to be the sha's index in the IndexFile
+        :param offset: if not None, its assumed to be the sha's offset into the PackFile,
+            the index is not consulted at all in that case"""
         # its a little bit redundant here, but it needs to be efficient
-        if index < 0:
-            index = self._sha_to_index(sha)
-        if sha is None:
-            sha = self._index.sha(index)
-        # END assure sha is present ( in output )
-        offset = self._index.offset(index)
-        type_id, uncomp_size, _ = pack_object_header_info(
-            self._pack._cursor.use_region(offset).buffer())
+        if offset is None:
+            if index < 0:
+                index = self._sha_to_index(sha)
+            if sha is None:
+                sha = self._index.sha(index)
+            # END assure sha is present ( in output )
+            offset = self._index.offset(index)
+        # END handle offset
         if as_stream:
+            type_id, uncomp_size, _ = pack_object_header_info(
+                self._pack._cursor.use_region(offset).buffer())
             if type_id not in delta_types:
                 packstream = self._pack.stream(offset)
                 return OStream(sha, packstream.type, packstream.size, packstream.stream)
@@ -776,25 +2254,19 @@ class PackEntity(LazyMixin):
             # To prevent it from applying the deltas when querying the size,
             # we extract it from the delta stream ourselves
             streams = self.collect_streams_at_offset(offset)
-            dstream = DeltaApplyReader.new(streams)
+            dstream = DeltaApplyReader.new(streams, self._delta_base_cache, self._pack.path())
 
             return ODeltaStream(sha, dstream.type, None, dstream)
         else:
-            if type_id not in delta_types:
-                return OInfo(sha, type_id_to_type_map[type_id], uncomp_size)
+            data_offset, info = pack_object_at(self._pack._cursor, offset, False)
+            if info.type_id not in delta_types:
+                return OInfo(sha, type_id_to_type_map[info.type_id], info.size)
             # END handle non-deltas
 
-            # deltas are a little tougher - unpack the first bytes to obtain
-            # the actual target size, as opposed to the size of the delta data
-            streams = self.collect_streams_at_offset(offset)
-            buf = streams[0].read(512)
-            offset, src_size = msb_size(buf)  # @UnusedVariable
-            offset, target_size = msb_size(buf, offset)
-
-            # collect the streams to obtain the actual object type
-            if streams[-1].type_id in delta_types:
-                raise BadObject(sha, "Could not resolve delta object")
-            return OInfo(sha, streams[-1].type, target_size)
+            # deltas are a little tougher - the type is the one of the chain's base object,
+            # and the actual size is stored in the first bytes of the delta data
+            type_id = self._base_type_id(sha, offset, info)
+            return OInfo(sha, type_id_to_type_map[type_id], delta_target_size_at(self._pack._cursor, data_offset))
         # END handle stream
 
     #{ Read-Database like Interface
@@ -824,6 +2296,24 @@ class PackEntity(LazyMixin):
         object"""
         return self._object(None, True, index)
 
+    def offset_to_index(self, offset):
+        """
+        :return: index usable with the index' ``sha`` or ``entry`` method for the
+            object at the given offset into the pack, or None if no object starts there"""
+        pos = bisect_left(self._sorted_offsets, offset)
+        if pos < len(self._sorted_offsets) and self._sorted_offsets[pos] == offset:
+            return self._offset_indices[pos]
+        return None
+
+    def info_at_offset(self, sha, offset):
+        """As ``info``, but uses the known offset of the object into the pack, as
+        obtained from a MultiPackIndexFile for instance"""
+        return self._object(sha, False, offset=offset)
+
+    def stream_at_offset(self, sha, offset):
+        """As ``stream``, but uses the known offset of the object into the pack"""
+        return self._object(sha, True, offset=offset)
+
     #} END Read-Database like Interface
 
     #{ Interface
@@ -832,6 +2322,31 @@ class PackEntity(LazyMixin):
         """:return: the underlying pack file instance"""
         return self._pack
 
+    def reverse_index(self):
+        """:return: the underlying reverse index file instance, whose file might not exist"""
+        return self._rev_index
+
+    def delta_base_cache(self):
+        """:return: DeltaBaseCache used when resolving deltas, or None"""
+        return self._delta_base_cache
+
+    def write_reverse_index(self):
+        """Write a reverse index in git's .rev format next to our pack, which will be
+        used by future instances to map offsets to objects
+
+        :return: path to the written reverse index file"""
+        rev_path = self._rev_index.path()
+        lfd = LockedFD(rev_path)
+        fd = lfd.open(write=True)
+        try:
+            write_reverse_index(self._index.offsets(), self._index.packfile_checksum(), lambda d: os.write(fd, d))
+        except:
+            lfd.rollback()
+            raise
+        # END handle write failure
+        lfd.commit()
+        return rev_path
+
     def index(self):
         """:return: the underlying pack index file instance"""
         return self._index
@@ -861,7 +2376,7 @@ class PackEntity(LazyMixin):
 
             index = self._sha_to_index(sha)
             offset = self._index.offset(index)
-            next_offset = self._offset_map[offset]
+            next_offset = self._next_offset(offset)
             crc_value = self._index.crc(index)
 
             # create the current crc value, on the compressed object data
@@ -891,17 +2406,295 @@ class PackEntity(LazyMixin):
         # END handle crc/sha verification
         return True
 
-    def info_iter(self):
+    def info_iter(self, by_offset=False, madvise=False):
         """
         :return: Iterator over all objects in this pack. The iterator yields
-            OInfo instances"""
-        return self._iter_objects(as_stream=False)
-
-    def stream_iter(self):
+            OInfo instances
+        :param by_offset: if True, objects are yielded in the order they are stored
+            in the pack, instead of the order of their shas. This reads the pack
+            sequentially, which is much faster if it isn't cached yet
+        :param madvise: if True and by_offset is True, tell the kernel that we read
+            the pack sequentially, if the platform supports it"""
+        return self._iter_objects(as_stream=False, by_offset=by_offset, madvise=madvise)
+
+    def stream_iter(self, by_offset=False, madvise=False):
         """
         :return: iterator over all objects in this pack. The iterator yields
-            OStream instances"""
-        return self._iter_objects(as_stream=True)
+            OStream instances
+        :param by_offset: see ``info_iter``
+        :param madvise: see ``info_iter``"""
+        return self._iter_objects(as_stream=True, by_offset=by_offset, madvise=madvise)
+
+    def object_records(self):
+        """
+        :return: PackObjectRecords with information about all objects in this pack.
+            Only object headers are read, no object is decompressed
+        :raise ParseError: if delta bases form a cycle"""
+        cursor = self._pack._cursor
+        index = self._index
+        offsets = self._sorted_offsets
+        num_objects = len(offsets)
+
+        type_ids = array.array('B', repeat(0, num_objects))
+        sizes = array.array(uint64_typecode)
+        base_positions = array.array('l', repeat(-1, num_objects))
+        for pos, offset in enumerate(offsets):
+            info = pack_object_at(cursor, offset, False)[1]
+            type_ids[pos] = info.type_id
+            sizes.append(info.size)
+            if info.type_id == OFS_DELTA:
+                base_offset = offset - info.delta_info
+            elif info.type_id == REF_DELTA:
+                base_index = index.sha_to_index(bytes(info.delta_info))
+                if base_index is None:
+                    continue
+                # END handle thin pack
+                base_offset = index.offset(base_index)
+            else:
+                continue
+            # END handle type
+            base_pos = bisect_left(offsets, base_offset)
+            if base_pos < num_objects and offsets[base_pos] == base_offset:
+                base_positions[pos] = base_pos
+            # END handle existing base
+        # END for each object
+
+        # walk each chain up to the first object we know about, and assign depth and
+        # type to all of its links on the way back. Each object is visited once only
+        depths = array.array('I', repeat(0, num_objects))
+        for pos in xrange(num_objects):
+            if type_ids[pos] not in delta_types or depths[pos]:
+                continue
+            # END skip known objects
+            chain = []
+            base_pos = pos
+            while base_pos != -1 and type_ids[base_pos] in delta_types and not depths[base_pos]:
+                chain.append(base_pos)
+                if len(chain) > num_objects:
+                    raise ParseError("Delta chain at offset %i of pack %s is a cycle"
+                                     % (offsets[pos], self._pack.path()))
+                # END handle cycle
+                base_pos = base_positions[base_pos]
+            # END for each link
+
+            if base_pos == -1:
+                # missing base, the last link keeps its delta type
+                depth = 0
+                type_id = type_ids[chain[-1]]
+            else:
+                depth = depths[base_pos]
+                type_id = type_ids[base_pos]
+            # END handle chain end
+            for link_pos in reversed(chain):
+                depth += 1
+                depths[link_pos] = depth
+                type_ids[link_pos] = type_id
+            # END for each link
+        # END for each object
+
+        packed_sizes = array.array(uint64_typecode, (next_offset - offset for offset, next_offset in
+                                                     izip(offsets, offsets[1:])))
+        packed_sizes.append(cursor.file_size() - self._pack.footer_size - offsets[-1])
+        base_offsets = array.array(uint64_typecode, (base_pos != -1 and offsets[base_pos] or 0
+                                                     for base_pos in base_positions))
+
+        return PackObjectRecords(offsets, self._offset_indices, type_ids, sizes,
+                                 packed_sizes, depths, base_offsets)
+
+    def stats(self):
+        """
+        :return: dict with statistics about the objects in this pack, as obtained from
+            ``object_records``:
+
+            * objects - amount of objects
+            * deltas - amount of deltified objects
+            * types - dict(type: amount of objects)
+            * chain_lengths - dict(chain length: amount of deltas)
+            * sizes - dict(type: dict(bits: amount of objects)) with the amount of
+              bits required to represent the object size, i.e. objects with a size
+              smaller than 2**bits, but no smaller than 2**(bits-1)
+            * packed_sizes - dict(type: bytes taken by all objects in the pack)"""
+        records = self.object_records()
+        types = dict()
+        chain_lengths = dict()
+        sizes = dict()
+        packed_sizes = dict()
+        for type_id, size, packed_size, depth in izip(records.type_ids, records.sizes,
+                                                      records.packed_sizes, records.depths):
+            type_name = type_id_to_type_map[type_id]
+            types[type_name] = types.get(type_name, 0) + 1
+            if depth:
+                chain_lengths[depth] = chain_lengths.get(depth, 0) + 1
+            # END handle delta
+            type_sizes = sizes.setdefault(type_name, dict())
+            bits = bit_length(size)
+            type_sizes[bits] = type_sizes.get(bits, 0) + 1
+            packed_sizes[type_name] = packed_sizes.get(type_name, 0) + packed_size
+        # END for each object
+
+        return dict(objects=len(records),
+                    deltas=sum(chain_lengths.values()),
+                    types=types,
+                    chain_lengths=chain_lengths,
+                    sizes=sizes,
+                    packed_sizes=packed_sizes)
+
+    def resolved_iter(self):
+        """
+        :return: iterator yielding OStream instances of all objects in this pack, reading
+            from their resolved data in memory.
+            Delta trees are resolved depth-first from their base object, each object
+            serving as base for all of its deltas, which keeps only the objects along one
+            delta chain in memory. Trees are visited in the order of their base objects'
+            offsets into the pack
+        :raise BadObject: if a delta refers to a base which is not in this pack"""
+        children, roots, orphans = self._delta_trees()
+        if orphans:
+            raise BadObject(self._index.sha(self.offset_to_index(orphans[0])), "Could not resolve delta object")
+        # END handle thin pack
+
+        inflate = self._inflate_function()
+        no_children = ()
+        deltas_of = lambda offset, sha: children.get(offset, no_children)
+        for root, type_id in roots:
+            for offset, type_id, sha, data in iter_delta_tree(inflate, deltas_of, root, type_id, inflate(root)):
+                yield OStream(sha, type_id_to_type_map[type_id], len(data), BytesIO(data))
+            # END for each object in tree
+        # END for each tree
+
+    def verify(self, use_crc=True, part=0, parts=1):
+        """
+        Verify this pack and its index entirely. This checks the checksums of both files,
+        the crc of each object's compressed data if the index provides them, and the sha
+        of each object, which is computed by resolving all delta trees like ``resolved_iter``.
+        Unlike ``is_valid_stream``, each delta chain is resolved only once.
+
+        :param use_crc: if False, crcs are not checked
+        :param part: the work can be split up into parts, to be verified concurrently,
+            like in different processes. Each part checks every parts-th crc and delta
+            tree, starting at the part'th one. The checksums of the files and the objects
+            in no tree at all are checked by part 0
+        :param parts: amount of parts the work is split up into
+        :return: list of tuple(binsha, kind, message) for each problem found, which is empty
+            if all is well. binsha is None if the problem concerns a file as a whole. kind
+            is one of 'pack_checksum', 'index_checksum', 'crc', 'sha' and 'object', the
+            latter denoting objects which could not be resolved at all"""
+        index = self._index
+        problems = []
+        if part == 0:
+            if not self._pack.verify_checksum():
+                problems.append((None, 'pack_checksum', "Checksum of pack %s does not match its contents"
+                                 % self._pack.path()))
+            # END check pack
+            if not index.verify_checksum():
+                problems.append((None, 'index_checksum', "Checksum of index %s does not match its contents"
+                                 % index.path()))
+            # END check index
+            if bytes(index.packfile_checksum()) != bytes(self._pack.checksum()):
+                problems.append((None, 'index_checksum', "Index %s was made for another pack than %s"
+                                 % (index.path(), self._pack.path())))
+            # END check index belongs to pack
+        # END handle file checksums
+
+        if use_crc and index.version() >= 2:
+            cursor = self._pack._cursor
+            null_write = lambda data: None
+            for i in xrange(part, index.size(), parts):
+                offset = index.offset(i)
+                crc = copy_pack_data(cursor, offset, self._next_offset(offset), null_write, 0)
+                if crc & 0xffffffff != index.crc(i):
+                    problems.append((bytes(index.sha(i)), 'crc', "Crc of the compressed data doesn't match the index"))
+                # END handle crc mismatch
+            # END for each object
+        # END handle crcs
+
+        sha_at = lambda offset: bytes(index.sha(self.offset_to_index(offset)))
+        children, roots, orphans = self._delta_trees()
+        no_children = ()
+
+        def tree_offsets(root):
+            stack = [root]
+            while stack:
+                offset = stack.pop()
+                yield offset
+                stack.extend(children.get(offset, no_children))
+            # END while there are offsets
+        # END tree_offsets
+
+        inflate = self._inflate_function()
+        deltas_of = lambda offset, sha: children.get(offset, no_children)
+        for root, type_id in roots[part::parts]:
+            resolved = set()
+            try:
+                for offset, type_id, sha, data in iter_delta_tree(inflate, deltas_of, root, type_id, inflate(root)):
+                    resolved.add(offset)
+                    if sha != sha_at(offset):
+                        problems.append((sha_at(offset), 'sha', "Object data doesn't match its sha"))
+                    # END handle sha mismatch
+                # END for each object in tree
+            except Exception as exc:
+                for offset in tree_offsets(root):
+                    if offset not in resolved:
+                        problems.append((sha_at(offset), 'object', "Object could not be resolved: %s" % exc))
+                    # END handle unresolved object
+                # END for each object in tree
+            # END handle corrupted tree
+        # END for each tree
+
+        if part == 0:
+            in_tree = set()
+            for root, type_id in roots:
+                in_tree.update(tree_offsets(root))
+            # END for each tree
+            for offset in self._sorted_offsets:
+                if offset not in in_tree:
+                    problems.append((sha_at(offset), 'object', "Base object of delta is not in the pack"))
+                # END handle orphan
+            # END for each object
+        # END handle objects without base
+        return problems
+
+    def _delta_trees(self):
+        """:return: tuple(children, roots, orphans) describing the delta trees of this pack,
+            as read from the object headers. children is a dict mapping base offsets to the
+            offsets of their deltas, roots a list of tuple(offset, type_id) of all base
+            objects, and orphans a list of offsets of REF_DELTAs whose base isn't in this pack"""
+        cursor = self._pack._cursor
+        index = self._index
+        children = dict()
+        roots = []
+        orphans = []
+        for offset in self._sorted_offsets:
+            info = pack_object_at(cursor, offset, False)[1]
+            if info.type_id == OFS_DELTA:
+                base_offset = offset - info.delta_info
+            elif info.type_id == REF_DELTA:
+                base_index = index.sha_to_index(bytes(info.delta_info))
+                if base_index is None:
+                    orphans.append(offset)
+                    continue
+                # END handle thin pack
+                base_offset = index.offset(base_index)
+            else:
+                roots.append((offset, info.type_id))
+                continue
+            # END handle type
+            children.setdefault(base_offset, []).append(offset)
+        # END for each object
+        return children, roots, orphans
+
+    def _inflate_function(self):
+        """:return: function inflate(offset) returning the decompressed data of the object
+            at the given offset, which is the delta for deltas"""
+        cursor = self._pack._cursor
+        read = lambda offset, size: bytes(cursor.use_region(offset, size).buffer())
+
+        def inflate(offset):
+            chunks = []
+            inflate_at(read, pack_object_at(cursor, offset, False)[0], chunks.append)
+            return b''.join(chunks)
+        # END inflate
+        return inflate
 
     def collect_streams_at_offset(self, offset):
         """
@@ -950,7 +2743,9 @@ class PackEntity(LazyMixin):
 
     @classmethod
     def write_pack(cls, object_iter, pack_write, index_write=None,
-                   object_count=None, zlib_compression=zlib.Z_BEST_SPEED):
+                   object_count=None, zlib_compression=zlib.Z_BEST_SPEED,
+                   window=0, depth=50, name_hints=None, reuse=None,
+                   threads=None, max_pending_size=64 * 1024 ** 2, thin_bases=None):
         """
         Create a new pack by putting all objects obtained by the object_iterator
         into a pack which is written using the pack_write method.
@@ -964,13 +2759,32 @@ class PackEntity(LazyMixin):
             this would be the place to put it. Otherwise we have to pre-iterate and store
             all items into a list to get the number, which uses more memory than necessary.
         :param zlib_compression: the zlib compression level to use
+        :param window: if not 0, the amount of similar objects each object is tried to
+            be deltified against, see ``deltify_objects``. All objects are kept in
+            memory then. 10 is what git uses by default
+        :param depth: maximum length of the delta chains to produce
+        :param name_hints: if not None, dict(binsha: path) of the objects, which helps
+            finding bases for deltas
+        :param reuse: if not None, a sequence of entered PackEntity instances the objects
+            may be contained in. Their compressed data is copied as is if they are no delta,
+            or a delta against another one of the objects, see ``find_reusable_objects``.
+            Their streams are not read then. All objects are kept in memory
+        :param threads: amount of threads compressing objects concurrently, or None to use
+            one per cpu. With 1, all objects are compressed on the calling thread
+        :param max_pending_size: amount of bytes of objects which may be compressed
+            concurrently. Larger objects are compressed on the calling thread
+        :param thin_bases: if not None, iterable of OStream instances the receiver of the
+            pack is known to have. If a window is given, they serve as bases of REF_DELTAs
+            without being written themselves, which produces a thin pack. Its receiver
+            has to complete it, see ``fix_thin_pack``
         :return: tuple(pack_sha, index_binsha) binary sha over all the contents of the pack
             and over all contents of the index. If index_write was None, index_binsha will be None
 
         **Note:** The destination of the write functions is up to the user. It could
         be a socket, or a file for instance
 
-        **Note:** writes only undeltified objects"""
+        **Note:** deltas are written as OFS_DELTA, following their base object, unless
+        they are reused REF_DELTAs, or deltas against thin_bases"""
         objs = object_iter
         if not object_count:
             if not isinstance(object_iter, (tuple, list)):
@@ -979,60 +2793,178 @@ class PackEntity(LazyMixin):
             object_count = len(objs)
         # END handle object
 
-        with FlexibleSha1Writer(pack_write) as pack_writer:
-            pwrite = pack_writer.write
-            ofs = 0                                         # current offset into the pack file
-            index = None
-            wants_index = index_write is not None
-
-            # write header
-            pwrite(pack('>LLL', PackFile.pack_signature, PackFile.pack_version_default, object_count))
-            ofs += 12
-
-            if wants_index:
-                index = IndexWriter()
-            # END handle index header
-
-            actual_count = 0
-            for obj in objs:
-                actual_count += 1
-                crc = 0
-
-                # object header
-                hdr = create_pack_object_header(obj.type_id, obj.size)
-                if index_write:
-                    crc = crc32(hdr)
-                else:
-                    crc = None
-                # END handle crc
-                pwrite(hdr)
-
-                # data stream
-                zstream = zlib.compressobj(zlib_compression)
-                ostream = obj.stream
-                br, bw, crc = write_stream_to_pack(ostream.read, pwrite, zstream, base_crc=crc)
-                assert(br == obj.size)
-                if wants_index:
-                    index.append(obj.binsha, crc, ofs)
-                # END handle index
-
-                ofs += len(hdr) + bw
-                if actual_count == object_count:
-                    break
-                # END abort once we are done
-            # END for each object
-
-            if actual_count != object_count:
+        # objects are planned if we deltify or reuse them. Each one is either copied from
+        # the source of its reused data, written from its deltified entry, or as it is
+        entries = None
+        sources = None
+        if window > 0 or reuse:
+            objs = list(islice(objs, object_count))
+            if len(objs) != object_count:
                 raise ValueError("Expected to write %i objects into pack, "
                                  "but received only %i from iterators" %
-                                 (object_count, actual_count))
+                                 (object_count, len(objs)))
             # END count assertion
 
-            # write footer
-            pack_sha = pack_writer.sha(as_hex=False)
-            assert len(pack_sha) == 20
-            pack_write(pack_sha)
-            ofs += len(pack_sha)                            # just for completeness ;)
+            sources = [None] * object_count
+            if reuse:
+                sources = find_reusable_objects(objs, reuse)
+            # END find reusable objects
+            entries = [None] * object_count
+            if window > 0:
+                shas = set(obj.binsha for obj in objs)
+                thin_bases = [obj for obj in thin_bases or () if obj.binsha not in shas]
+                positions = [pos for pos in xrange(object_count) if sources[pos] is None]
+                for pos, entry in izip(positions, deltify_objects([objs[pos] for pos in positions],
+                                                                  window, depth, name_hints, thin_bases)):
+                    if entry[3] >= len(positions):
+                        # thin bases follow the objects
+                        entry = entry[:3] + (object_count + entry[3] - len(positions),) + entry[4:]
+                    elif entry[3] != -1:
+                        entry = entry[:3] + (positions[entry[3]],) + entry[4:]
+                    # END translate base position
+                    entries[pos] = entry
+                # END for each deltified object
+            # END search deltas
+        # END plan objects
+
+        pool, threads = compression_pool(threads)
+        # objects are compressed concurrently in memory, unless they are too large to
+        # keep the compressed data of the other threads within the limit
+        max_object_size = max_pending_size // threads
+        try:
+            with FlexibleSha1Writer(pack_write) as pack_writer:
+                pwrite = pack_writer.write
+                ofs = 0                                         # current offset into the pack file
+                index = None
+                wants_index = index_write is not None
+
+                # write header
+                pwrite(pack('>LLL', PackFile.pack_signature, PackFile.pack_version_default, object_count))
+                ofs += 12
+
+                if wants_index:
+                    index = IndexWriter()
+                # END handle index header
+
+                if entries is not None:
+                    def base_position(pos):
+                        if sources[pos] is not None:
+                            return sources[pos][3]
+                        if entries[pos] is not None and entries[pos][3] < object_count:
+                            return entries[pos][3]
+                        return -1
+                    # END base_position
+
+                    # bases go first, as OFS_DELTAs can only point back
+                    order = []
+                    ordered = [False] * object_count
+                    for entry_pos in xrange(object_count):
+                        chain = []
+                        pos = entry_pos
+                        while pos != -1 and not ordered[pos]:
+                            if pos in chain:
+                                # reused deltas of different packs may form a cycle, which
+                                # we break by writing the first link as it is
+                                del chain[chain.index(pos) + 1:]
+                                sources[pos] = None
+                                break
+                            # END handle cycle
+                            chain.append(pos)
+                            pos = base_position(pos)
+                        # END for each unordered link
+                        for pos in reversed(chain):
+                            ordered[pos] = True
+                            order.append(pos)
+                        # END for each link
+                    # END for each entry
+
+                    def iter_data():
+                        for pos in order:
+                            if sources[pos] is not None:
+                                yield pos, None
+                            elif entries[pos] is not None:
+                                yield pos, entries[pos][4] or entries[pos][2]
+                            elif pool is not None and objs[pos].size <= max_object_size:
+                                yield pos, objs[pos].stream.read()
+                            else:
+                                yield pos, None
+                            # END handle object kind
+                        # END for each position
+                    # END iter_data
+
+                    offsets = [None] * object_count
+                    for pos, compressed in iter_compressed(iter_data(), zlib_compression, pool, max_pending_size):
+                        if sources[pos] is not None:
+                            entity, src_offset, src_index, base_pos = sources[pos]
+                            cursor = entity.pack()._cursor
+                            end = entity._next_offset(src_offset)
+                            data_offset, info = pack_object_at(cursor, src_offset, False)
+                            if info.type_id == OFS_DELTA:
+                                hdr = create_pack_object_header(OFS_DELTA, info.size)
+                                hdr += create_ofs_delta_offset(ofs - offsets[base_pos])
+                                pwrite(hdr)
+                                crc = copy_pack_data(cursor, data_offset, end, pwrite, crc32(hdr))
+                                size = len(hdr) + end - data_offset
+                            else:
+                                # header and data are the same, and so is their crc
+                                if wants_index and entity.index().version() < 2:
+                                    crc = copy_pack_data(cursor, src_offset, end, pwrite, 0)
+                                else:
+                                    copy_pack_data(cursor, src_offset, end, pwrite)
+                                    crc = entity.index().crc(src_index)
+                                # END handle index version
+                                size = end - src_offset
+                            # END handle offset delta
+                        elif entries[pos] is not None:
+                            binsha, type_id, data, base_pos, delta = entries[pos]
+                            if delta is None:
+                                hdr = create_pack_object_header(type_id, len(data))
+                            elif base_pos >= object_count:
+                                hdr = create_pack_object_header(REF_DELTA, len(delta))
+                                hdr += thin_bases[base_pos - object_count].binsha
+                            else:
+                                hdr = create_pack_object_header(OFS_DELTA, len(delta))
+                                hdr += create_ofs_delta_offset(ofs - offsets[base_pos])
+                            # END handle delta
+                            pwrite(hdr)
+                            pwrite(compressed)
+                            crc = crc32(compressed, crc32(hdr))
+                            size = len(hdr) + len(compressed)
+                        else:
+                            crc, size = write_pack_object(objs[pos], pwrite, zlib_compression, wants_index,
+                                                          compressed)
+                        # END handle object kind
+
+                        if wants_index:
+                            index.append(objs[pos].binsha, crc, ofs)
+                        # END handle index
+                        offsets[pos] = ofs
+                        ofs += size
+                    # END for each object
+                    actual_count = object_count
+                else:
+                    actual_count, ofs = write_pack_objects(islice(objs, object_count), pwrite, index,
+                                                           zlib_compression, ofs, pool, max_pending_size,
+                                                           max_object_size)
+                # END handle planned objects
+
+                if actual_count != object_count:
+                    raise ValueError("Expected to write %i objects into pack, "
+                                     "but received only %i from iterators" %
+                                     (object_count, actual_count))
+                # END count assertion
+
+                # write footer
+                pack_sha = pack_writer.sha(as_hex=False)
+                assert len(pack_sha) == 20
+                pack_write(pack_sha)
+                ofs += len(pack_sha)                            # just for completeness ;)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            # END handle pool
+        # END shutdown pool
 
         index_sha = None
         if wants_index:
@@ -1042,7 +2974,67 @@ class PackEntity(LazyMixin):
         return pack_sha, index_sha
 
     @classmethod
-    def create(cls, mman, object_iter, base_dir, object_count=None, zlib_compression=zlib.Z_BEST_SPEED):
+    def write_pack_file(cls, object_iter, pack_file, index_write=None, zlib_compression=zlib.Z_BEST_SPEED,
+                        threads=None, max_pending_size=64 * 1024 ** 2):
+        """
+        Write a new pack of all objects obtained by object_iter into the given file, without
+        knowing their amount upfront. This allows streaming any amount of objects in constant
+        memory. Once all objects are written, the object count in the pack's header is fixed
+        and the pack is read again to compute its checksum.
+        Files which can't be read and seeked, like pipes, receive the pack once it was
+        completed in a temporary file.
+
+        :param pack_file: file object to write the pack into, starting at its current position
+        :return: tuple(pack_sha, index_binsha), see ``write_pack``
+
+        **Note:** objects are not deltified, see ``write_pack`` for the other parameters"""
+        if not is_random_access(pack_file):
+            spool = tempfile.TemporaryFile()
+            try:
+                shas = cls.write_pack_file(object_iter, spool, index_write, zlib_compression,
+                                           threads, max_pending_size)
+                spool.seek(0)
+                while True:
+                    chunk = spool.read(chunk_size)
+                    if not chunk:
+                        break
+                    pack_file.write(chunk)
+                # END copy loop
+            finally:
+                spool.close()
+            # END handle spool
+            return shas
+        # END handle sequential files
+
+        start = pack_file.tell()
+        pack_file.write(pack('>LLL', PackFile.pack_signature, PackFile.pack_version_default, 0))
+        index = None
+        if index_write is not None:
+            index = IndexWriter()
+        # END handle index
+
+        pool, threads = compression_pool(threads)
+        try:
+            object_count, end = write_pack_objects(object_iter, pack_file.write, index, zlib_compression, 12,
+                                                   pool, max_pending_size, max_pending_size // threads)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            # END handle pool
+        # END shutdown pool
+
+        pack_sha = finalize_pack_file(pack_file, start, end, object_count)
+
+        index_sha = None
+        if index is not None:
+            index_sha = index.write(pack_sha, index_write)
+        # END handle index
+        return pack_sha, index_sha
+
+    @classmethod
+    def create(cls, mman, object_iter, base_dir, object_count=None, zlib_compression=zlib.Z_BEST_SPEED,
+               window=0, depth=50, name_hints=None, reuse=None, threads=None):
         """Create a new on-disk entity comprised of a properly named pack file and a properly named
         and corresponding index file. The pack contains all OStream objects contained in object iter.
 
@@ -1050,23 +3042,286 @@ class PackEntity(LazyMixin):
         :param base_dir: directory which is to contain the files
         :return: PackEntity instance initialized with the new pack
 
-        **Note:** for more information on the other parameters see the write_pack method"""
+        **Note:** for more information on the other parameters see the write_pack method.
+        If neither object_count nor a list of objects is given, and objects are neither
+        deltified nor reused, they are streamed using ``write_pack_file``"""
         pack_fd, pack_path = tempfile.mkstemp('', 'pack', base_dir)
         index_fd, index_path = tempfile.mkstemp('', 'index', base_dir)
-        pack_write = lambda d: os.write(pack_fd, d)
-        index_write = lambda d: os.write(index_fd, d)
-
-        pack_binsha, _ = cls.write_pack(
-            object_iter, pack_write, index_write, object_count, zlib_compression)
-        os.close(pack_fd)
-        os.close(index_fd)
+        try:
+            with os.fdopen(pack_fd, 'w+b') as pack_file:
+                with os.fdopen(index_fd, 'wb') as index_file:
+                    if not (object_count or isinstance(object_iter, (tuple, list)) or window > 0 or reuse):
+                        pack_binsha, _ = cls.write_pack_file(object_iter, pack_file, index_file.write,
+                                                             zlib_compression, threads)
+                    else:
+                        pack_binsha, _ = cls.write_pack(
+                            object_iter, pack_file.write, index_file.write, object_count, zlib_compression,
+                            window, depth, name_hints, reuse, threads)
+                    # END handle streaming
+                # END with index file
+            # END with pack file
+        except:
+            # don't leave incomplete files behind
+            for path in (pack_path, index_path):
+                os.remove(path)
+            # END for each temporary file
+            raise
+        # END handle write failure
 
         fmt = "pack-%s.%s"
-        new_pack_path = os.path.join(base_dir, fmt % (bin_to_hex(pack_binsha), 'pack'))
-        new_index_path = os.path.join(base_dir, fmt % (bin_to_hex(pack_binsha), 'idx'))
-        os.rename(pack_path, new_pack_path)
+        new_pack_path = os.path.join(base_dir, fmt % (force_text(bin_to_hex(pack_binsha)), 'pack'))
+        new_index_path = os.path.join(base_dir, fmt % (force_text(bin_to_hex(pack_binsha)), 'idx'))
+        # packs are found by their name, hence the index must be in place first
         os.rename(index_path, new_index_path)
+        os.rename(pack_path, new_pack_path)
 
         return cls(mman, new_pack_path)
 
+    @classmethod
+    def index_pack(cls, mman, pack_path, workers=0, odb=None):
+        """Write the index for the pack at the given path, as obtained from other tools.
+        The pack is scanned once to collect the crcs and the shas of all base objects,
+        the shas of deltas are obtained by resolving all delta trees afterwards.
+
+        :param mman: use :func:`smmap.managed_mmaps()` as a context-manager
+        :param pack_path: path to the pack file. The index is written next to it, using
+            the .idx extension
+        :param workers: if larger than 0, the amount of threads resolving delta trees.
+            Decompression and hashing release the GIL, which makes it worthwhile on
+            multi-core machines
+        :param odb: if not None, database to complete thin packs with, see ``fix_thin_pack``
+        :return: PackEntity instance initialized with the pack and its new index, which is
+            a new pack if a thin pack was completed
+        :raise ParseError: if the pack is corrupted, or contains deltas whose base is
+            not part of the pack, nor of odb"""
+        with cls.PackFileCls(mman, pack_path) as packfile:
+            cursor = packfile._cursor
+            read = lambda offset, size: bytes(cursor.use_region(offset, size).buffer())
+            content_size = cursor.file_size() - packfile.footer_size
+            pack_sha = bytes(packfile.checksum())
+
+            offsets = []            # offset of each object
+            data_offsets = []       # offset of the compressed data of each object
+            type_ids = []           # type id of each object, the base object type for deltas
+            crcs = []
+            shas = []               # binary sha of each object, None for unresolved deltas
+            ofs_children = dict()   # base offset -> list of indices of OFS deltas
+            ref_children = dict()   # base sha -> list of indices of REF deltas
+            roots = []              # indices of base objects with deltas
+
+            null_write = NullStream().write
+            offset = packfile.first_object_offset
+            for index in xrange(packfile.size()):
+                if offset >= content_size:
+                    raise ParseError("Pack contains %i objects, expected %i" % (index, packfile.size()))
+                # END handle truncated pack
+                data_offset, info = pack_object_at(cursor, offset, False)
+                type_id = info.type_id
+                sha = None
+                if type_id == OFS_DELTA:
+                    ofs_children.setdefault(offset - info.delta_info, []).append(index)
+                    write = null_write
+                elif type_id == REF_DELTA:
+                    ref_children.setdefault(bytes(info.delta_info), []).append(index)
+                    write = null_write
+                else:
+                    sha = make_sha(loose_object_header(type_id_to_type_map[type_id], info.size))
+                    write = sha.update
+                # END handle type
+
+                end_offset, size, crc = inflate_at(read, data_offset, write,
+                                                   crc32(read(offset, data_offset - offset)))
+                if size != info.size:
+                    raise ParseError("Object at offset %i has %i bytes, expected %i" % (offset, size, info.size))
+                # END handle size mismatch
+                if sha is not None:
+                    sha = sha.digest()
+                # END finalize sha
+
+                offsets.append(offset)
+                data_offsets.append(data_offset)
+                type_ids.append(type_id)
+                crcs.append(crc)
+                shas.append(sha)
+                offset = end_offset
+            # END for each object
+
+            for index, sha in enumerate(shas):
+                if sha is not None and (offsets[index] in ofs_children or sha in ref_children):
+                    roots.append(index)
+                # END handle root
+            # END for each object
+
+            def children(index, sha):
+                return ofs_children.get(offsets[index], []) + ref_children.get(sha, [])
+
+            def resolve(read, roots):
+                def inflate(index):
+                    chunks = []
+                    inflate_at(read, data_offsets[index], chunks.append)
+                    return b''.join(chunks)
+                # END inflate
+
+                resolved = []
+                for root in roots:
+                    for index, type_id, sha, data in iter_delta_tree(inflate, children, root,
+                                                                     type_ids[root], inflate(root)):
+                        if index != root:
+                            resolved.append((index, sha))
+                    # END for each resolved delta
+                # END for each root
+                return resolved
+
+            if workers > 0:
+                # cursors may not be shared among threads, each job reads from its own file
+                def resolve_from_file(roots):
+                    with open(pack_path, 'rb') as fp:
+                        def read_file(offset, size):
+                            fp.seek(offset)
+                            return fp.read(size)
+                        return resolve(read_file, roots)
+                    # END with file
+
+                pool = ThreadPool(workers)
+                try:
+                    results = pool.map(resolve_from_file, [roots[i::workers] for i in xrange(workers)])
+                finally:
+                    pool.close()
+                    pool.join()
+                # END handle pool
+            else:
+                results = [resolve(read, roots)]
+            # END handle workers
+        # END with pack
+
+        for resolved in results:
+            for index, sha in resolved:
+                shas[index] = sha
+            # END for each resolved delta
+        # END for each result
+
+        if odb is not None and None in shas:
+            pack_path, pack_sha = cls._complete_thin_pack(pack_path, content_size, odb, offsets, data_offsets,
+                                                          crcs, shas, children, ref_children)
+        # END handle thin packs
+
+        num_unresolved = shas.count(None)
+        if num_unresolved:
+            raise ParseError("%i deltas of pack at %s could not be resolved, their bases are not in the pack"
+                             % (num_unresolved, pack_path))
+        # END handle thin packs
+
+        index_writer = IndexWriter()
+        for sha, crc, offset in izip(shas, crcs, offsets):
+            index_writer.append(sha, crc, offset)
+        # END for each object
+
+        index_path = "%s.idx" % os.path.splitext(pack_path)[0]
+        lfd = LockedFD(index_path)
+        fd = lfd.open(write=True)
+        try:
+            index_writer.write(pack_sha, lambda d: os.write(fd, d))
+        except:
+            lfd.rollback()
+            raise
+        # END handle write failure
+        lfd.commit()
+
+        return cls(mman, pack_path)
+
+    @classmethod
+    def fix_thin_pack(cls, mman, pack_path, odb, workers=0):
+        """Complete the thin pack at the given path, and write its index.
+        The bases of its REF_DELTAs which are not part of the pack are obtained from
+        the given database, and appended to a copy of the pack as they are, whose object
+        count in the header and trailing checksum are rewritten accordingly. The copy is
+        named after its checksum, like pack-<sha>.pack, in the directory of the thin pack.
+
+        :param odb: database containing the bases missing in the pack, like a GitDB
+        :return: PackEntity instance initialized with the completed pack and its index
+        :raise ParseError: if a base is neither part of the pack nor of odb
+
+        **Note:** the thin pack is left as it is, a pack which isn't thin is just indexed.
+        See ``index_pack`` for the other parameters"""
+        return cls.index_pack(mman, pack_path, workers, odb)
+
+    @classmethod
+    def _complete_thin_pack(cls, pack_path, content_size, odb, offsets, data_offsets, crcs, shas,
+                            children, ref_children):
+        """Copy the thin pack, append the bases of its unresolved REF_DELTAs found in odb,
+        and resolve the delta trees below them. The given lists are extended with the
+        appended objects.
+
+        :return: tuple(path, binary sha) of the completed pack"""
+        known = set(sha for sha in shas if sha is not None)
+        base_dir = os.path.dirname(pack_path)
+        fd, tmp_path = tempfile.mkstemp('', 'pack', base_dir or None)
+        try:
+            with os.fdopen(fd, 'w+b') as fp:
+                # the thin pack may be mapped already, hence we write a new file
+                with open(pack_path, 'rb') as thin_fp:
+                    remaining = content_size
+                    while remaining:
+                        chunk = thin_fp.read(min(chunk_size, remaining))
+                        if not chunk:
+                            raise ParseError("Pack at %s was truncated while reading it" % pack_path)
+                        # END handle truncation
+                        fp.write(chunk)
+                        remaining -= len(chunk)
+                    # END copy loop
+                # END with thin pack
+
+                def read(offset, size):
+                    fp.seek(offset)
+                    return fp.read(size)
+                # END read
+
+                def inflate(index):
+                    chunks = []
+                    inflate_at(read, data_offsets[index], chunks.append)
+                    return b''.join(chunks)
+                # END inflate
+
+                end = content_size
+                # like git, bases are appended in the order of their first delta
+                for base_sha, indices in sorted(ref_children.items(), key=lambda item: item[1][0]):
+                    if base_sha in known or all(shas[index] is not None for index in indices):
+                        continue
+                    # END skip bases in the pack, and those resolved meanwhile
+                    if not odb.has_object(base_sha):
+                        continue
+                    # END leave unresolvable deltas to the caller
+
+                    ostream = odb.stream(base_sha)
+                    data = ostream.read()
+                    fp.seek(end)
+                    crc, size = write_pack_object(ostream, fp.write, zlib.Z_BEST_SPEED, True,
+                                                  zlib.compress(data, zlib.Z_BEST_SPEED))
+                    root = len(shas)
+                    offsets.append(end)
+                    data_offsets.append(end + len(create_pack_object_header(ostream.type_id, ostream.size)))
+                    crcs.append(crc)
+                    shas.append(base_sha)
+                    known.add(base_sha)
+                    end += size
+
+                    for index, type_id, sha, _ in iter_delta_tree(inflate, children, root, ostream.type_id, data):
+                        if index != root:
+                            shas[index] = sha
+                            known.add(sha)
+                        # END handle delta
+                    # END for each resolved delta
+                # END for each missing base
+
+                pack_sha = finalize_pack_file(fp, 0, end, len(shas))
+            # END with pack file
+        except:
+            os.remove(tmp_path)
+            raise
+        # END handle failure
+
+        new_pack_path = os.path.join(base_dir, "pack-%s.pack" % force_text(bin_to_hex(pack_sha)))
+        os.rename(tmp_path, new_pack_path)
+        return new_pack_path, pack_sha
+
     #} END interface
@@ -7,12 +7,14 @@ from io import BytesIO
 import mmap
 import os
 import sys
+import threading
 import zlib
 
 from gitdb.const import NULL_BYTE, BYTE_SPACE
 from gitdb.fun import (
     msb_size,
     stream_copy,
+    apply_delta,
     apply_delta_data,
     connect_deltas,
     delta_types
@@ -26,7 +28,11 @@ from gitdb.util import (
     suppress,
     is_darwin,
 )
-from gitdb.utils.compat import buffer
+from gitdb.utils.compat import (
+    buffer,
+    xrange,
+    OrderedDict
+)
 
 
 has_perf_mod = False
@@ -37,7 +43,7 @@ try:
 except ImportError:
     pass
 
-__all__ = ('DecompressMemMapReader', 'FDCompressedSha1Writer', 'DeltaApplyReader',
+__all__ = ('DecompressMemMapReader', 'FDCompressedSha1Writer', 'DeltaApplyReader', 'DeltaBaseCache',
            'Sha1Writer', 'FlexibleSha1Writer', 'ZippedStoreShaWriter', 'FDCompressedSha1Writer',
            'FDStream', 'NullStream')
 
@@ -343,6 +349,89 @@ class DecompressMemMapReader(LazyMixin):
         return dcompdat
 
 
+class DeltaBaseCache(object):
+
+    """A least-recently-used cache of resolved object data, keyed by tuple(pack, offset),
+    which holds up to a budget of bytes. Objects in a pack share their delta bases, which
+    would have to be decompressed and resolved for each delta otherwise.
+
+    **Note:** Access is serialized with a lock, as one instance is shared by all readers
+    of a database, which may run on many threads"""
+    __slots__ = ('_budget', '_size', '_entries', '_hits', '_misses', '_lock')
+
+    def __init__(self, budget=32 * 1024 * 1024):
+        """:param budget: maximum amount of bytes of all cached objects"""
+        self._budget = budget
+        self._size = 0
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    #{ Interface
+
+    def get(self, key):
+        """:return: cached data for the given key, or None"""
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is None:
+                self._misses += 1
+                return None
+            # END handle miss
+            self._entries[key] = data       # most recently used entries come last
+            self._hits += 1
+            return data
+        # END with lock
+
+    def put(self, key, data):
+        """Cache the given data, evicting the least recently used objects as required.
+        Objects larger than our budget are not cached"""
+        if len(data) > self._budget:
+            return
+        # END handle huge objects
+        with self._lock:
+            entries = self._entries
+            old = entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            # END handle replacement
+            while entries and self._size + len(data) > self._budget:
+                self._size -= len(entries.popitem(last=False)[1])
+            # END evict until it fits
+            entries[key] = data
+            self._size += len(data)
+        # END with lock
+
+    def clear(self):
+        """Drop all cached objects, keeping the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        # END with lock
+
+    def budget(self):
+        """:return: maximum amount of bytes we cache"""
+        return self._budget
+
+    def size(self):
+        """:return: amount of bytes currently cached"""
+        return self._size
+
+    def stats(self):
+        """:return: tuple(hits, misses) of all ``get`` calls"""
+        return (self._hits, self._misses)
+
+    def hit_rate(self):
+        """:return: fraction of ``get`` calls which were served from the cache"""
+        total = self._hits + self._misses
+        return total and float(self._hits) / total
+
+    #} END interface
+
+
 class DeltaApplyReader(LazyMixin):
 
     """A reader which dynamically applies pack deltas to a base object, keeping the
@@ -375,6 +464,8 @@ class DeltaApplyReader(LazyMixin):
         "_mm_target",           # memory map of the delta-applied data
         "_size",                # actual number of bytes in _mm_target
         "_br",                  # number of bytes read
+        "_cache",               # DeltaBaseCache of resolved objects, or None
+        "_cache_pack",          # identifies the pack of all streams in the cache
         "_entered",
     )
 
@@ -382,7 +473,7 @@ class DeltaApplyReader(LazyMixin):
     k_max_memory_move = 250 * 1000 * 1000
     #} END configuration
 
-    def __init__(self, stream_list):
+    def __init__(self, stream_list, cache=None, cache_pack=None):
         """Initialize this instance with a list of streams, the first stream being
         the delta to apply on top of all following deltas, the last stream being the
         base object onto which to apply the deltas"""
@@ -391,6 +482,8 @@ class DeltaApplyReader(LazyMixin):
         self._bstream = stream_list[-1]
         self._dstreams = tuple(stream_list[:-1])
         self._br = 0
+        self._cache = cache
+        self._cache_pack = cache_pack
 
     def __enter__(self):
         if getattr(self, '_entered', None):
@@ -516,14 +609,46 @@ class DeltaApplyReader(LazyMixin):
         self._mm_target = bbuf
         self._size = final_target_size
 
+    def _set_cache_cached_(self, attr):
+        """Resolve the chain starting at the topmost link whose object is cached already,
+        caching the objects of all links we resolve on the way"""
+        cache = self._cache
+        keys = [(self._cache_pack, s.pack_offset) for s in self._dstreams + (self._bstream,)]
+        data = None
+        for top, key in enumerate(keys):
+            data = cache.get(key)
+            if data is not None:
+                break
+            # END handle hit
+        # END for each link
+        if data is None:
+            data = self._bstream.read()
+            cache.put(keys[-1], data)
+            top = len(self._dstreams)
+        # END handle full miss
+
+        for i in reversed(xrange(top)):
+            data = apply_delta(data, self._dstreams[i].read())
+            cache.put(keys[i], data)
+        # END for each delta to apply
+        self._mm_target = BytesIO(data)
+        self._size = len(data)
+
     #{ Configuration
     if not has_perf_mod:
-        _set_cache_ = _set_cache_brute_
+        _set_cache_uncached_ = _set_cache_brute_
     else:
-        _set_cache_ = _set_cache_too_slow_without_c
+        _set_cache_uncached_ = _set_cache_too_slow_without_c
 
     #} END configuration
 
+    def _set_cache_(self, attr):
+        if self._cache is not None:
+            self._set_cache_cached_(attr)
+        else:
+            self._set_cache_uncached_(attr)
+        # END handle cache
+
     def read(self, count=0):
         # if not getattr(self, '_entered', None):
         #     raise ValueError('Not entered!')
@@ -553,7 +678,7 @@ class DeltaApplyReader(LazyMixin):
     #{ Interface
 
     @classmethod
-    def new(cls, stream_list):
+    def new(cls, stream_list, cache=None, cache_pack=None):
         """
         Convert the given list of streams into a stream which resolves deltas
         when reading from it.
@@ -561,6 +686,10 @@ class DeltaApplyReader(LazyMixin):
         :param stream_list: two or more stream objects, first stream is a Delta
             to the object that you want to resolve, followed by N additional delta
             streams. The list's last stream must be a non-delta stream.
+        :param cache: if not None, a DeltaBaseCache which is consulted for the object
+            of each link of the chain, and receives all objects we resolve. Streams
+            must provide their ``pack_offset`` then
+        :param cache_pack: identifier of the pack of the streams, used to key the cache
 
         :return: Non-Delta OPackStream object whose stream can be used to obtain
             the decompressed resolved data
@@ -573,7 +702,7 @@ class DeltaApplyReader(LazyMixin):
             raise ValueError(
                 "Cannot resolve deltas if there is no base object stream, last one was type: %s" % stream_list[-1].type)
         # END check stream
-        return cls(stream_list)
+        return cls(stream_list, cache, cache_pack)
 
     #} END interface
 
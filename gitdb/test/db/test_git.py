@@ -2,18 +2,27 @@
 #
 # This module is part of GitDB and is released under
 # the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+from io import BytesIO
 import os
+import zlib
 
 import smmap
 
-from gitdb.base import OStream, OInfo
-from gitdb.db import GitDB
-from gitdb.exc import BadObject
+from gitdb.base import IStream, OStream, OInfo
+from gitdb.db import GitDB, LooseObjectDB, MemoryDB, PackedDB, copy_objects
+from gitdb.exc import BadObject, AmbiguousObjectName
 from gitdb.test.db.lib import (
     TestDBBase,
-    with_rw_directory
+    with_rw_directory,
+    fixture_path
 )
-from gitdb.util import bin_to_hex
+from gitdb.test.lib import copy_files_globbed
+from gitdb.typ import str_blob_type
+from gitdb.util import (
+    bin_to_hex,
+    make_sha
+)
+from gitdb.utils.encoding import force_text
 
 
 class TestGitDB(TestDBBase):
@@ -57,3 +66,250 @@ class TestGitDB(TestDBBase):
 
             # its possible to write objects
             self._assert_object_writing(gdb)
+
+    @with_rw_directory
+    def test_partial_sha_resolution(self, path):
+        with smmap.managed_mmaps() as mman:
+            packs_path = os.path.join(path, GitDB.packs_dir)
+            os.mkdir(packs_path)
+            copy_files_globbed(fixture_path('packs/*'), packs_path, hard_link_ok=True)
+            gdb = GitDB(mman, path)
+            sha_list = list(gdb.sha_iter())
+
+            # mix even/uneven hexshas
+            for i, binsha in enumerate(sha_list):
+                assert gdb.partial_to_complete_sha_hex(bin_to_hex(binsha)[:8 - (i % 2)]) == binsha
+            # END for each sha
+            self.failUnlessRaises(BadObject, gdb.partial_to_complete_sha_hex, "0000")
+            self.failUnlessRaises(AmbiguousObjectName, gdb.partial_to_complete_sha_hex, "")
+
+            # stored objects are found without rebuilding the index
+            index = gdb._prefix_index
+            data = b'prefix'
+            istream = gdb.store(IStream(str_blob_type, len(data), BytesIO(data)))
+            assert gdb._prefix_index is index
+            assert gdb.partial_to_complete_sha_hex(istream.hexsha[:7]) == istream.binsha
+
+            # objects written behind our back are found as well
+            ldb = [db for db in gdb.databases() if isinstance(db, LooseObjectDB)][0]
+            data = b'behind our back'
+            istream = ldb.store(IStream(str_blob_type, len(data), BytesIO(data)))
+            assert gdb.partial_to_complete_sha_hex(istream.hexsha[:7]) == istream.binsha
+            assert istream.binsha in gdb._prefix_index_new
+
+            # many new shas are merged into the index at once
+            new_shas = [make_sha(str(i).encode('ascii')).digest() for i in range(2000)]
+            for binsha in new_shas:
+                gdb._prefix_index_add(binsha)
+            # END for each new sha
+            assert gdb._prefix_index is not index
+            assert len(gdb._prefix_index_new) < 1024
+            assert len(gdb._prefix_index) // 20 == len(sha_list) + 2 + len(new_shas) - len(gdb._prefix_index_new)
+            for binsha in new_shas[::100] + [istream.binsha]:
+                assert gdb.partial_to_complete_sha_hex(bin_to_hex(binsha)[:12]) == binsha
+            # END for each sha
+
+            gdb.update_cache(force=True)
+            assert gdb.partial_to_complete_sha_hex(istream.hexsha[:7]) == istream.binsha
+            assert gdb._prefix_index is not index
+
+            # ... and make prefixes of indexed objects ambiguous
+            prefix = istream.hexsha[:3]
+            assert gdb.partial_to_complete_sha_hex(prefix) == istream.binsha
+            i = 0
+            while True:
+                data = ('behind our back %i' % i).encode('ascii')
+                if make_sha(('blob %i\0' % len(data)).encode('ascii') + data).hexdigest()[:3] == force_text(prefix):
+                    break
+                # END handle matching prefix
+                i += 1
+            # END while prefix differs
+            ldb.store(IStream(str_blob_type, len(data), BytesIO(data)))
+            # indexed prefixes are answered without touching the disk until the next update
+            assert gdb.partial_to_complete_sha_hex(prefix) == istream.binsha
+            gdb.update_cache(force=True)
+            self.failUnlessRaises(AmbiguousObjectName, gdb.partial_to_complete_sha_hex, prefix)
+
+    @with_rw_directory
+    def test_verify(self, path):
+        with smmap.managed_mmaps() as mman:
+            packs_path = os.path.join(path, GitDB.packs_dir)
+            os.mkdir(packs_path)
+            copy_files_globbed(fixture_path('packs/*'), packs_path)
+            gdb = GitDB(mman, path)
+            binshas = [gdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha
+                       for data in (b'first', b'second', b'third')]
+            num_packed = gdb.databases()[0].size()
+
+            progress = []
+            for processes in (1, 2):
+                report = gdb.verify(processes, progress=lambda done, total: progress.append((done, total)))
+                assert report.is_valid(), report.errors
+                assert report.packs == 3
+                assert report.packed_objects == num_packed
+                assert report.loose_objects == len(binshas)
+                assert progress[-1][0] == progress[-1][1]
+            # END for each amount of processes
+
+            # a loose object whose data doesn't match its name
+            loose_path = os.path.join(path, bin_to_hex(binshas[0]).decode('ascii')[:2],
+                                      bin_to_hex(binshas[0]).decode('ascii')[2:])
+            os.chmod(loose_path, 0o644)
+            with open(loose_path, 'wb') as fp:
+                fp.write(zlib.compress(b'blob 6\x00second'))
+            # END corrupt loose object
+
+            # a pack with a flipped bit
+            pack_path = gdb.databases()[0].entities()[0].pack().path()
+            with open(pack_path, 'r+b') as fp:
+                fp.seek(os.path.getsize(pack_path) // 2)
+                byte = fp.read(1)
+                fp.seek(-1, os.SEEK_CUR)
+                fp.write(bytearray([ord(byte) ^ 1]))
+            # END corrupt pack
+
+            report = gdb.verify(1)
+            assert not report.is_valid()
+            kinds = set(error.kind for error in report.errors)
+            assert 'pack_checksum' in kinds and 'sha' in kinds
+            assert binshas[0] in report.corrupt_objects()
+            assert len(report.corrupt_objects()) > 1
+            assert set(error.path for error in report.errors) == set((loose_path, pack_path))
+
+    @with_rw_directory
+    def test_copy_objects(self, path):
+        with smmap.managed_mmaps() as mman:
+            src_path = os.path.join(path, 'src')
+            os.makedirs(os.path.join(src_path, GitDB.packs_dir))
+            copy_files_globbed(fixture_path('packs/*'), os.path.join(src_path, GitDB.packs_dir), hard_link_ok=True)
+            src = GitDB(mman, src_path)
+            loose_shas = [src.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha
+                          for data in (b'first', b'second', b'third')]
+            shas = list(src.sha_iter())
+
+            def assert_copied(db):
+                for sha in shas[::50] + loose_shas:
+                    with src.stream(sha) as src_stream:
+                        with db.stream(sha) as dst_stream:
+                            assert (dst_stream.type, dst_stream.read()) == (src_stream.type, src_stream.read())
+                        # END with dst stream
+                    # END with src stream
+                # END for each sample
+            # END assert_copied
+
+            dst_path = os.path.join(path, 'dst')
+            os.makedirs(os.path.join(dst_path, GitDB.packs_dir))
+            dst = GitDB(mman, dst_path)
+            # copied objects are part of a prefix index built before
+            assert len(dst._prefix_index) == 0
+            assert copy_objects(src, dst, loose_shas) == len(loose_shas)
+            for sha in loose_shas:
+                assert sha in dst._prefix_index
+            # END for each loose object
+            assert copy_objects(src, dst, shas + shas[:10], batch_size=100) == len(shas) - len(loose_shas)
+            assert dst.size() == len(shas)
+            assert_copied(dst)
+            # packed objects went into one pack, loose ones were copied as they are
+            assert len(dst.databases()[0].entities()) == 1
+            for sha in loose_shas:
+                rela_path = os.path.join(bin_to_hex(sha).decode('ascii')[:2], bin_to_hex(sha).decode('ascii')[2:])
+                with open(os.path.join(src_path, rela_path), 'rb') as src_fp:
+                    with open(os.path.join(dst_path, rela_path), 'rb') as dst_fp:
+                        assert src_fp.read() == dst_fp.read()
+                # END with files
+            # END for each loose object
+            assert copy_objects(src, dst, shas) == 0
+
+            for dst in (LooseObjectDB(os.path.join(path, 'loose')), MemoryDB()):
+                if isinstance(dst, LooseObjectDB):
+                    os.mkdir(dst.root_path())
+                # END create loose db
+                assert copy_objects(src, dst, shas[:100] + loose_shas) == 100 + len(loose_shas)
+                assert dst.size() == 100 + len(loose_shas)
+                assert copy_objects(src, dst, shas[:100] + loose_shas) == 0
+            # END for each destination
+            self.failUnlessRaises(BadObject, copy_objects, src, MemoryDB(), [b'\x01' * 20])
+
+    @with_rw_directory
+    def test_copy_objects_subset(self, path):
+        with smmap.managed_mmaps() as mman:
+            src = PackedDB(mman, fixture_path('packs'))
+            delta_shas = []
+            other_shas = []
+            for entity in src.entities():
+                with entity:
+                    records = entity.object_records()
+                    sha_by_index = entity.index().sha
+                    for index, depth in zip(records.indices, records.depths):
+                        if depth:
+                            delta_shas.append(sha_by_index(index))
+                        else:
+                            other_shas.append(sha_by_index(index))
+                        # END handle object kind
+                    # END for each object
+                # END with entity
+            # END for each entity
+            assert delta_shas
+
+            # deltas whose base isn't copied can't reuse their data and are resolved instead
+            shas = delta_shas[::3] + other_shas[::5]
+            dst = PackedDB(mman, path)
+            assert copy_objects(src, dst, shas) == len(shas)
+            assert len(os.listdir(path)) == 2, "only the new pack and its index should remain"
+            assert dst.size() == len(shas)
+            for sha in shas:
+                with src.stream(sha) as src_stream:
+                    with dst.stream(sha) as dst_stream:
+                        assert (dst_stream.type, dst_stream.read()) == (src_stream.type, src_stream.read())
+                    # END with dst stream
+                # END with src stream
+            # END for each object
+
+            # packs our caller entered are used as they are
+            dst = PackedDB(mman, os.path.join(path, 'entered'))
+            os.mkdir(dst.root_path())
+            with src.entities()[0]:
+                assert copy_objects(src, dst, shas) == len(shas)
+                assert copy_objects(src, MemoryDB(), shas) == len(shas)
+            # END with entered pack
+            assert dst.size() == len(shas)
+
+    @with_rw_directory
+    def test_pack_loose_objects(self, path):
+        with smmap.managed_mmaps() as mman:
+            gdb = GitDB(mman, path)
+            loose_db = gdb.databases()[0]
+            # store objects until the fanout directory used for the estimate has one
+            contents = dict()
+            while not any(bin_to_hex(sha).startswith(b'17') for sha in contents):
+                data = ('object %i' % len(contents)).encode('ascii')
+                contents[gdb.store(IStream(str_blob_type, len(data), BytesIO(data))).binsha] = data
+            # END while sample directory is empty
+            assert loose_db.approximate_size() == 256
+            assert gdb.pack_loose_objects(threshold=256) is None
+            assert loose_db.size() == len(contents)
+
+            entity = gdb.pack_loose_objects(threshold=255)
+            assert entity is not None
+            assert os.path.isdir(os.path.join(path, GitDB.packs_dir))
+            assert len(gdb.databases()[0].entities()) == 1
+            assert gdb._loose_db.size() == 0
+            assert not [name for name in os.listdir(path) if len(name) == 2]
+            assert gdb.size() == len(contents)
+            for sha, data in contents.items():
+                assert not gdb._loose_db.has_object(sha)
+                with gdb.stream(sha) as ostream:
+                    assert ostream.read() == data
+                # END with stream
+            # END for each object
+
+            # loose objects which are packed already are just deleted
+            sha, data = next(iter(contents.items()))
+            gdb.store(IStream(str_blob_type, len(data), BytesIO(data)))
+            assert gdb._loose_db.has_object(sha)
+            assert gdb.pack_loose_objects(threshold=None) is None
+            assert not gdb._loose_db.has_object(sha)
+            assert len(gdb.databases()[0].entities()) == 1
+            with gdb.stream(sha) as ostream:
+                assert ostream.read() == data
+            # END with stream
@@ -2,19 +2,25 @@
 #
 # This module is part of GitDB and is released under
 # the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+from io import BytesIO
+import glob
 import os
 import random
 
 import smmap
 
+from gitdb.base import OStream
 from gitdb.db import PackedDB
 from gitdb.exc import BadObject, AmbiguousObjectName
+from gitdb.pack import PackEntity
 from gitdb.test import HIDE_WINDOWS_KNOWN_ERRORS
 from gitdb.test.db.lib import (
     TestDBBase,
     with_rw_directory,
     with_packs_rw
 )
+from gitdb.typ import str_blob_type
+from gitdb.util import make_sha
 
 
 class TestPackDB(TestDBBase):
@@ -87,3 +93,192 @@ class TestPackDB(TestDBBase):
 
             # non-existing
             self.failUnlessRaises(BadObject, pdb.partial_to_complete_sha, b'\0\0', 4)
+
+    @with_rw_directory
+    @with_packs_rw
+    def test_multi_pack_index(self, path):
+        with smmap.managed_mmaps() as mman:
+            pdb = PackedDB(mman, path)
+            assert pdb.multi_pack_index() is None
+            sha_list = list(pdb.sha_iter())
+            infos = [pdb.info(sha) for sha in sha_list]
+
+            midx_path = pdb.write_multi_pack_index()
+            assert os.path.isfile(midx_path)
+            midx = pdb.multi_pack_index()
+            assert midx is not None
+            with midx:
+                assert midx.size() == len(set(sha_list))
+                assert len(midx.pack_names()) == len(pdb.entities())
+
+            # all lookups are served by the multi-pack-index now
+            for sha, info in zip(sha_list, infos):
+                assert pdb.info(sha) == info
+                with pdb.stream(sha) as ostream:
+                    assert ostream.read() is not None
+            # END for each sha
+            assert not pdb.has_object(b'\0' * 20)
+
+            # files larger than the window are read through all of its windows
+            with smmap.managed_mmaps(window_size=4096) as wmman:
+                wpdb = PackedDB(wmman, path)
+                wpdb.update_cache(force=True)
+                wmidx = wpdb.multi_pack_index()
+                with wmidx:
+                    assert os.path.getsize(midx_path) > 4096
+                    assert wmidx.pack_names() == midx.pack_names()
+                    with midx:
+                        assert wmidx.checksum() == midx.checksum()
+                        for i in range(0, midx.size(), 7):
+                            assert wmidx.sha(i) == midx.sha(i)
+                            assert wmidx.pack_offset(i) == midx.pack_offset(i)
+                        # END for each object
+                    # END with midx
+                # END with windowed midx
+                for sha, info in zip(sha_list, infos):
+                    assert wpdb.info(sha) == info
+                # END for each sha
+            # END with windowed mman
+
+            # a stale file is ignored
+            pack_path = pdb.entities()[0].pack().path()
+            os.rename(pack_path, pack_path + "renamed")
+            pdb.update_cache(force=True)
+            assert pdb.multi_pack_index() is None
+
+    @with_rw_directory
+    @with_packs_rw
+    def test_unusable_multi_pack_index(self, path):
+        with smmap.managed_mmaps() as mman:
+            pdb = PackedDB(mman, path)
+            sha_list = list(pdb.sha_iter())
+            infos = [pdb.info(sha) for sha in sha_list]
+            midx_path = pdb.write_multi_pack_index()
+            with open(midx_path, 'rb') as fp:
+                data = fp.read()
+            # END read file
+        # END with mman
+
+        # files we can't read are ignored, and all packs are searched instead
+        unsupported_version = data[:4] + b'\x02' + data[5:]
+        for content in (unsupported_version, data[:len(data) // 2], data[:20], b''):
+            # a new file, as the old one may still be mapped
+            os.remove(midx_path)
+            with open(midx_path, 'wb') as fp:
+                fp.write(content)
+            # END write unusable file
+            with smmap.managed_mmaps() as mman:
+                pdb = PackedDB(mman, path)
+                for sha, info in zip(sha_list, infos):
+                    assert pdb.info(sha) == info
+                # END for each sha
+                assert pdb.multi_pack_index() is None
+            # END with mman
+        # END for each unusable file
+
+    @with_rw_directory
+    @with_packs_rw
+    def test_bloom_filter(self, path):
+        with smmap.managed_mmaps() as mman:
+            pdb = PackedDB(mman, path)
+            pdb.bloom_filter_bits = 10
+            pdb.bloom_filter_persist = True
+            sha_list = list(pdb.sha_iter())
+            num_packs = len(pdb.entities())
+
+            # there are no false negatives
+            for sha in sha_list:
+                assert pdb.has_object(sha)
+            # END for each sha
+            skips, passes, false_positives = pdb.bloom_filter_stats()
+            assert passes >= len(sha_list)
+            assert passes - false_positives == len(sha_list)
+            for entity in pdb.entities():
+                assert os.path.isfile(os.path.splitext(entity.pack().path())[0] + ".bloom")
+            # END for each entity
+
+            # missing shas skip most packs
+            for i in range(100):
+                assert not pdb.has_object(os.urandom(20))
+            # END for each missing sha
+            nskips, npasses, nfalse_positives = pdb.bloom_filter_stats()
+            assert nskips - skips + npasses - passes == 100 * num_packs
+            assert nskips - skips > 90 * num_packs
+            assert npasses - passes == nfalse_positives - false_positives
+
+            # persisted filters are read back
+            pdb = PackedDB(mman, path)
+            pdb.bloom_filter_bits = 10
+            pdb.bloom_filter_persist = True
+            for sha in sha_list:
+                assert pdb.info(sha).binsha == sha
+            # END for each sha
+
+    @with_rw_directory
+    @with_packs_rw
+    def test_consolidate(self, path):
+        with smmap.managed_mmaps() as mman:
+            # a few more tiny packs, one of them with an object of another pack
+            pdb = PackedDB(mman, path)
+            duplicate = next(pdb.sha_iter())
+            for i in range(2):
+                data = ('%4i' % i).encode('ascii')
+                objects = [OStream(make_sha(b'blob 4\0' + data).digest(), str_blob_type, 4, BytesIO(data))]
+                if i == 0:
+                    objects.append(pdb.stream(duplicate))
+                # END add duplicate
+                PackEntity.create(mman, objects, path)
+            # END for each pack
+            pdb.update_cache(force=True)
+            num_packs = len(pdb.entities())
+            sha_list = set(pdb.sha_iter())
+            infos = dict((sha, pdb.info(sha)) for sha in sha_list)
+            pdb.write_multi_pack_index()
+
+            assert pdb.consolidate(max_packs=num_packs) is None
+            assert pdb.consolidate(max_packs=1, min_size=1) is None
+            # the largest pack is kept
+            sizes = sorted(os.path.getsize(e.pack().path()) for e in pdb.entities())
+            entity = pdb.consolidate(max_packs=1, min_size=sizes[-1])
+            assert entity is not None
+            assert len(pdb.entities()) == 2
+            assert len(glob.glob(os.path.join(path, "pack-*.pack"))) == 2
+            assert len(glob.glob(os.path.join(path, "pack-*.idx"))) == 2
+            assert entity.pack().path() in [e.pack().path() for e in pdb.entities()]
+
+            # all objects are still there, and nothing else
+            assert set(pdb.sha_iter()) == sha_list
+            for sha, info in infos.items():
+                assert pdb.info(sha) == info
+                with pdb.stream(sha) as ostream:
+                    assert len(ostream.read()) == info.size
+                # END with stream
+            # END for each object
+            assert pdb.multi_pack_index() is None
+            assert not os.path.exists(os.path.join(path, pdb.multi_pack_index_name))
+            assert not pdb.update_cache()
+
+    @with_rw_directory
+    def test_consolidate_into_existing_pack(self, path):
+        with smmap.managed_mmaps() as mman:
+            # merging a pack with one of its subsets yields the very same pack
+            objects = []
+            for i in range(2):
+                data = ('%4i' % i).encode('ascii')
+                objects.append(OStream(make_sha(b'blob 4\0' + data).digest(), str_blob_type, 4, BytesIO(data)))
+            # END for each object
+            superset = PackEntity.create(mman, objects, path)
+            objects[0].stream.seek(0)
+            PackEntity.create(mman, objects[:1], path)
+
+            pdb = PackedDB(mman, path)
+            entity = pdb.consolidate(max_packs=1, min_size=10 ** 9)
+            assert entity.pack().path() == superset.pack().path()
+            assert len(pdb.entities()) == 1
+            assert len(glob.glob(os.path.join(path, "pack-*.pack"))) == 1
+            assert len(glob.glob(os.path.join(path, "pack-*.idx"))) == 1
+
+            pdb = PackedDB(mman, path)
+            for ostream in objects:
+                assert pdb.has_object(ostream.binsha)
+            # END for each object
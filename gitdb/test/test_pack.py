@@ -3,31 +3,53 @@
 # This module is part of GitDB and is released under
 # the New BSD License: http://www.opensource.org/licenses/bsd-license.php
 """Test everything about packs reading and writing"""
+from io import BytesIO
+import mmap
 import os
+import shutil
 import tempfile
 
 from nose import SkipTest
 import smmap
 
 from gitdb.base import (
+    IStream,
     OInfo,
     OStream,
 )
-from gitdb.exc import UnsupportedOperation
-from gitdb.fun import delta_types
+from gitdb.const import NULL_BIN_SHA
+from gitdb.db.mem import MemoryDB
+from gitdb.exc import (
+    ParseError,
+    UnsupportedOperation
+)
+from gitdb.fun import (
+    delta_types,
+    type_to_type_id_map,
+    apply_delta,
+    create_delta,
+    loose_object_header,
+)
 from gitdb.pack import (
+    IndexWriter,
     PackEntity,
+    mapped_file_sha,
     PackIndexFile,
-    PackFile
+    PackFile,
+    PackReverseIndexFile,
+    WindowedFileView,
+    write_reverse_index
 )
-from gitdb.stream import DeltaApplyReader
+from gitdb.stream import DeltaApplyReader, DeltaBaseCache
 from gitdb.test.lib import (
     TestBase,
     with_rw_directory,
     fixture_path
 )
-from gitdb.util import to_bin_sha
+from gitdb.typ import str_blob_type
+from gitdb.util import bin_to_hex, to_bin_sha, make_sha
 from gitdb.utils.compat import xrange, ExitStack
+from gitdb.utils.encoding import force_text
 
 
 try:
@@ -79,6 +101,11 @@ class TestPack(TestBase):
         # END for each object index in indexfile
         self.failUnlessRaises(ValueError, index.partial_sha_to_index, "\0", 2)
 
+        # batched lookup, results line up with the input order
+        shas = [index.sha(oidx) for oidx in xrange(index.size())]
+        indices = index.sha_to_index_many(reversed(shas + [NULL_BIN_SHA]))
+        assert list(indices) == [-1] + list(reversed(xrange(size)))
+
     def _assert_pack_file(self, pack, version, size):
         assert pack.version() == 2
         assert pack.size() == size
@@ -133,6 +160,102 @@ class TestPack(TestBase):
                 with PackIndexFile(mman, indexfile) as index:
                     self._assert_index_file(index, version, size)
 
+    @with_rw_directory
+    def test_pack_index_lookup_many(self, rw_dir):
+        # a single crowded fanout bucket makes sparse queries bisect
+        shas = sorted(set(b'\x01' + os.urandom(19) for _ in xrange(5000)))
+        iwriter = IndexWriter()
+        for offset, sha in enumerate(shas):
+            iwriter.append(sha, 0, offset)
+        index_path = os.path.join(rw_dir, 'index')
+        with open(index_path, 'wb') as ifile:
+            iwriter.write(NULL_BIN_SHA, ifile.write)
+
+        with smmap.managed_mmaps() as mman:
+            with PackIndexFile(mman, index_path) as index:
+                query = [shas[4000], b'\x01' + NULL_BIN_SHA[:19], shas[7], b'\x02' * 20, shas[7]]
+                assert list(index.sha_to_index_many(query)) == [4000, -1, 7, -1, 7]
+
+                query = shas[::3] + [b'\x01' * 20]
+                last = index.sha_to_index(b'\x01' * 20)
+                expected = list(xrange(0, len(shas), 3)) + [last is None and -1 or last]
+                assert list(index.sha_to_index_many(query)) == expected
+
+    @with_rw_directory
+    def test_index_writer(self, rw_dir):
+        index_path = os.path.join(rw_dir, 'pack-test.idx')
+        objects = dict()
+        writer = IndexWriter()
+        for i in xrange(1000):
+            binsha = make_sha(str(i).encode('ascii')).digest()
+            # every tenth object beyond what 31 bits can address
+            offset = 12 + i * 100 + (i % 10 == 0 and 0x80000000 or 0)
+            if i % 7 == 0:
+                # crowd a few buckets of the writer's sort
+                binsha = bytes(bytearray([i % 3, 0x17])) + binsha[2:]
+            # END handle shared prefix
+            objects[binsha] = (i * 0x7fff1 & 0xffffffff, offset)
+            writer.append(binsha, objects[binsha][0], offset)
+        # END for each object
+        assert len(writer) == len(objects)
+
+        pack_sha = make_sha(b'pack').digest()
+        with open(index_path, 'wb') as fp:
+            index_sha = writer.write(pack_sha, fp.write)
+        # END with file
+
+        with smmap.managed_mmaps() as mman:
+            with PackIndexFile(mman, index_path) as index:
+                assert index.size() == len(objects)
+                assert index.packfile_checksum() == pack_sha
+                assert index.indexfile_checksum() == index_sha
+                shas = [index.sha(i) for i in xrange(index.size())]
+                assert shas == sorted(objects)
+                for binsha, (crc, offset) in objects.items():
+                    i = index.sha_to_index(binsha)
+                    assert index.crc(i) == crc
+                    assert index.offset(i) == offset
+                # END for each object
+            # END with index
+
+    @with_rw_directory
+    def test_pack_index_windowed(self, rw_dir):
+        # an index far larger than the window, with some 64 bit offsets
+        shas = sorted(set(os.urandom(20) for _ in xrange(3000)))
+        iwriter = IndexWriter()
+        for i, sha in enumerate(shas):
+            iwriter.append(sha, i, i * 0x1000000)
+        index_path = os.path.join(rw_dir, 'index')
+        with open(index_path, 'wb') as ifile:
+            iwriter.write(NULL_BIN_SHA, ifile.write)
+
+        window_size = mmap.ALLOCATIONGRANULARITY
+        assert os.path.getsize(index_path) > 8 * window_size
+        with smmap.managed_mmaps() as mman:
+            with smmap.SlidingWindowMapManager(window_size=window_size) as wmman:
+                with PackIndexFile(mman, index_path) as index:
+                    with PackIndexFile(wmman, index_path) as windex:
+                        # lookups don't need any windows but the pinned ones
+                        assert isinstance(windex._data, WindowedFileView)
+                        assert windex._data.pinned_size() >= 8 + 1024 + 20 * len(shas)
+                        assert list(windex.sha_to_index_many(shas)) == list(xrange(len(shas)))
+                        assert windex.sha_to_index(b'\xff' * 20) is None
+                        assert not windex._data._cursor.is_valid()
+
+                        assert windex.size() == index.size() == len(shas)
+                        assert windex.packfile_checksum() == index.packfile_checksum()
+                        assert windex.indexfile_checksum() == index.indexfile_checksum()
+                        assert list(windex.offsets()) == list(index.offsets())
+                        assert windex.crcs() == index.crcs()
+                        for i in xrange(0, len(shas), 7):
+                            assert windex.entry(i) == index.entry(i)
+                            assert windex.sha_to_index(shas[i]) == i
+                            assert windex.partial_sha_to_index(shas[i][:4], 8) == i
+                        # END for each sha
+                    # END with windowed index
+                # END with index
+            # END with windowed manager
+
     def test_pack(self):
         # there is this special version 3, but apparently its like 2 ...
         with smmap.managed_mmaps() as mman:
@@ -141,6 +264,43 @@ class TestPack(TestBase):
                     self._assert_pack_file(pack, version, size)
         # END for each pack to test
 
+    @with_rw_directory
+    def test_pack_iteration(self, rw_dir):
+        with smmap.managed_mmaps() as mman:
+            for packfile, version, size in (self.packfile_v2_1, self.packfile_v2_2):  # @UnusedVariable
+                pack_path = os.path.join(rw_dir, os.path.basename(packfile))
+                shutil.copyfile(packfile, pack_path)
+                with PackFile(mman, packfile) as indexed_pack:
+                    with PackFile(mman, pack_path) as pack:
+                        expected = [(s.pack_offset, s.read()) for s in indexed_pack.stream_iter()]
+                        assert len(expected) == size
+
+                        # without index, each object is decompressed once, no matter how
+                        # much we read
+                        actual = []
+                        for i, stream in enumerate(pack.stream_iter()):
+                            data = stream.read(i % 3 and 7 or -1)
+                            if i % 5 == 1:
+                                data += stream.read(3) + stream.read()
+                            # END read in pieces
+                            actual.append((stream.pack_offset, data))
+                        # END for each stream
+                        assert [o for o, d in actual] == [o for o, d in expected]
+                        assert all(e.startswith(a) for (o, a), (o, e) in zip(actual, expected))
+                        assert all(a == e for i, ((o, a), (o, e)) in enumerate(zip(actual, expected))
+                                   if i % 5 == 1 or not i % 3)
+
+                        infos = list(pack._iter_objects(0, as_stream=False))
+                        assert [info.pack_offset for info in infos] == [o for o, d in expected]
+                        assert not any(hasattr(info, 'stream') for info in infos)
+
+                        offsets = [o for o, d in expected]
+                        assert [s.pack_offset for s in indexed_pack.stream_iter(offsets[5])] == offsets[5:]
+                        assert [s.pack_offset for s in pack.stream_iter(offsets[5])] == offsets[5:]
+                    # END with pack
+                # END with indexed pack
+            # END for each pack
+
     ## Unless HIDE_WINDOWS_KNOWN_ERRORS, on Windows fails with:
     # File "D:\Work\gitdb.git\gitdb\util.py", line 141, in onerror
     #     func(path)  # Will scream if still not possible to delete.
@@ -191,6 +351,18 @@ class TestPack(TestBase):
                     # END for each info, stream tuple
                     assert count == size
 
+                    # offset order yields the same objects, reading the pack sequentially
+                    infos = list(entity.info_iter(by_offset=True, madvise=True))
+                    assert sorted(i.binsha for i in infos) == sorted(i.binsha for i in entity.info_iter())
+                    index = entity.index()
+                    offsets = [index.offset(index.sha_to_index(i.binsha)) for i in infos]
+                    assert offsets == sorted(offsets)
+                    for info, stream in izip(infos, entity.stream_iter(by_offset=True)):
+                        with stream:
+                            assert stream.binsha == info.binsha
+                            assert len(stream.read()) == info.size
+                    # END for each stream
+
             # END for each entity
 
             # pack writing - write all packs into one
@@ -253,6 +425,445 @@ class TestPack(TestBase):
                         assert entity.is_valid_stream(info.binsha, use_crc)
             assert count == len(pack_objs)
 
+    @with_rw_directory
+    def test_pack_verify_checksum(self, rw_dir):
+        pack_path = os.path.join(rw_dir, os.path.basename(self.packfile_v2_2[0]))
+        index_path = os.path.join(rw_dir, os.path.basename(self.packindexfile_v2[0]))
+        shutil.copyfile(self.packfile_v2_2[0], pack_path)
+        shutil.copyfile(self.packindexfile_v2[0], index_path)
+
+        with smmap.managed_mmaps(window_size=4096) as mman:
+            # blocks don't align with windows
+            cursor = mman.make_cursor(pack_path)
+            with open(pack_path, 'rb') as fp:
+                data = fp.read()
+            # END read pack
+            for threaded, block_size in ((False, 0), (True, 1000), (True, len(data))):
+                assert mapped_file_sha(cursor, len(data) - 20, threaded, block_size) == data[-20:]
+            # END for each configuration
+            cursor._destroy()
+
+            for path, cls in ((pack_path, PackFile), (index_path, PackIndexFile)):
+                for threaded in (False, True):
+                    with cls(mman, path) as packfile:
+                        assert packfile.verify_checksum(threaded)
+                    # END with file
+                # END for each mode
+            # END for each file
+        # END with mman
+
+        for path, cls in ((pack_path, PackFile), (index_path, PackIndexFile)):
+            with open(path, 'r+b') as fp:
+                fp.seek(-21, os.SEEK_END)
+                byte = fp.read(1)
+                fp.seek(-1, os.SEEK_CUR)
+                fp.write(bytearray([ord(byte) ^ 1]))
+            # END flip bit of last content byte
+            with smmap.managed_mmaps() as mman:
+                for threaded in (False, True):
+                    with cls(mman, path) as packfile:
+                        assert not packfile.verify_checksum(threaded)
+                    # END with file
+                # END for each mode
+            # END with mman
+        # END for each file
+
+    @with_rw_directory
+    def test_pack_index_pack(self, rw_dir):
+        with smmap.managed_mmaps() as mman:
+            for packfile, indexfile, workers in ((self.packfile_v2_1[0], self.packindexfile_v1[0], 0),
+                                                 (self.packfile_v2_2[0], self.packindexfile_v2[0], 2),
+                                                 (self.packfile_v2_3_ascii[0], self.packindexfile_v2_3_ascii[0], 0)):
+                pack_path = os.path.join(rw_dir, os.path.basename(packfile))
+                shutil.copyfile(packfile, pack_path)
+                entity = PackEntity.index_pack(mman, pack_path, workers=workers)
+                with entity.index() as index:
+                    with PackIndexFile(mman, indexfile) as git_index:
+                        assert index.version() == 2
+                        assert index.packfile_checksum() == git_index.packfile_checksum()
+                        assert index.size() == git_index.size()
+                        assert [index.entry(i)[:2] for i in xrange(index.size())] == \
+                            [git_index.entry(i)[:2] for i in xrange(git_index.size())]
+                        if git_index.version() == 2:
+                            assert index.crcs() == git_index.crcs()
+                    # END with git index
+                # END with index
+                with entity:
+                    for info in entity.info_iter():
+                        assert entity.is_valid_stream(info.binsha, use_crc=True)
+            # END for each pack
+
+    def test_pack_entity_resolved_iter(self):
+        with smmap.managed_mmaps() as mman:
+            for packfile, version, size in (self.packfile_v2_1, self.packfile_v2_2,  # @UnusedVariable
+                                            self.packfile_v2_3_ascii):
+                with PackEntity(mman, packfile) as entity:
+                    resolved = dict()
+                    for stream in entity.resolved_iter():
+                        assert stream.binsha not in resolved
+                        resolved[stream.binsha] = (stream.type, stream.read())
+                        assert len(resolved[stream.binsha][1]) == stream.size
+                    # END for each resolved object
+                    assert len(resolved) == size
+
+                    for stream in entity.stream_iter():
+                        with stream:
+                            assert resolved[stream.binsha] == (stream.type, stream.read())
+                    # END for each stream
+                # END with entity
+            # END for each pack
+
+    def test_pack_entity_object_records(self):
+        with smmap.managed_mmaps() as mman:
+            for packfile, version, size in (self.packfile_v2_1, self.packfile_v2_2,  # @UnusedVariable
+                                            self.packfile_v2_3_ascii):
+                with PackEntity(mman, packfile) as entity:
+                    records = entity.object_records()
+                    assert len(records) == size
+                    assert sum(records.packed_sizes) == os.path.getsize(packfile) - 12 - 20
+
+                    index = entity.index()
+                    for i in xrange(len(records)):
+                        offset = records.offsets[i]
+                        assert index.offset(records.indices[i]) == offset
+                        streams = entity.collect_streams_at_offset(offset)
+                        assert records.depths[i] == len(streams) - 1
+                        assert records.sizes[i] == streams[0].size
+                        info = entity.info_at_offset(index.sha(records.indices[i]), offset)
+                        assert type_to_type_id_map[info.type] == records.type_ids[i]
+                        if len(streams) > 1:
+                            assert records.base_offsets[i] == streams[1].pack_offset
+                        else:
+                            assert records.base_offsets[i] == 0
+                        # END check base
+                    # END for each record
+
+                    stats = entity.stats()
+                    assert stats['objects'] == size
+                    assert sum(stats['types'].values()) == size
+                    assert stats['deltas'] == sum(1 for depth in records.depths if depth)
+                    assert sum(sum(s.values()) for s in stats['sizes'].values()) == size
+                    assert sum(stats['packed_sizes'].values()) == sum(records.packed_sizes)
+                # END with entity
+            # END for each pack
+
+    def test_pack_entity_delta_info(self):
+        with smmap.managed_mmaps() as mman:
+            for packfile, version, size in (self.packfile_v2_1, self.packfile_v2_2,  # @UnusedVariable
+                                            self.packfile_v2_3_ascii):
+                with PackEntity(mman, packfile) as entity:
+                    expected = dict()
+                    for stream in entity.stream_iter():
+                        with stream:
+                            expected[stream.binsha] = (stream.type, len(stream.read()))
+                    # END for each stream
+                # END with entity
+
+                # infos of deltas are obtained from headers, without collecting streams
+                class HeaderOnlyPackEntity(PackEntity):
+                    __slots__ = ()
+
+                    def collect_streams_at_offset(self, offset):
+                        raise AssertionError("info shouldn't collect streams")
+                # END header only entity
+
+                with HeaderOnlyPackEntity(mman, packfile) as entity:
+                    for sha, (type, size) in expected.items():
+                        info = entity.info(sha)
+                        assert (info.type, info.size) == (type, size)
+                    # END for each object
+
+                    records = entity.object_records()
+                    base_type_ids = entity._base_type_ids
+                    assert sum(1 for type_id in base_type_ids if type_id) == \
+                        sum(1 for depth in records.depths if depth)
+                    positions = dict((offset, pos) for pos, offset in enumerate(entity._sorted_offsets))
+                    for offset, type_id in izip(records.offsets, records.type_ids):
+                        assert base_type_ids[positions[offset]] in (0, type_id)
+                    # END for each record
+                # END with entity
+            # END for each pack
+
+    def test_pack_entity_delta_base_cache(self):
+        with smmap.managed_mmaps() as mman:
+            for packfile, version, size in (self.packfile_v2_2, self.packfile_v2_3_ascii):  # @UnusedVariable
+                cache = DeltaBaseCache()
+                with PackEntity(mman, packfile) as entity:
+                    with PackEntity(mman, packfile, delta_base_cache=cache) as centity:
+                        assert centity.delta_base_cache() is cache
+                        for _ in range(2):
+                            for stream, cstream in izip(entity.stream_iter(), centity.stream_iter()):
+                                with stream:
+                                    with cstream:
+                                        assert cstream.binsha == stream.binsha
+                                        assert cstream.type == stream.type
+                                        assert cstream.size == stream.size
+                                        assert cstream.read() == stream.read()
+                                    # END with cached stream
+                                # END with stream
+                            # END for each stream
+                        # END iterate twice
+                    # END with cached entity
+                # END with entity
+                hits, misses = cache.stats()
+                assert hits and misses
+                assert 0 < cache.size() <= cache.budget()
+            # END for each pack
+
+    @with_rw_directory
+    def test_pack_write_deltas(self, rw_dir):
+        # deltas reproduce their target, and respect size limits
+        base = b''.join(('line %i of a file which changes a little\n' % i).encode('ascii') for i in range(200))
+        target = base[:1000] + b'an inserted line\n' + base[1000:5000] + base[5100:]
+        delta = create_delta(base, target)
+        assert apply_delta(base, delta) == target
+        assert len(delta) < 100
+        assert create_delta(base, target, max_size=10) is None
+        assert apply_delta(base, create_delta(base, b'')) == b''
+        assert apply_delta(b'', create_delta(b'', target)) == target
+
+        with smmap.managed_mmaps() as mman:
+            objects = []
+            with PackEntity(mman, self.packfile_v2_3_ascii[0]) as entity:
+                for stream in entity.resolved_iter():
+                    objects.append(stream)
+                # END for each object
+            # END with entity
+            # similar blobs, that's what deltas are good for
+            for i in range(20):
+                data = base[:i * 100] + ('revision %i\n' % i).encode('ascii') + base[i * 100:]
+                binsha = make_sha(loose_object_header(str_blob_type, len(data)) + data).digest()
+                objects.append(OStream(binsha, str_blob_type, len(data), BytesIO(data)))
+            # END for each blob
+
+            expected = dict()
+            for obj in objects:
+                expected[obj.binsha] = (obj.type, obj.stream.read())
+            # END for each object
+
+            sizes = list()
+            for window in (0, 10):
+                for obj in objects:
+                    obj.stream.seek(0)
+                # END rewind streams
+                with PackEntity.create(mman, objects, rw_dir, window=window, depth=3) as entity:
+                    sizes.append(os.path.getsize(entity.pack().path()))
+                    records = entity.object_records()
+                    assert max(records.depths) <= 3
+                    assert (max(records.depths) > 0) == (window > 0)
+
+                    for info in entity.info_iter():
+                        assert entity.is_valid_stream(info.binsha, use_crc=True)
+                        assert entity.is_valid_stream(info.binsha, use_crc=False)
+                        with entity.stream(info.binsha) as stream:
+                            assert (stream.type, stream.read()) == expected[info.binsha]
+                    # END for each object
+                # END with entity
+            # END for each window
+            assert sizes[1] < sizes[0] // 2
+
+    @with_rw_directory
+    def test_pack_write_reuse(self, rw_dir):
+        class UnreadStream(object):
+            def read(self, size=-1):
+                raise AssertionError("reused objects should not be read")
+        # END unread stream
+
+        with smmap.managed_mmaps() as mman:
+            for packfile, version, size in (self.packfile_v2_1, self.packfile_v2_3_ascii):  # @UnusedVariable
+                with PackEntity(mman, packfile) as source:
+                    records = source.object_records()
+                    # all objects are copied, deltas included
+                    objects = [OStream(info.binsha, info.type, info.size, UnreadStream())
+                               for info in source.info_iter()]
+                    with PackEntity.create(mman, objects, rw_dir, reuse=[source]) as entity:
+                        assert entity.stats() == source.stats()
+                        for info in entity.info_iter():
+                            assert entity.is_valid_stream(info.binsha, use_crc=True)
+                            assert entity.is_valid_stream(info.binsha, use_crc=False)
+                        # END for each object
+                    # END with entity
+
+                    # deltas whose base isn't written are written as they are
+                    objects = [source.stream_at_index(records.indices[i])
+                               for i in xrange(len(records)) if records.depths[i] != 1]
+                    with PackEntity.create(mman, objects, rw_dir, reuse=[source]) as entity:
+                        assert len(entity.index().offsets()) == len(objects)
+                        for info in entity.info_iter():
+                            assert entity.is_valid_stream(info.binsha, use_crc=True)
+                            assert entity.is_valid_stream(info.binsha, use_crc=False)
+                        # END for each object
+                    # END with entity
+                # END with source
+            # END for each pack
+
+    def test_pack_write_threads(self):
+        with smmap.managed_mmaps() as mman:
+            with PackEntity(mman, self.packfile_v2_3_ascii[0]) as entity:
+                objects = list(entity.resolved_iter())
+            # END with entity
+
+            # compressing objects concurrently doesn't change the pack
+            for window in (0, 10):
+                results = set()
+                for threads, max_pending_size in ((1, 0), (3, 0), (3, 1000), (3, 64 * 1024 ** 2)):
+                    for obj in objects:
+                        obj.stream.seek(0)
+                    # END rewind streams
+                    pack_data = BytesIO()
+                    index_data = BytesIO()
+                    shas = PackEntity.write_pack(objects, pack_data.write, index_data.write, window=window,
+                                                 threads=threads, max_pending_size=max_pending_size)
+                    results.add((pack_data.getvalue(), index_data.getvalue()) + shas)
+                # END for each configuration
+                assert len(results) == 1
+            # END for each window
+
+    @with_rw_directory
+    def test_pack_write_file(self, rw_dir):
+        class SequentialFile(object):
+            def __init__(self):
+                self.data = BytesIO()
+                self.write = self.data.write
+        # END sequential file
+
+        with smmap.managed_mmaps() as mman:
+            with PackEntity(mman, self.packfile_v2_3_ascii[0]) as entity:
+                objects = list(entity.resolved_iter())
+            # END with entity
+
+            def object_iter():
+                for obj in objects:
+                    obj.stream.seek(0)
+                    yield obj
+                # END for each object
+            # END object_iter
+
+            pack_data = BytesIO()
+            index_data = BytesIO()
+            shas = PackEntity.write_pack(list(object_iter()), pack_data.write, index_data.write)
+
+            # objects are streamed into files we can seek in, others get a copy of the pack
+            pack_path = os.path.join(rw_dir, 'pack')
+            leading_data = BytesIO()
+            leading_data.write(b'leading')
+            for pack_file in (leading_data, SequentialFile(), open(pack_path, 'wb'), open(pack_path, 'w+b')):
+                assert PackEntity.write_pack_file(object_iter(), pack_file, BytesIO().write) == shas
+                if isinstance(pack_file, SequentialFile):
+                    assert pack_file.data.getvalue() == pack_data.getvalue()
+                elif isinstance(pack_file, BytesIO):
+                    assert pack_file.getvalue() == b'leading' + pack_data.getvalue()
+                else:
+                    pack_file.close()
+                    with open(pack_path, 'rb') as fp:
+                        assert fp.read() == pack_data.getvalue()
+                # END check pack
+            # END for each file
+
+            with PackEntity.create(mman, object_iter(), rw_dir) as entity:
+                assert entity.pack().checksum() == shas[0]
+                assert entity.index().indexfile_checksum() == shas[1]
+            # END with entity
+
+    @with_rw_directory
+    def test_pack_write_thin(self, rw_dir):
+        def blob(data):
+            return IStream(str_blob_type, len(data), BytesIO(data))
+        # END blob
+
+        # hashes don't compress well, unlike the deltas against them
+        base = b''.join(make_sha(('line %i' % i).encode('ascii')).digest() for i in range(200))
+        odb = MemoryDB()
+        old_shas = [odb.store(blob(base + ('revision %i\n' % i).encode('ascii'))).binsha for i in range(5)]
+        new_objects = list()
+        for i in range(5):
+            data = base + ('revision %i\n' % (i + 5)).encode('ascii')
+            binsha = make_sha(loose_object_header(str_blob_type, len(data)) + data).digest()
+            new_objects.append(OStream(binsha, str_blob_type, len(data), BytesIO(data)))
+        # END for each new blob
+
+        pack_data = dict()
+        for thin in (False, True):
+            for obj in new_objects:
+                obj.stream.seek(0)
+            # END rewind streams
+            thin_bases = thin and [odb.stream(sha) for sha in old_shas] or None
+            pack_stream = BytesIO()
+            PackEntity.write_pack(new_objects, pack_stream.write, window=10, thin_bases=thin_bases)
+            pack_data[thin] = pack_stream.getvalue()
+        # END for each kind of pack
+        # without a base to start from, at least one object is written as it is
+        assert len(pack_data[True]) < len(pack_data[False]) // 4
+
+        with smmap.managed_mmaps() as mman:
+            pack_path = os.path.join(rw_dir, 'thin.pack')
+            with open(pack_path, 'wb') as fp:
+                fp.write(pack_data[True])
+            # END write pack
+            self.failUnlessRaises(ParseError, PackEntity.index_pack, mman, pack_path)
+            self.failUnlessRaises(ParseError, PackEntity.fix_thin_pack, mman, pack_path, MemoryDB())
+
+            with PackEntity.fix_thin_pack(mman, pack_path, odb) as entity:
+                pack_file = entity.pack()
+                assert pack_file.size() == entity.index().size()
+                assert pack_file.checksum() == entity.index().packfile_checksum()
+                assert 5 < pack_file.size() <= 10
+                for obj in new_objects:
+                    obj.stream.seek(0)
+                    assert entity.is_valid_stream(obj.binsha, use_crc=True)
+                    with entity.stream(obj.binsha) as stream:
+                        assert stream.read() == obj.stream.read()
+                # END for each new object
+                assert max(entity.object_records().depths) > 0
+                pack_name = "pack-%s.pack" % force_text(bin_to_hex(pack_file.checksum()))
+                assert os.path.basename(pack_file.path()) == pack_name
+            # END with entity
+
+    @with_rw_directory
+    def test_pack_reverse_index(self, rw_dir):
+        packfile = self.packfile_v2_2[0]
+        for ext in ('.pack', '.idx'):
+            shutil.copy(os.path.splitext(packfile)[0] + ext, rw_dir)
+        packfile = os.path.join(rw_dir, os.path.basename(packfile))
+
+        with smmap.managed_mmaps() as mman:
+            with PackEntity(mman, packfile) as entity:
+                assert not os.path.isfile(entity.reverse_index().path())
+                index = entity.index()
+                for i in xrange(index.size()):
+                    assert entity.offset_to_index(index.offset(i)) == i
+                    assert entity.offset_to_index(index.offset(i) + 1) is None
+                # END for each object
+                rev_path = entity.write_reverse_index()
+                sorted_offsets = entity._sorted_offsets
+
+            with PackEntity(mman, packfile) as entity:
+                with entity.reverse_index() as rev:
+                    assert rev.path() == rev_path
+                    assert rev.size() == entity.index().size()
+                    assert rev.packfile_checksum() == entity.index().packfile_checksum()
+                    assert list(rev.index_positions()) == list(entity._offset_indices)
+                assert entity._sorted_offsets == sorted_offsets
+                for info in entity.info_iter():
+                    assert entity.is_valid_stream(info.binsha, use_crc=True)
+                # END for each object
+
+        # files larger than the window are read through all of its windows
+        offsets = [(i * 7919) % 5000 for i in xrange(5000)]
+        large_rev_path = os.path.join(rw_dir, 'large.rev')
+        with open(large_rev_path, 'wb') as fp:
+            write_reverse_index(offsets, b'\x01' * 20, fp.write)
+        # END write reverse index
+        with smmap.managed_mmaps(window_size=4096) as mman:
+            with PackReverseIndexFile(mman, large_rev_path) as rev:
+                assert rev.size() == len(offsets)
+                assert list(rev.index_positions()) == sorted(xrange(len(offsets)), key=offsets.__getitem__)
+                assert rev.packfile_checksum() == b'\x01' * 20
+                with open(large_rev_path, 'rb') as fp:
+                    assert rev.revfile_checksum() == fp.read()[-20:]
+                # END read checksum
+            # END with reverse index
+
     def test_pack_64(self):
         # TODO: hex-edit a pack helping us to verify that we can handle 64 byte offsets
         # of course without really needing such a huge pack
@@ -14,6 +14,7 @@ from gitdb.test.lib import (
 
 from gitdb import (
     DecompressMemMapReader,
+    DeltaBaseCache,
     FDCompressedSha1Writer,
     LooseObjectDB,
     Sha1Writer,
@@ -22,6 +23,7 @@ from gitdb import (
 )
 from gitdb.util import hex_to_bin
 
+import threading
 import zlib
 from gitdb.typ import (
     str_blob_type
@@ -163,3 +165,46 @@ class TestStream(TestBase):
                 dump = mdb.store(IStream(ostream.type, ostream.size, BytesIO(data)))
                 assert dump.hexsha == sha
         # end for each loose object sha to test
+
+    def test_delta_base_cache(self):
+        cache = DeltaBaseCache(budget=10)
+        assert cache.get(('pack', 1)) is None
+        cache.put(('pack', 1), b'1234')
+        cache.put(('pack', 2), b'5678')
+        assert cache.get(('pack', 1)) == b'1234'
+        assert len(cache) == 2 and cache.size() == 8
+
+        # the least recently used object is evicted to fit new ones
+        cache.put(('pack', 3), b'90')
+        assert len(cache) == 3 and cache.size() == 10
+        cache.put(('pack', 4), b'ab')
+        assert cache.get(('pack', 2)) is None
+        assert cache.get(('pack', 1)) == b'1234'
+        assert cache.size() <= cache.budget()
+
+        # objects larger than the budget are not cached at all
+        cache.put(('pack', 5), b'x' * 11)
+        assert cache.get(('pack', 5)) is None
+
+        assert cache.stats() == (2, 3)
+        assert cache.hit_rate() == 0.4
+        cache.clear()
+        assert len(cache) == 0 and cache.size() == 0
+
+        # readers of a database share their cache on many threads
+        def use_cache(seed):
+            for i in range(2000):
+                key = ('pack', (seed * i) % 13)
+                if cache.get(key) is None:
+                    cache.put(key, b'x' * (i % 5))
+            # END for each access
+
+        threads = [threading.Thread(target=use_cache, args=(seed,)) for seed in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # END for each thread
+        assert cache.size() == sum(len(cache.get(('pack', i)) or b'') for i in range(13))
+        assert cache.size() <= cache.budget()
+        assert sum(cache.stats()) == 4 * 2000 + 5 + 13
@@ -1,3 +1,4 @@
+from array import array
 import sys
 
 
@@ -12,6 +13,13 @@ except ImportError:
     xrange = range
 # end handle python version
 
+try:
+    from queue import Queue
+except ImportError:
+    # py2
+    from Queue import Queue
+# end handle queue module
+
 try:
     # Python 2
     buffer = buffer         # @UndefinedVariable
@@ -40,6 +48,35 @@ except NameError:
 
     memoryview = memoryview     # @ReservedAssignment
 
+if hasattr(array, 'frombytes'):
+    def array_frombytes(a, data):
+        """Append the items in data, interpreted as machine values, to array a"""
+        a.frombytes(data)
+
+    def array_tobytes(a):
+        """:return: the machine values of all items in array a as bytes"""
+        return a.tobytes()
+else:
+    def array_frombytes(a, data):
+        """Append the items in data, interpreted as machine values, to array a"""
+        a.fromstring(data)
+
+    def array_tobytes(a):
+        """:return: the machine values of all items in array a as bytes"""
+        return a.tostring()
+# END handle array.fromstring deprecation
+
+if hasattr(int, 'bit_length'):
+    def bit_length(i):
+        """:return: amount of bits needed to represent the non-negative integer i"""
+        return i.bit_length()
+else:
+    # py2.6
+    def bit_length(i):
+        """:return: amount of bits needed to represent the non-negative integer i"""
+        return i and len(bin(i)) - 2
+# END handle int.bit_length
+
 try:
     MAXSIZE = sys.maxint        # @UndefinedVariable
 except AttributeError:
@@ -50,6 +87,12 @@ try:
 except ImportError:
     from contextlib2 import ExitStack   # @UnusedImport
 
+try:
+    from collections import OrderedDict
+except ImportError:
+    # py2.6
+    from ordereddict import OrderedDict     # @UnusedImport
+
 try:
     from struct import unpack_from      # @UnusedImport
 except ImportError:
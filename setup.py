@@ -23,6 +23,7 @@ setup(
     install_requires=['smmap2 >= 2.1.0'],
     extras_require={
         ':python_version <= "2.7"': ['contextlib2'],
+        ':python_version < "2.7"': ['ordereddict'],
     },
     long_description="""GitDB is a pure-Python git object database""",
     # See https://pypi.python.org/pypi?%3Aaction=list_classifiers